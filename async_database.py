@@ -0,0 +1,153 @@
+"""Awaitable equivalents of the functions in database.py.
+
+SQLite calls block, so running them directly inside a handler stalls the
+whole event loop. Every function here hands the call to a dedicated thread
+pool (one thread per pooled connection) and awaits the result instead.
+"""
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+import database
+
+_executor = None
+
+
+def get_executor():
+    """Returns the database executor, creating it on first use."""
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(
+            max_workers=database.get_pool().size,
+            thread_name_prefix="database",
+        )
+    return _executor
+
+
+def shutdown_executor(wait=True):
+    """Stops the database executor. It is recreated on the next call."""
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=wait)
+        _executor = None
+
+
+async def run_in_executor(func, *args, **kwargs):
+    """Runs a blocking database function on the database executor."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_executor(), functools.partial(func, *args, **kwargs))
+
+
+async def initialize_database(storage_settings=None):
+    """Applies storage settings, creates the tables and runs pending migrations."""
+    return await run_in_executor(database.initialize_database, storage_settings)
+
+async def insert_order(user_id, from_city, to_city, tariff, trip_time, phone_number, price=None):
+    """Inserts a new order into the database."""
+    return await run_in_executor(
+        database.insert_order, user_id, from_city, to_city, tariff, trip_time, phone_number, price
+    )
+
+async def get_waiting_orders(due_before=None):
+    """Retrieves the orders with the status 'Ожидает', optionally only those due by ``due_before``."""
+    return await run_in_executor(database.get_waiting_orders, due_before)
+
+async def get_scheduled_orders(due_after):
+    """Retrieves the waiting orders with a trip time later than ``due_after``, soonest first."""
+    return await run_in_executor(database.get_scheduled_orders, due_after)
+
+async def get_order_by_id(order_id):
+    """Retrieves a single order by its ID."""
+    return await run_in_executor(database.get_order_by_id, order_id)
+
+async def get_user_orders(user_id):
+    """Retrieves all orders for a specific user."""
+    return await run_in_executor(database.get_user_orders, user_id)
+
+async def get_user_orders_page(user_id, before_id=None, after_id=None, limit=10):
+    """Retrieves one page of a user's orders, newest first."""
+    return await run_in_executor(database.get_user_orders_page, user_id, before_id, after_id, limit)
+
+async def get_user_orders_version(user_id):
+    """Returns the change counter of a user's orders."""
+    return await run_in_executor(database.get_user_orders_version, user_id)
+
+async def update_order_status(order_id, new_status):
+    """Updates the status of a specific order."""
+    return await run_in_executor(database.update_order_status, order_id, new_status)
+
+async def accept_order(order_id, driver_id, notification=None):
+    """Assigns a waiting order to a driver; returns None if it was already taken."""
+    return await run_in_executor(database.accept_order, order_id, driver_id, notification)
+
+async def expire_orders(before, limit=database.EXPIRE_BATCH_SIZE, notification=None):
+    """Marks waiting orders whose trip time passed before ``before`` as expired; returns their rows."""
+    return await run_in_executor(database.expire_orders, before, limit, notification)
+
+async def import_orders(orders, chunk_size=database.IMPORT_CHUNK_SIZE):
+    """Inserts orders in bulk. Returns how many were imported, or None on an error."""
+    return await run_in_executor(database.import_orders, orders, chunk_size)
+
+async def get_pending_dispatches(limit=20):
+    """Retrieves orders that have not been pushed to drivers yet."""
+    return await run_in_executor(database.get_pending_dispatches, limit)
+
+async def mark_dispatched(order_ids):
+    """Marks orders as pushed to drivers."""
+    return await run_in_executor(database.mark_dispatched, order_ids)
+
+async def get_due_notifications(limit=50):
+    """Retrieves the oldest due undelivered outbox message of each chat."""
+    return await run_in_executor(database.get_due_notifications, limit)
+
+async def mark_notifications_sent(notification_ids):
+    """Marks outbox messages as delivered."""
+    return await run_in_executor(database.mark_notifications_sent, notification_ids)
+
+async def reschedule_notification(notification_id, delay, error, give_up=False):
+    """Records a failed delivery attempt and schedules the next one."""
+    return await run_in_executor(database.reschedule_notification, notification_id, delay, error, give_up)
+
+async def load_persisted(kind):
+    """Retrieves all persisted (key, value) pairs of one kind."""
+    return await run_in_executor(database.load_persisted, kind)
+
+async def save_persisted(changes):
+    """Writes a batch of persistence changes in one transaction."""
+    return await run_in_executor(database.save_persisted, changes)
+
+async def get_driver_telegram_ids():
+    """Retrieves the Telegram IDs of all registered drivers."""
+    return await run_in_executor(database.get_driver_telegram_ids)
+
+async def get_driver_by_phone(phone_number):
+    """Retrieves a driver by their phone number."""
+    return await run_in_executor(database.get_driver_by_phone, phone_number)
+
+async def get_driver_by_telegram_id(telegram_id):
+    """Retrieves a driver by their Telegram ID."""
+    return await run_in_executor(database.get_driver_by_telegram_id, telegram_id)
+
+async def add_driver(telegram_id, phone_number, full_name, car_number):
+    """Adds a new driver to the database."""
+    return await run_in_executor(database.add_driver, telegram_id, phone_number, full_name, car_number)
+
+async def update_driver_telegram_id(phone_number, telegram_id):
+    """Updates the telegram_id for a driver with the given phone number."""
+    return await run_in_executor(database.update_driver_telegram_id, phone_number, telegram_id)
+
+async def get_driver_routes():
+    """Retrieves all declared routes as (telegram_id, from_city, to_city, tariff) rows."""
+    return await run_in_executor(database.get_driver_routes)
+
+async def set_driver_routes(telegram_id, routes):
+    """Replaces the (from_city, to_city, tariff) routes a driver serves."""
+    return await run_in_executor(database.set_driver_routes, telegram_id, routes)
+
+async def load_driver_sessions():
+    """Retrieves the open shifts as (telegram_id, city, started_at, last_seen_at) rows."""
+    return await run_in_executor(database.load_driver_sessions)
+
+async def save_driver_sessions(sessions):
+    """Writes a batch of shift changes in one transaction."""
+    return await run_in_executor(database.save_driver_sessions, sessions)
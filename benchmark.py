@@ -0,0 +1,1466 @@
+"""Micro-benchmarks for the taxi bots.
+
+Every benchmark runs against a throwaway database in a temporary directory,
+so the real ``orders.db`` is never touched.
+
+Usage:
+    python benchmark.py pool [--iterations N]
+    python benchmark.py drivers [--iterations N] [--changes N]
+    python benchmark.py handlers [--updates N] [--concurrency N] [--io-delay S]
+    python benchmark.py plans
+    python benchmark.py contention [--seconds N]
+    python benchmark.py notify [--messages N]
+    python benchmark.py persistence [--conversations N ...]
+    python benchmark.py webhook [--updates N] [--connections N]
+    python benchmark.py startup [--runs N]
+    python benchmark.py updates [--users N] [--concurrency N ...] [--latency S]
+    python benchmark.py keyboards [--orders N]
+    python benchmark.py edits [--users N] [--taps N] [--interval S] [--debounce S]
+    python benchmark.py ingest [--rows N] [--chunk-size N]
+    python benchmark.py metrics [--iterations N] [--users N]
+    python benchmark.py matching [--orders N] [--drivers N] [--pages N]
+    python benchmark.py schedule [--orders N] [--seconds S]
+    python benchmark.py quote [--quotes N] [--fares FILE]
+    python benchmark.py expiry [--history N] [--stale N] [--batch-size N]
+    python benchmark.py e2e [--clients N] [--drivers N] [--latency S] [--output FILE] [--baseline FILE]
+"""
+import argparse
+import asyncio
+import collections
+import datetime
+import json
+import logging
+import multiprocessing
+import os
+import random
+import re
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+from telegram import Update
+from telegram.request import BaseRequest
+
+import async_database
+import database
+import expiry
+import fares
+import keyboards
+import matching
+import metrics
+import scheduling
+from fake_bot_api import FakeBotApi
+from notifications import NotificationClient
+from persistence import SQLitePersistence
+from webhook import WebhookServer
+
+
+def _use_temp_database(directory):
+    """Points the database module at a fresh file inside ``directory``."""
+    database.DB_FILE = os.path.join(directory, "bench.db")
+    database.configure_pool()
+    database.initialize_database()
+
+
+def _seed(order_count=100, driver_count=10):
+    for i in range(driver_count):
+        database.add_driver(1000 + i, f"+7900000{i:04d}", f"Водитель {i}", f"А{i:03d}АА")
+    for i in range(order_count):
+        database.insert_order(i, "Уфа", "Туймазы", "Стандарт", "12:00", "+79000000000")
+
+
+def _report(name, iterations, elapsed):
+    per_call_us = elapsed / iterations * 1_000_000
+    print(f"{name:<24} {iterations:>8} calls  {elapsed:8.3f}s  {per_call_us:8.1f} us/call  {iterations / elapsed:10.0f} calls/s")
+
+
+def _connect_per_call_lookup(order_id, telegram_id):
+    """The pre-pool access path: a fresh connection for every query."""
+    conn = sqlite3.connect(database.DB_FILE, check_same_thread=False)
+    try:
+        conn.execute("SELECT * FROM orders WHERE id = ?", (order_id,)).fetchone()
+    finally:
+        conn.close()
+    conn = sqlite3.connect(database.DB_FILE, check_same_thread=False)
+    try:
+        conn.execute("SELECT * FROM drivers WHERE telegram_id = ?", (telegram_id,)).fetchone()
+    finally:
+        conn.close()
+
+
+def _pooled_lookup(order_id, telegram_id):
+    database.get_order_by_id(order_id)
+    database.get_driver_by_telegram_id(telegram_id)
+
+
+def bench_pool(args):
+    """Compares connect-per-call with the pooled path for a driver tap's lookups."""
+    with tempfile.TemporaryDirectory() as directory:
+        _use_temp_database(directory)
+        _seed()
+
+        for name, lookup in (("connect-per-call", _connect_per_call_lookup), ("pooled", _pooled_lookup)):
+            start = time.perf_counter()
+            for i in range(args.iterations):
+                lookup(i % 100 + 1, 1000 + i % 10)
+            _report(name, args.iterations, time.perf_counter() - start)
+
+        database.close_pool()
+
+
+
+def _change_car_number(db_file, telegram_id, car_number):
+    """Runs in another process, like the other bot writing to the drivers table."""
+    conn = sqlite3.connect(db_file)
+    conn.execute("UPDATE drivers SET car_number = ? WHERE telegram_id = ?", (car_number, telegram_id))
+    conn.commit()
+    conn.close()
+
+
+def bench_drivers(args):
+    """Driver lookups with and without the cache, plus a cross-process staleness check."""
+    stale = 0
+    with tempfile.TemporaryDirectory() as directory:
+        _use_temp_database(directory)
+        _seed()
+        cache = database.get_driver_cache()
+
+        start = time.perf_counter()
+        for i in range(args.iterations):
+            with database.get_connection() as conn:
+                conn.execute("SELECT * FROM drivers WHERE telegram_id = ?", (1000 + i % 10,)).fetchone()
+        _report("uncached", args.iterations, time.perf_counter() - start)
+
+        start = time.perf_counter()
+        for i in range(args.iterations):
+            database.get_driver_by_telegram_id(1000 + i % 10)
+        _report("cached", args.iterations, time.perf_counter() - start)
+        print(f"  {cache.metrics}")
+
+        # The same process re-registering a driver
+        database.get_driver_by_phone("+79000000001")
+        database.update_driver_telegram_id("+79000000001", 2001)
+        stale += database.get_driver_by_phone("+79000000001")[0] != 2001
+
+        # The other bot process changing a car number behind this cache
+        ctx = multiprocessing.get_context("spawn")
+        for attempt in range(args.changes):
+            car_number = f"Б{attempt:03d}ББ"
+            database.get_driver_by_telegram_id(1002)
+            writer = ctx.Process(target=_change_car_number, args=(database.DB_FILE, 1002, car_number))
+            writer.start()
+            writer.join()
+            # Changes from another process show up within one version check interval
+            time.sleep(cache.check_interval)
+            stale += database.get_driver_by_telegram_id(1002)[3] != car_number
+        print(f"stale reads after {args.changes + 1} changes: {stale}  {cache.metrics}")
+
+        database.close_pool()
+
+    if stale:
+        sys.exit(1)
+
+def _percentile(values, percent):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(percent / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def _report_latencies(name, latencies):
+    ms = [value * 1000 for value in latencies]
+    print(
+        f"{name:<24} p50 {_percentile(ms, 50):8.2f} ms  p95 {_percentile(ms, 95):8.2f} ms  "
+        f"p99 {_percentile(ms, 99):8.2f} ms  max {max(ms):8.2f} ms"
+    )
+
+
+async def _sync_handler(i):
+    """A handler in the old style: database calls block the event loop."""
+    if i % 4 == 0:
+        database.insert_order(i, "Уфа", "Туймазы", "Стандарт", "12:00", "+79000000000")
+    else:
+        database.get_order_by_id(i % 100 + 1)
+    await asyncio.sleep(0.002)  # stand-in for the Telegram reply
+
+
+async def _async_handler(i):
+    """The same handler using the awaitable database API."""
+    if i % 4 == 0:
+        await async_database.insert_order(i, "Уфа", "Туймазы", "Стандарт", "12:00", "+79000000000")
+    else:
+        await async_database.get_order_by_id(i % 100 + 1)
+    await asyncio.sleep(0.002)
+
+
+async def _light_handler(i):
+    """A handler that never touches the database, e.g. a menu button."""
+    await asyncio.sleep(0.002)
+
+
+async def _drive_handlers(handler, updates, concurrency):
+    """Feeds ``updates`` updates through the handlers and returns latencies.
+
+    Every other update is a light handler, so the result shows both how long
+    database-bound updates take and how much they delay unrelated users.
+    """
+    latencies = {"database": [], "other users": []}
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def process(i):
+        async with semaphore:
+            start = time.perf_counter()
+            if i % 2:
+                await _light_handler(i)
+                latencies["other users"].append(time.perf_counter() - start)
+            else:
+                await handler(i)
+                latencies["database"].append(time.perf_counter() - start)
+
+    await asyncio.gather(*(process(i) for i in range(updates)))
+    return latencies
+
+
+def _with_io_delay(func, delay):
+    """Wraps a database function so every call also waits ``delay`` seconds, like a slow disk."""
+    def slow(*args, **kwargs):
+        time.sleep(delay)
+        return func(*args, **kwargs)
+    return slow
+
+
+def bench_handlers(args):
+    """Measures handler latency with blocking vs. awaitable database calls under slow storage.
+
+    Every commit is fsynced (rollback journal, synchronous=FULL), half of the
+    database-bound updates write, and ``--io-delay`` is added to each call,
+    so a blocking call holds up every other user on the event loop.
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        _use_temp_database(directory)
+        database.initialize_database({"journal_mode": "DELETE", "synchronous": "FULL"})
+        _seed()
+        originals = {name: getattr(database, name) for name in ("insert_order", "get_order_by_id")}
+        for name, func in originals.items():
+            setattr(database, name, _with_io_delay(func, args.io_delay))
+
+        try:
+            for mode, handler in (("blocking", _sync_handler), ("async", _async_handler)):
+                latencies = asyncio.run(_drive_handlers(handler, args.updates, args.concurrency))
+                for group, values in latencies.items():
+                    _report_latencies(f"{mode} / {group}", values)
+                async_database.shutdown_executor()
+        finally:
+            for name, func in originals.items():
+                setattr(database, name, func)
+
+        database.close_pool()
+
+
+# Storage configurations compared by the contention benchmark
+CONTENTION_CONFIGS = {
+    "rollback journal": {"journal_mode": "DELETE", "synchronous": "FULL"},
+    "wal": {},
+}
+
+
+def _contention_worker(db_file, settings, role, seconds, results):
+    """Writes as fast as possible for ``seconds`` as the client or the driver process."""
+    database.DB_FILE = db_file
+    database.configure_storage(settings)
+    writes = locked = 0
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        try:
+            with database.get_connection() as conn:
+                if role == "client":
+                    conn.execute(
+                        "INSERT INTO orders (user_id, from_city, to_city, tariff, trip_time, phone_number) "
+                        "VALUES (1, 'Уфа', 'Туймазы', 'Стандарт', '12:00', '+79000000000')"
+                    )
+                else:
+                    conn.execute(
+                        "UPDATE orders SET status = 'Принят', driver_id = 1000 "
+                        "WHERE id = (SELECT id FROM orders WHERE status = 'Ожидает' LIMIT 1)"
+                    )
+                conn.commit()
+            writes += 1
+        except sqlite3.OperationalError:
+            locked += 1
+    database.close_pool()
+    results.put((role, writes, locked))
+
+
+def bench_contention(args):
+    """Measures sustained writes/s of a client and a driver process sharing one database."""
+    ctx = multiprocessing.get_context("spawn")
+    with tempfile.TemporaryDirectory() as directory:
+        for name, settings in CONTENTION_CONFIGS.items():
+            db_file = os.path.join(directory, f"{name.replace(' ', '_')}.db")
+            database.DB_FILE = db_file
+            database.initialize_database(settings)
+            database.close_pool()
+
+            results = ctx.Queue()
+            workers = [
+                ctx.Process(target=_contention_worker, args=(db_file, settings, role, args.seconds, results))
+                for role in ("client", "driver")
+            ]
+            for worker in workers:
+                worker.start()
+            counts = {role: (writes, locked) for role, writes, locked in (results.get() for _ in workers)}
+            for worker in workers:
+                worker.join()
+
+            total = sum(writes for writes, _ in counts.values())
+            locked = sum(locked for _, locked in counts.values())
+            print(
+                f"{name:<18} {total / args.seconds:10.0f} writes/s  "
+                f"(client {counts['client'][0]}, driver {counts['driver'][0]}, locked errors {locked})"
+            )
+
+
+# Seconds the mock Bot API asks rate limited clients to wait
+MOCK_RETRY_AFTER = 0.05
+
+
+def _flaky_bot_api(request):
+    """Mock Bot API: the first attempt for every 10th chat is rate limited and
+    for every 25th chat fails with 502; retries succeed. Records when each
+    attempt arrived."""
+    chat_id = json.loads(request.content)["chat_id"]
+    attempts = _flaky_bot_api.attempts.setdefault(chat_id, [])
+    attempts.append(time.monotonic())
+    if len(attempts) == 1 and chat_id % 10 == 0:
+        return httpx.Response(429, json={
+            "ok": False,
+            "error_code": 429,
+            "description": f"Too Many Requests: retry after {MOCK_RETRY_AFTER}",
+            "parameters": {"retry_after": MOCK_RETRY_AFTER},
+        })
+    if len(attempts) == 1 and chat_id % 25 == 0:
+        return httpx.Response(502, text="Bad Gateway")
+    return httpx.Response(200, json={"ok": True, "result": {"message_id": chat_id}})
+
+
+async def _send_notifications(messages, concurrency):
+    _flaky_bot_api.attempts = {}
+    notifier = NotificationClient("TOKEN", transport=httpx.MockTransport(_flaky_bot_api), backoff=0)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def send(i):
+        async with semaphore:
+            await notifier.send_message(i, "Ваш заказ принят!")
+
+    start = time.perf_counter()
+    await asyncio.gather(*(send(i) for i in range(messages)))
+    elapsed = time.perf_counter() - start
+    await notifier.close()
+    return elapsed, notifier.metrics
+
+
+def bench_notify(args):
+    """Exercises the notification client, including retries, against a mock transport; fails on wrong counts."""
+    elapsed, metrics = asyncio.run(_send_notifications(args.messages, args.concurrency))
+    print(f"{args.messages} notifications in {elapsed:.3f}s ({args.messages / elapsed:.0f}/s)")
+    for name, value in metrics.items():
+        print(f"  {name:<16} {value:.3f}" if isinstance(value, float) else f"  {name:<16} {value}")
+
+    rate_limited = [chat_id for chat_id in range(args.messages) if chat_id % 10 == 0]
+    bad_gateway = [chat_id for chat_id in range(args.messages) if chat_id % 25 == 0 and chat_id % 10 != 0]
+    # A retry after a 429 must wait at least the retry_after the Bot API asked for
+    early = sum(
+        attempts[1] - attempts[0] < MOCK_RETRY_AFTER
+        for attempts in (_flaky_bot_api.attempts[chat_id] for chat_id in rate_limited)
+    )
+    expected = {
+        "sent": args.messages,
+        "failed": 0,
+        "rate_limited": len(rate_limited),
+        "retries": len(rate_limited) + len(bad_gateway),
+        "request_count": args.messages + len(rate_limited) + len(bad_gateway),
+    }
+    failures = 0
+    for name, value in expected.items():
+        if metrics[name] != value:
+            print(f"FAIL  {name}: expected {value}, got {metrics[name]}")
+            failures += 1
+    if early:
+        print(f"FAIL  {early} retries after a 429 came sooner than retry_after")
+        failures += 1
+    if failures:
+        sys.exit(1)
+    print("ok    counters match the injected faults and 429 retries honored retry_after")
+
+
+async def _flush_conversations(count):
+    persistence = SQLitePersistence("bench")
+    user_data = {"from_city": "Уфа", "to_city": "Туймазы", "tariff": "Стандарт", "phone_number": "+79000000000"}
+    for user_id in range(count):
+        await persistence.update_conversation("order_conversation", (user_id, user_id), 4)
+        await persistence.update_user_data(user_id, user_data)
+
+    start = time.perf_counter()
+    await persistence.flush()
+    return time.perf_counter() - start, persistence.metrics["rows_written"]
+
+
+def bench_persistence(args):
+    """Measures one write-behind flush against the number of active conversations."""
+    with tempfile.TemporaryDirectory() as directory:
+        _use_temp_database(directory)
+        for count in args.conversations:
+            elapsed, rows = asyncio.run(_flush_conversations(count))
+            print(f"{count:>8} conversations  {rows:>8} rows  flush {elapsed * 1000:9.2f} ms  {elapsed / rows * 1e6:7.2f} us/row")
+            async_database.shutdown_executor()
+        database.close_pool()
+
+
+# Updates as recorded from the Bot API, replayed against the webhook server
+RECORDED_UPDATES = {
+    "client": {
+        "update_id": 100000001,
+        "callback_query": {
+            "id": "4382bfdwdsb323b2d9",
+            "from": {"id": 111111, "is_bot": False, "first_name": "Иван"},
+            "message": {
+                "message_id": 42,
+                "date": 1760000000,
+                "chat": {"id": 111111, "type": "private"},
+                "text": "Выберите время поездки:",
+            },
+            "chat_instance": "-5312331200000000000",
+            "data": "hour_up",
+        },
+    },
+    "driver": {
+        "update_id": 200000001,
+        "message": {
+            "message_id": 7,
+            "date": 1760000000,
+            "chat": {"id": 222222, "type": "private"},
+            "from": {"id": 222222, "is_bot": False, "first_name": "Пётр"},
+            "text": "/start",
+            "entities": [{"type": "bot_command", "offset": 0, "length": 6}],
+        },
+    },
+}
+
+
+async def _replay_webhook(updates, connections):
+    from telegram.ext import Application
+
+    secret_token = "bench-secret"
+    server = WebhookServer(port=0, max_queue=updates)
+    applications = {}
+    for path in RECORDED_UPDATES:
+        application = Application.builder().token("123456:BENCHMARK").updater(None).build()
+        applications[path] = application
+        server.add_bot(path, application, secret_token)
+    await server.start()
+
+    received = 0
+    done = asyncio.Event()
+
+    async def consume(application):
+        nonlocal received
+        while True:
+            await application.update_queue.get()
+            received += 1
+            if received == updates:
+                done.set()
+
+    consumers = [asyncio.create_task(consume(application)) for application in applications.values()]
+
+    async def post(connection, count):
+        reader, writer = await asyncio.open_connection("127.0.0.1", server.port)
+        for i in range(count):
+            path = "client" if (connection + i) % 2 else "driver"
+            body = json.dumps(RECORDED_UPDATES[path]).encode()
+            writer.write(
+                f"POST /{path} HTTP/1.1\r\nHost: localhost\r\nContent-Type: application/json\r\n"
+                f"X-Telegram-Bot-Api-Secret-Token: {secret_token}\r\n"
+                f"Content-Length: {len(body)}\r\n\r\n".encode() + body
+            )
+            await writer.drain()
+            while (await reader.readline()) not in (b"\r\n", b""):
+                pass
+        writer.close()
+
+    start = time.perf_counter()
+    per_connection = updates // connections
+    await asyncio.gather(*(post(connection, per_connection) for connection in range(connections)))
+    await done.wait()
+    elapsed = time.perf_counter() - start
+
+    for consumer in consumers:
+        consumer.cancel()
+    await server.stop()
+    return elapsed, server.metrics
+
+
+def bench_webhook(args):
+    """Replays recorded updates against the webhook server and reports updates/s."""
+    args.updates -= args.updates % args.connections
+    elapsed, metrics = asyncio.run(_replay_webhook(args.updates, args.connections))
+    print(f"{args.updates} updates over {args.connections} connections in {elapsed:.3f}s ({args.updates / elapsed:.0f} updates/s)")
+    print(f"  {metrics}")
+
+
+
+
+class _FakeBotApi(BaseRequest):
+    """Answers every Bot API call after about ``latency`` seconds, like a remote server.
+
+    The delay varies from call to call, so updates handled concurrently
+    finish in a different order than they started.
+    """
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.calls = 0
+        self.methods = collections.Counter()
+        self._random = random.Random(42)
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def do_request(self, url, method, request_data=None, **kwargs):
+        self.calls += 1
+        await asyncio.sleep(self._random.uniform(0, 2 * self.latency))
+        params = request_data.parameters if request_data else {}
+        bot_method = url.rsplit("/", 1)[-1]
+        self.methods[bot_method] += 1
+        if bot_method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "Benchmark", "username": "benchmark_bot"}
+        elif bot_method in ("sendMessage", "editMessageText"):
+            chat = {"id": params.get("chat_id", 1), "type": "private"}
+            result = {"message_id": 1, "date": 1760000000, "chat": chat, "text": params.get("text", "")}
+        else:
+            result = True
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+
+def _message_update(user_id, text, **extra):
+    user = {"id": user_id, "is_bot": False, "first_name": "Клиент"}
+    chat = {"id": user_id, "type": "private"}
+    return {"message": {"message_id": 1, "date": 1760000000, "chat": chat, "from": user, "text": text, **extra}}
+
+
+def _callback_update(user_id, data):
+    message = _message_update(user_id, "…")["message"]
+    return {"callback_query": {
+        "id": f"{user_id}-{data}", "from": message["from"], "chat_instance": str(user_id),
+        "message": message, "data": data,
+    }}
+
+
+def _order_flow(user_id):
+    """The updates of one client ordering a taxi from /start to the trip time."""
+    return [
+        _message_update(user_id, "/start", entities=[{"type": "bot_command", "offset": 0, "length": 6}]),
+        _callback_update(user_id, "new_order"),
+        _callback_update(user_id, "Уфа"),
+        _callback_update(user_id, "Туймазы"),
+        _callback_update(user_id, "Стандарт"),
+        _message_update(user_id, "89271234567"),
+        _message_update(user_id, "18:30"),
+    ]
+
+
+async def _drive_conversations(users, concurrency, latency):
+    import bot
+    from runner import shutdown_application, start_application, stop_application
+
+    api = _FakeBotApi(latency)
+    config = {"CLIENT_TELEGRAM_TOKEN": "123456:BENCHMARK", "CONCURRENT_UPDATES": concurrency}
+    application = bot.build_application(config, request=api)
+    await start_application(application, polling=False)
+
+    # Users interleaved at random, each user's updates in their own order
+    pending = [_order_flow(20000 + user)[::-1] for user in range(users)]
+    rng = random.Random(7)
+    updates = []
+    while pending:
+        flow = rng.choice(pending)
+        updates.append(flow.pop())
+        if not flow:
+            pending.remove(flow)
+    start = time.perf_counter()
+    for update_id, data in enumerate(updates, start=1):
+        await application.update_queue.put(Update.de_json({"update_id": update_id, **data}, application.bot))
+    while application.update_processor.metrics["processed"] < len(updates):
+        await asyncio.sleep(0.01)
+    elapsed = time.perf_counter() - start
+
+    metrics = dict(application.update_processor.metrics)
+    await stop_application(application)
+    await shutdown_application(application)
+    return len(updates), elapsed, api.calls, metrics
+
+
+def bench_updates(args):
+    """Stress test: complete order conversations of many users through bot.py's handlers."""
+    failures = 0
+    for concurrency in args.concurrency:
+        with tempfile.TemporaryDirectory() as directory:
+            _use_temp_database(directory)
+            count, elapsed, calls, metrics = asyncio.run(_drive_conversations(args.users, concurrency, args.latency))
+            with database.get_connection() as conn:
+                completed = conn.execute(
+                    "SELECT COUNT(DISTINCT user_id) FROM orders "
+                    "WHERE trip_time LIKE '% 18:30' AND phone_number = '+79271234567'"
+                ).fetchone()[0]
+            database.close_pool()
+
+        # Every conversation only completes if its updates were handled in order
+        failures += completed != args.users
+        print(
+            f"concurrency {concurrency:<4} {count} updates in {elapsed:.2f}s ({count / elapsed:.0f} updates/s), "
+            f"{calls} API calls, {completed}/{args.users} orders"
+        )
+        print(f"  {metrics}")
+
+    if failures:
+        sys.exit(1)
+
+
+async def _drive_time_picker(users, taps, interval, debounce):
+    import bot
+    from runner import shutdown_application, start_application, stop_application
+
+    api = _FakeBotApi(0.01)
+    config = {"CLIENT_TELEGRAM_TOKEN": "123456:BENCHMARK", "EDIT_DEBOUNCE": debounce}
+    application = bot.build_application(config, request=api)
+    await start_application(application, polling=False)
+    processor = application.update_processor
+    update_ids = iter(range(1, 10 ** 9))
+
+    async def feed(updates):
+        for data in updates:
+            await application.update_queue.put(Update.de_json({"update_id": next(update_ids), **data}, application.bot))
+        target = processor.metrics["processed"] + len(updates)
+        while processor.metrics["processed"] < target:
+            await asyncio.sleep(0.005)
+
+    user_ids = [30000 + user for user in range(users)]
+    # Everything up to the time picker, without typing the time
+    await feed([data for user_id in user_ids for data in _order_flow(user_id)[:-1]])
+    edits_before = api.methods["editMessageText"]
+
+    # Every user taps "+" quickly, e.g. to get from 12:00 to 18:45
+    actions = (["hour_up"] * 6 + ["minute_up"] * 3) * (taps // 9 + 1)
+    for action in actions[:taps]:
+        await feed([_callback_update(user_id, action) for user_id in user_ids])
+        await asyncio.sleep(interval)
+    await feed([_callback_update(user_id, "confirm_time") for user_id in user_ids])
+
+    # The confirmation itself is one edit per user
+    picker_edits = api.methods["editMessageText"] - edits_before - users
+    metrics = dict(application.bot_data["edit_coalescer"].metrics)
+    await stop_application(application)
+    await shutdown_application(application)
+    return picker_edits, metrics
+
+
+def bench_edits(args):
+    """Time-picker edits sent to Telegram for bursts of taps, with and without debouncing."""
+    for debounce in (0.0, args.debounce):
+        with tempfile.TemporaryDirectory() as directory:
+            _use_temp_database(directory)
+            picker_edits, metrics = asyncio.run(_drive_time_picker(args.users, args.taps, args.interval, debounce))
+            with database.get_connection() as conn:
+                orders = conn.execute("SELECT COUNT(*) FROM orders").fetchone()[0]
+            database.close_pool()
+        taps = args.users * args.taps
+        print(
+            f"debounce {debounce:.2f}s  {taps} taps -> {picker_edits} edits "
+            f"({picker_edits / taps:.0%}), {orders}/{args.users} orders  {metrics}"
+        )
+
+
+
+def _order_flow_keyboards(registry):
+    """The markups one order needs, per callback: ``registry`` prebuilt or None to build them."""
+    from bot import CITIES, TARIFFS
+
+    taps = [(12, 0), (13, 0), (14, 0), (14, 15), (14, 30), (15, 30)]
+    if registry is None:
+        return [
+            lambda: keyboards.main_menu_keyboard(),
+            lambda: keyboards.choice_keyboard(CITIES),
+            lambda: keyboards.choice_keyboard([city for city in CITIES if city != "Уфа"]),
+            lambda: keyboards.tariff_keyboard(TARIFFS),
+            lambda: keyboards.contact_keyboard(),
+        ] + [lambda hour=hour, minute=minute: keyboards.time_picker_keyboard(hour, minute) for hour, minute in taps]
+    return [
+        lambda: registry.main_menu,
+        lambda: registry.city_from,
+        lambda: registry.city_to["Уфа"],
+        lambda: registry.tariffs_for("Уфа", "Туймазы"),
+        lambda: registry.contact,
+    ] + [lambda hour=hour, minute=minute: registry.time(hour, minute) for hour, minute in taps]
+
+
+def bench_keyboards(args):
+    """Per-callback CPU time and allocations of building vs. reusing keyboards over an order flow."""
+    import tracemalloc
+
+    from bot import KEYBOARDS
+
+    for name, registry in (("built per callback", None), ("prebuilt registry", KEYBOARDS)):
+        flow = _order_flow_keyboards(registry)
+        callbacks = args.orders * len(flow)
+
+        start = time.process_time()
+        for _ in range(args.orders):
+            for markup in flow:
+                markup()
+        cpu = time.process_time() - start
+
+        tracemalloc.start()
+        before = tracemalloc.take_snapshot()
+        kept = [markup() for markup in flow]
+        allocated = tracemalloc.take_snapshot().compare_to(before, "filename")
+        tracemalloc.stop()
+        del kept
+        blocks = sum(stat.count_diff for stat in allocated if stat.count_diff > 0)
+        size = sum(stat.size_diff for stat in allocated if stat.size_diff > 0)
+
+        print(
+            f"{name:<20} {cpu / callbacks * 1e6:7.2f} us/callback  "
+            f"{blocks / len(flow):6.1f} blocks  {size / len(flow):8.0f} bytes allocated per callback"
+        )
+
+    # What remains per callback either way: PTB serializes the markup for every request
+    start = time.process_time()
+    for _ in range(args.orders):
+        for markup in _order_flow_keyboards(KEYBOARDS):
+            markup().to_json()
+    print(f"{'serializing markup':<20} {(time.process_time() - start) / callbacks * 1e6:7.2f} us/callback")
+
+
+def _synthetic_orders(count):
+    for i in range(count):
+        yield {
+            "user_id": 100000 + i % 5000, "from_city": "Уфа", "to_city": "Туймазы", "tariff": "Стандарт",
+            "trip_time": "12:00", "phone_number": "+79000000000", "status": "Выполнен",
+            "created_at": "2025-01-01 12:00:00",
+        }
+
+
+def bench_ingest(args):
+    """Rows/s of one-by-one inserts, bulk import and streaming export."""
+    import tracemalloc
+
+    with tempfile.TemporaryDirectory() as directory:
+        _use_temp_database(directory)
+
+        single = min(args.rows, 5000)
+        start = time.perf_counter()
+        for order in _synthetic_orders(single):
+            database.insert_order(*(order[field] for field in database.IMPORT_FIELDS[:6]))
+        elapsed = time.perf_counter() - start
+        print(f"{'insert_order':<16} {single:>9} rows  {single / elapsed:10.0f} rows/s")
+
+        start = time.perf_counter()
+        imported = database.import_orders(_synthetic_orders(args.rows), chunk_size=args.chunk_size)
+        elapsed = time.perf_counter() - start
+        if imported is None:
+            sys.exit(1)
+        print(f"{'import_orders':<16} {imported:>9} rows  {imported / elapsed:10.0f} rows/s")
+
+        tracemalloc.start()
+        start = time.perf_counter()
+        exported = sum(1 for _ in database.export_orders())
+        elapsed = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print(f"{'export_orders':<16} {exported:>9} rows  {exported / elapsed:10.0f} rows/s  peak {peak / 1024:.0f} KB")
+
+        database.close_pool()
+
+def bench_metrics(args):
+    """Cost of a timing histogram per call, and what the registry shows after a run of bot.py."""
+    with tempfile.TemporaryDirectory() as directory:
+        _use_temp_database(directory)
+        _seed()
+        lookup = database.get_driver_by_telegram_id
+        lookup(1000)
+
+        start = time.perf_counter()
+        for _ in range(args.iterations):
+            lookup.__wrapped__(1000)
+        plain = (time.perf_counter() - start) / args.iterations
+        start = time.perf_counter()
+        for _ in range(args.iterations):
+            lookup(1000)
+        instrumented = (time.perf_counter() - start) / args.iterations
+        print(
+            f"cached driver lookup: {plain * 1e6:.2f} us plain, {instrumented * 1e6:.2f} us timed "
+            f"(+{(instrumented - plain) * 1e6:.2f} us per call)"
+        )
+
+        count, elapsed, _, _ = asyncio.run(_drive_conversations(args.users, 32, 0.005))
+        database.close_pool()
+    print(f"{count} updates in {elapsed:.2f}s\n")
+
+    start = time.perf_counter()
+    text = metrics.REGISTRY.render()
+    print(f"rendered {len(text.splitlines())} lines in {(time.perf_counter() - start) * 1e3:.1f} ms")
+    for name, labels, histogram in metrics.REGISTRY.histograms():
+        if histogram.count:
+            labels = ",".join(f"{key}={value}" for key, value in labels.items())
+            print(
+                f"  {name}{{{labels}}} n={histogram.count} "
+                f"p50<={histogram.percentile(50)} p95<={histogram.percentile(95)} p99<={histogram.percentile(99)}"
+            )
+
+
+def bench_matching(args):
+    """A driver's feed pages and a new order's recipients: database scan vs. matching index."""
+    rng = random.Random(42)
+    keys = [(*route, tariff) for route in matching.ROUTES for tariff in matching.TARIFFS]
+    with tempfile.TemporaryDirectory() as directory:
+        _use_temp_database(directory)
+        database.import_orders(
+            {"user_id": 100000 + i, "from_city": key[0], "to_city": key[1], "tariff": key[2],
+             "trip_time": "12:00", "phone_number": "+79000000000"}
+            for i, key in ((i, rng.choice(keys)) for i in range(args.orders))
+        )
+        # Half of the drivers serve two routes in one tariff, the rest everything
+        for i in range(args.drivers):
+            database.add_driver(1000 + i, f"+7900{i:07d}", f"Водитель {i}", f"А{i:03d}АА")
+            if i % 2 == 0:
+                database.set_driver_routes(1000 + i, rng.sample(keys, 2))
+
+        driver_routes = collections.defaultdict(set)
+        for driver_id, *key in database.get_driver_routes():
+            driver_routes[driver_id].add(tuple(key))
+
+        def scan_feed(driver_id, after_id=0):
+            routes = driver_routes.get(driver_id)
+            orders = [order for order in database.get_waiting_orders()
+                      if order[0] > after_id and (not routes or matching.order_route(order) in routes)]
+            return orders[:5]
+
+        def scan_recipients(order):
+            routes = collections.defaultdict(set)
+            for driver_id, *key in database.get_driver_routes():
+                routes[driver_id].add(tuple(key))
+            return {driver_id for driver_id in database.get_driver_telegram_ids()
+                    if not routes[driver_id] or matching.order_route(order) in routes[driver_id]}
+
+        start = time.perf_counter()
+        index = matching.MatchingIndex()
+        index.load(database.get_waiting_orders(), database.get_driver_telegram_ids(), database.get_driver_routes())
+        print(f"index load: {args.orders} orders in {(time.perf_counter() - start) * 1000:.1f} ms")
+
+        driver_ids = [1000 + i % args.drivers for i in range(args.pages)]
+        orders = [rng.choice(index.orders_for(1001, limit=100)) for _ in range(args.pages)]
+        # Deep pages start near the end of the feed; their cost must not grow with the offset
+        deep = args.orders - args.orders // 20
+        mismatches = sum(scan_feed(driver_id) != index.orders_for(driver_id, limit=5) for driver_id in driver_ids[:20])
+        mismatches += sum(
+            scan_feed(driver_id, deep) != index.orders_for(driver_id, after_id=deep, limit=5) for driver_id in driver_ids[:20]
+        )
+        mismatches += sum(scan_recipients(order) != index.drivers_for(order) for order in orders[:20])
+
+        for name, run in (
+            ("feed (scan)", lambda: [scan_feed(driver_id) for driver_id in driver_ids]),
+            ("feed (index)", lambda: [index.orders_for(driver_id, limit=5) for driver_id in driver_ids]),
+            ("deep feed (index)", lambda: [index.orders_for(driver_id, after_id=deep, limit=5) for driver_id in driver_ids]),
+            ("recipients (scan)", lambda: [scan_recipients(order) for order in orders]),
+            ("recipients (index)", lambda: [index.drivers_for(order) for order in orders]),
+        ):
+            start = time.perf_counter()
+            run()
+            elapsed = time.perf_counter() - start
+            print(f"{name:<20} {elapsed / args.pages * 1e6:10.1f} us/call")
+        database.close_pool()
+
+    print(f"mismatches between scan and index: {mismatches}")
+    if mismatches:
+        sys.exit(1)
+
+
+async def _run_release_scheduler(orders, seconds):
+    rng = random.Random(42)
+    released = {}
+    start = time.time()
+    release_at = {order_id: start + rng.uniform(0.1, seconds) for order_id in range(1, orders + 1)}
+
+    async def release(order):
+        released[order[0]] = time.time()
+
+    scheduler = scheduling.ReleaseScheduler(release)
+    # Release times straight from the table instead of from minute-resolution trip times
+    scheduler.release_time = lambda order: release_at[order[0]]
+    scheduler.start()
+    add_start = time.perf_counter()
+    for order_id in release_at:
+        await scheduler.add((order_id, 0, "Уфа", "Туймазы", "Стандарт", None, "+79000000000", "Ожидает"))
+    add_elapsed = time.perf_counter() - add_start
+    while len(released) < orders:
+        await asyncio.sleep(0.05)
+    await scheduler.stop()
+    return add_elapsed, [released[order_id] - release_at[order_id] for order_id in release_at]
+
+
+def bench_schedule(args):
+    """How late the release scheduler hands out bookings, and what scheduling one costs."""
+    add_elapsed, lateness = asyncio.run(_run_release_scheduler(args.orders, args.seconds))
+    print(f"scheduled {args.orders} orders in {add_elapsed * 1000:.1f} ms ({add_elapsed / args.orders * 1e6:.1f} us/order)")
+    _report_latencies("release lateness", lateness)
+
+
+def _price_from_settings(settings, from_city, to_city, tariff, trip_time):
+    """A quote worked out from the fares file on every call, as without the matrix."""
+    distances = settings.get("distances_km", {})
+    distance = distances.get(from_city, {}).get(to_city) or distances.get(to_city, {}).get(from_city)
+    rate = settings.get("tariffs", {}).get(tariff)
+    if from_city == to_city or distance is None or rate is None:
+        return None
+    price = max(rate.get("base", 0) + rate.get("per_km", 0) * distance, rate.get("minimum", 0))
+    minute = fares._minute_of_day(trip_time)
+    multiplier = 1.0
+    for period in settings.get("surge", []):
+        start, end = fares._minute_of_day(period["from"]), fares._minute_of_day(period["to"])
+        if (start <= minute < end) if start <= end else (minute >= start or minute < end):
+            multiplier = period["multiplier"]
+    return fares._round(price * multiplier, settings.get("rounding", fares.ROUNDING))
+
+
+def bench_quote(args):
+    """Fare quote throughput and per-quote latency: precomputed matrix vs. computing each quote."""
+    with open(args.fares, "r", encoding="utf-8") as f:
+        settings = json.load(f)
+    start = time.perf_counter()
+    table = fares.FareTable(matching.CITIES, matching.TARIFFS, settings)
+    print(f"matrix build: {(time.perf_counter() - start) * 1000:.2f} ms")
+
+    rng = random.Random(42)
+    keys = [(*route, tariff) for route in matching.ROUTES for tariff in matching.TARIFFS]
+    requests = [
+        (*rng.choice(keys), f"2026-01-01 {rng.randrange(24):02d}:{rng.randrange(0, 60, 5):02d}")
+        for _ in range(args.quotes)
+    ]
+    mismatches = sum(table.quote(*request) != _price_from_settings(settings, *request) for request in requests[:1000])
+
+    for name, quote in (
+        ("computed per call", lambda *request: _price_from_settings(settings, *request)),
+        ("precomputed matrix", table.quote),
+    ):
+        start = time.perf_counter()
+        for request in requests:
+            quote(*request)
+        elapsed = time.perf_counter() - start
+
+        latencies = []
+        for request in requests[:10000]:
+            quote_start = time.perf_counter()
+            quote(*request)
+            latencies.append(time.perf_counter() - quote_start)
+        us = [value * 1e6 for value in latencies]
+        print(
+            f"{name:<20} {args.quotes / elapsed:12.0f} quotes/s  "
+            f"p50 {_percentile(us, 50):6.2f} us  p99 {_percentile(us, 99):6.2f} us  max {max(us):8.2f} us"
+        )
+
+    print(f"mismatches between computed and precomputed quotes: {mismatches}")
+    if mismatches:
+        sys.exit(1)
+
+
+async def _sweep_until_done(sweeper):
+    sweeps = []
+    while True:
+        expired = await sweeper.sweep()
+        sweeps.append((len(expired), len({order[1] for order in expired}), sweeper.metrics["last_seconds"]))
+        if not expired:
+            return sweeps
+
+
+def bench_expiry(args):
+    """Expiry sweeps over stale waiting orders, and what they save every waiting-order scan."""
+    import driver_bot
+
+    now = scheduling.local_now()
+    stale = (now - datetime.timedelta(days=1)).strftime(scheduling.TRIP_TIME_FORMAT)
+    upcoming = (now + datetime.timedelta(hours=2)).strftime(scheduling.TRIP_TIME_FORMAT)
+    with tempfile.TemporaryDirectory() as directory:
+        _use_temp_database(directory)
+        # Mostly finished orders, a pile of abandoned ones (four per client) and a few still to come
+        database.import_orders(
+            {"user_id": 100000 + i // 4, "from_city": "Уфа", "to_city": "Туймазы", "tariff": "Стандарт",
+             "trip_time": stale, "phone_number": "+79000000000",
+             "status": "Ожидает" if i < args.stale else "Выполнен"}
+            for i in range(args.history + args.stale)
+        )
+        database.import_orders(
+            {"user_id": 100000 + i, "from_city": "Уфа", "to_city": "Туймазы", "tariff": "Стандарт",
+             "trip_time": upcoming, "phone_number": "+79000000000"}
+            for i in range(100)
+        )
+
+        def scan():
+            start = time.perf_counter()
+            for _ in range(20):
+                orders = database.get_waiting_orders()
+            return len(orders), (time.perf_counter() - start) / 20
+
+        waiting, before = scan()
+        sweeper = expiry.OrderSweeper(batch_size=args.batch_size, notification=driver_bot.format_expiry)
+        sweeps = asyncio.run(_sweep_until_done(sweeper))
+        async_database.shutdown_executor()
+        remaining, after = scan()
+
+        for number, (rows, clients, seconds) in enumerate(sweeps, 1):
+            print(f"sweep {number:<3} {rows:>7} rows {clients:>6} clients  {seconds * 1000:8.2f} ms")
+        with database.get_connection() as conn:
+            queued = conn.execute("SELECT COUNT(*) FROM outbox").fetchone()[0]
+        print(f"expired {sweeper.metrics['expired']} of {waiting} waiting orders, {queued} client notices queued")
+        print(f"get_waiting_orders: {waiting} rows {before * 1000:.2f} ms -> {remaining} rows {after * 1000:.2f} ms")
+        database.close_pool()
+
+    # One notice per client of each sweep
+    if remaining != 100 or queued != sum(clients for _, clients, _ in sweeps):
+        sys.exit(1)
+
+
+def _update_feeder(application):
+    """Returns ``send(data)``, which queues an update and returns the seconds until it was handled."""
+    processor = application.update_processor
+    process = processor.do_process_update
+    waiting = {}
+    update_ids = iter(range(1, 1 << 62))
+
+    async def do_process_update(update, coroutine):
+        try:
+            await process(update, coroutine)
+        finally:
+            future = waiting.pop(update.update_id, None)
+            if future is not None:
+                future.set_result(None)
+
+    processor.do_process_update = do_process_update
+
+    async def send(data):
+        update_id = next(update_ids)
+        waiting[update_id] = asyncio.get_running_loop().create_future()
+        start = time.perf_counter()
+        await application.update_queue.put(Update.de_json({"update_id": update_id, **data}, application.bot))
+        await waiting[update_id]
+        return time.perf_counter() - start
+
+    return send
+
+
+def _db_calls():
+    return collections.Counter({
+        labels["function"]: histogram.count
+        for name, labels, histogram in metrics.REGISTRY.histograms() if name == "db_call_seconds"
+    })
+
+
+def _latency_summary(latencies):
+    if not latencies:
+        return None
+    ms = [value * 1000 for value in latencies]
+    return {"p50": _percentile(ms, 50), "p95": _percentile(ms, 95), "p99": _percentile(ms, 99), "max": max(ms)}
+
+
+async def _run_e2e(clients, drivers, latency, race_window, concurrency, seed, timeout):
+    import bot
+    import driver_bot
+    from telegram.request import HTTPXRequest
+    from runner import shutdown_application, start_application, stop_application
+
+    client_token, driver_token = "123456:BENCHMARK", "654321:BENCHMARK"
+    api = FakeBotApi(port=0, latency=latency, seed=seed)
+    await api.start()
+    config = {
+        "CLIENT_TELEGRAM_TOKEN": client_token,
+        "DRIVER_TELEGRAM_TOKEN": driver_token,
+        "BOT_API_URL": api.url,
+        "CONCURRENT_UPDATES": concurrency,
+        # Every booking is due right away, whatever the time of day
+        "RELEASE_LEAD": 2 * 86400,
+    }
+    request = HTTPXRequest(connection_pool_size=256)
+    client_app = bot.build_application(config, request=request)
+    driver_app = driver_bot.build_application(config, request=request)
+    for application in (client_app, driver_app):
+        await start_application(application, polling=False)
+    send_client, send_driver = _update_feeder(client_app), _update_feeder(driver_app)
+
+    # Drivers only get new orders while on shift
+    for driver_id in database.get_driver_telegram_ids():
+        await send_driver(_message_update(driver_id, "/shift_start", entities=[
+            {"type": "bot_command", "offset": 0, "length": 12},
+        ]))
+        await send_driver(_callback_update(driver_id, "shift_city_0"))
+
+    rng = random.Random(seed)
+    client_latencies, accept_latencies = [], []
+    accept_tasks = []
+    winners = collections.Counter()
+    notified = set()
+
+    async def accept(driver_id, order_id):
+        await asyncio.sleep(rng.uniform(0, race_window))
+        accept_latencies.append(await send_driver(_callback_update(driver_id, f"accept_{order_id}")))
+
+    async def watch_messages():
+        # Drivers react to pushed orders; everything else is only counted
+        while True:
+            token, method, parameters = await api.messages.get()
+            text = parameters.get("text", "")
+            if token == client_token:
+                if text.startswith("Ваш заказ принят"):
+                    notified.add(parameters["chat_id"])
+                continue
+            accepted = re.match(r"^Заказ (\d+) принят", text)
+            if accepted:
+                winners[int(accepted.group(1))] += 1
+            for row in (parameters.get("reply_markup") or {}).get("inline_keyboard", []):
+                for button in row:
+                    if method == "sendMessage" and button.get("callback_data", "").startswith("accept_"):
+                        order_id = int(button["callback_data"].split("_")[1])
+                        accept_tasks.append(asyncio.create_task(accept(parameters["chat_id"], order_id)))
+
+    async def client(user_id):
+        for data in _order_flow(user_id):
+            client_latencies.append(await send_client(data))
+
+    watcher = asyncio.create_task(watch_messages())
+    calls_before = _db_calls()
+    start = time.perf_counter()
+    await asyncio.gather(*(client(30000 + i) for i in range(clients)))
+    # Every order is pushed to every driver, and every driver tries to take it
+    deadline = time.monotonic() + timeout
+    while len(accept_tasks) < clients * drivers and time.monotonic() < deadline:
+        await asyncio.sleep(0.01)
+    await asyncio.gather(*accept_tasks)
+    elapsed = time.perf_counter() - start
+    db_calls = _db_calls() - calls_before
+
+    # Client notifications are rate limited by the outbox worker; give them a moment
+    while len(notified) < len(winners) and time.monotonic() < deadline:
+        await asyncio.sleep(0.05)
+
+    watcher.cancel()
+    for application in (client_app, driver_app):
+        await stop_application(application)
+    for application in (client_app, driver_app):
+        await shutdown_application(application)
+    await api.stop()
+
+    with database.get_connection() as conn:
+        placed = conn.execute("SELECT COUNT(*) FROM orders").fetchone()[0]
+        accepted = conn.execute("SELECT COUNT(*) FROM orders WHERE status = 'Принят'").fetchone()[0]
+
+    bots = {client_token: "client", driver_token: "driver"}
+    api_calls = collections.Counter()
+    for (token, method), count in api.calls.items():
+        api_calls[f"{bots.get(token, token)}.{method}"] += count
+
+    return {
+        "clients": clients,
+        "drivers": drivers,
+        "latency": latency,
+        "race_window": race_window,
+        "concurrency": concurrency,
+        "seed": seed,
+        "orders_placed": placed,
+        "orders_accepted": accepted,
+        "accept_attempts": len(accept_tasks),
+        "elapsed_seconds": elapsed,
+        "orders_per_second": accepted / elapsed,
+        "client_latency_ms": _latency_summary(client_latencies),
+        "accept_latency_ms": _latency_summary(accept_latencies),
+        "db_ops_per_order": sum(db_calls.values()) / max(placed, 1),
+        "db_ops": dict(db_calls.most_common()),
+        "bot_api_calls": dict(api_calls.most_common()),
+        "double_accepts": sum(count - 1 for count in winners.values() if count > 1),
+        "clients_notified": len(notified),
+    }
+
+
+# Result keys compared against a baseline and whether larger values are better
+E2E_CHECKS = (
+    ("orders_per_second", True),
+    ("client_latency_ms.p95", False),
+    ("accept_latency_ms.p95", False),
+    ("db_ops_per_order", False),
+)
+
+
+def _regressions(result, baseline, tolerance):
+    regressions = []
+    for key, higher_is_better in E2E_CHECKS:
+        current, previous = result, baseline
+        for part in key.split("."):
+            current, previous = current[part], previous[part]
+        limit = previous * (1 - tolerance) if higher_is_better else previous * (1 + tolerance)
+        if (current < limit) if higher_is_better else (current > limit):
+            regressions.append(f"{key}: {current:.2f} vs. baseline {previous:.2f}")
+    return regressions
+
+
+def bench_e2e(args):
+    """Clients ordering through bot.py while drivers race for the orders in driver_bot.py, over HTTP."""
+    with tempfile.TemporaryDirectory() as directory:
+        _use_temp_database(directory)
+        for i in range(args.drivers):
+            database.add_driver(40000 + i, f"+7900{i:07d}", f"Водитель {i}", f"А{i:03d}АА102")
+        result = asyncio.run(_run_e2e(
+            args.clients, args.drivers, args.latency, args.race_window, args.concurrency, args.seed, args.timeout
+        ))
+        database.close_pool()
+
+    print(
+        f"{result['orders_accepted']}/{result['orders_placed']} orders accepted in {result['elapsed_seconds']:.2f}s "
+        f"({result['orders_per_second']:.1f} orders/s), {result['accept_attempts']} accept attempts, "
+        f"{result['double_accepts']} double accepts, {result['clients_notified']} clients notified"
+    )
+    for name in ("client_latency_ms", "accept_latency_ms"):
+        summary = result[name] or {}
+        print(f"  {name:<18} " + "  ".join(f"{key} {value:8.2f}" for key, value in summary.items()))
+    print(f"  db_ops_per_order   {result['db_ops_per_order']:.1f}")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+
+    failures = []
+    if result["double_accepts"]:
+        failures.append(f"{result['double_accepts']} orders were accepted more than once")
+    if result["orders_accepted"] != args.clients:
+        failures.append(f"only {result['orders_accepted']} of {args.clients} orders were accepted")
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            failures.extend(_regressions(result, json.load(f), args.tolerance))
+    for failure in failures:
+        print(f"FAIL {failure}")
+    if failures:
+        sys.exit(1)
+
+
+# Run in a fresh interpreter: import the given bot modules, build their
+# applications and print "<seconds> <RSS MB>"
+STARTUP_SNIPPET = """
+import sys, time
+start = time.perf_counter()
+import importlib
+from telegram.request import HTTPXRequest
+from runner import rss_mb
+config = {"CLIENT_TELEGRAM_TOKEN": "123456:BENCHMARK", "DRIVER_TELEGRAM_TOKEN": "654321:BENCHMARK"}
+request = HTTPXRequest()
+for name in sys.argv[1:]:
+    importlib.import_module(name).build_application(config, request=request)
+print(time.perf_counter() - start, rss_mb())
+"""
+
+
+def _measure_startup(modules):
+    """Returns (seconds, RSS MB) of one interpreter building ``modules``."""
+    output = subprocess.run(
+        [sys.executable, "-c", STARTUP_SNIPPET, *modules],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        capture_output=True, text=True, check=True,
+    ).stdout.split()
+    return float(output[0]), float(output[1])
+
+
+def bench_startup(args):
+    """Compares startup time and memory of the single-process and supervised modes."""
+    for _ in range(args.runs):
+        single = _measure_startup(["bot", "driver_bot"])
+        separate = [_measure_startup([module]) for module in ("bot", "driver_bot")]
+        print(f"{'single process':<24} startup {single[0]:6.2f}s  RSS {single[1]:6.1f} MB")
+        print(
+            f"{'supervised (2 procs)':<24} startup {max(s for s, _ in separate):6.2f}s  "
+            f"RSS {sum(rss for _, rss in separate):6.1f} MB"
+        )
+
+# Hot queries and the index each of them must use: (name, sql, params, index)
+# Hot queries as (name, call issuing them, index every statement of the call must use)
+QUERY_PLAN_EXPECTATIONS = [
+    ("get_waiting_orders", lambda: database.get_waiting_orders(), "idx_orders_waiting"),
+    ("get_waiting_orders (due)", lambda: database.get_waiting_orders("2025-01-01 12:00"), "idx_orders_waiting_trip_time"),
+    ("get_scheduled_orders", lambda: database.get_scheduled_orders("2025-01-01 12:00"), "idx_orders_waiting_trip_time"),
+    ("expire_orders", lambda: database.expire_orders("2000-01-01 00:00", 500), "idx_orders_waiting_trip_time"),
+    ("get_user_orders", lambda: database.get_user_orders(1), "idx_orders_user_id"),
+    ("get_user_orders_page", lambda: database.get_user_orders_page(1, before_id=50, limit=5), "idx_orders_user_id"),
+    ("get_user_orders_page (newer)", lambda: database.get_user_orders_page(1, after_id=50, limit=5), "idx_orders_user_id"),
+]
+
+
+def _traced_statements(call):
+    """The SQL statements ``call`` runs, as SQLite expands them with their parameters."""
+    statements = []
+    # The pool has a single connection here, so the call gets the traced one
+    with database.get_connection() as conn:
+        conn.set_trace_callback(statements.append)
+    try:
+        call()
+    finally:
+        with database.get_connection() as conn:
+            conn.set_trace_callback(None)
+    # A statement is reported again each time SQLite re-runs it, e.g. per row of UPDATE ... RETURNING
+    queries = (sql for sql in statements if sql.lstrip().upper().startswith(("SELECT", "UPDATE", "INSERT", "DELETE")))
+    return list(dict.fromkeys(queries))
+
+
+def bench_plans(args):
+    """Regression check: fails if a hot query stops using its index."""
+    failures = 0
+    with tempfile.TemporaryDirectory() as directory:
+        _use_temp_database(directory)
+        _seed()
+        database.configure_pool(size=1)
+
+        with database.get_connection() as conn:
+            # A realistic history: almost every order has been taken already
+            conn.execute("UPDATE orders SET status = 'Принят' WHERE id % 20 != 0")
+            conn.commit()
+            conn.execute("ANALYZE")
+
+        for name, call, index in QUERY_PLAN_EXPECTATIONS:
+            statements = _traced_statements(call)
+            with database.get_connection() as conn:
+                plans = [" / ".join(row[3] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}")) for sql in statements]
+            # A temporary B-tree means the rows are sorted instead of read in index order
+            ok = bool(plans) and all(index in plan and "TEMP B-TREE" not in plan for plan in plans)
+            failures += not ok
+            print(f"{'ok' if ok else 'FAIL':<5} {name:<30} {' | '.join(plans) or 'no statements traced'}")
+
+        database.close_pool()
+
+    if failures:
+        sys.exit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    pool_parser = subparsers.add_parser("pool", help="connection pool vs. connect-per-call")
+    pool_parser.add_argument("--iterations", type=int, default=5000)
+    pool_parser.set_defaults(func=bench_pool)
+
+    drivers_parser = subparsers.add_parser("drivers", help="driver cache hit rate and cross-process invalidation")
+    drivers_parser.add_argument("--iterations", type=int, default=20000)
+    drivers_parser.add_argument("--changes", type=int, default=5)
+    drivers_parser.set_defaults(func=bench_drivers)
+
+    handlers_parser = subparsers.add_parser("handlers", help="handler latency under concurrent updates")
+    handlers_parser.add_argument("--updates", type=int, default=2000)
+    handlers_parser.add_argument("--concurrency", type=int, default=50)
+    handlers_parser.add_argument("--io-delay", type=float, default=0.002, help="extra seconds per database call")
+    handlers_parser.set_defaults(func=bench_handlers)
+
+    plans_parser = subparsers.add_parser("plans", help="assert hot queries use their indexes")
+    plans_parser.set_defaults(func=bench_plans)
+
+    contention_parser = subparsers.add_parser("contention", help="two-process write throughput per storage mode")
+    contention_parser.add_argument("--seconds", type=float, default=3.0)
+    contention_parser.set_defaults(func=bench_contention)
+
+    notify_parser = subparsers.add_parser("notify", help="notification client against a mock Bot API")
+    notify_parser.add_argument("--messages", type=int, default=2000)
+    notify_parser.add_argument("--concurrency", type=int, default=20)
+    notify_parser.set_defaults(func=bench_notify)
+
+    persistence_parser = subparsers.add_parser("persistence", help="write-behind flush cost vs. active conversations")
+    persistence_parser.add_argument("--conversations", type=int, nargs="+", default=[10, 100, 1000, 10000])
+    persistence_parser.set_defaults(func=bench_persistence)
+
+    webhook_parser = subparsers.add_parser("webhook", help="replay recorded updates against the webhook server")
+    webhook_parser.add_argument("--updates", type=int, default=20000)
+    webhook_parser.add_argument("--connections", type=int, default=8)
+    webhook_parser.set_defaults(func=bench_webhook)
+
+    startup_parser = subparsers.add_parser("startup", help="startup time and RSS: single process vs. supervised")
+    startup_parser.add_argument("--runs", type=int, default=3)
+    startup_parser.set_defaults(func=bench_startup)
+
+    updates_parser = subparsers.add_parser("updates", help="order conversations of many users through bot.py")
+    updates_parser.add_argument("--users", type=int, default=300)
+    updates_parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 32])
+    updates_parser.add_argument("--latency", type=float, default=0.01, help="simulated Bot API latency in seconds")
+    updates_parser.set_defaults(func=bench_updates)
+
+    keyboards_parser = subparsers.add_parser("keyboards", help="keyboard building cost over a replayed order flow")
+    keyboards_parser.add_argument("--orders", type=int, default=10000)
+    keyboards_parser.set_defaults(func=bench_keyboards)
+
+    edits_parser = subparsers.add_parser("edits", help="debounced time-picker edits under bursts of taps")
+    edits_parser.add_argument("--users", type=int, default=50)
+    edits_parser.add_argument("--taps", type=int, default=9)
+    edits_parser.add_argument("--interval", type=float, default=0.1, help="seconds between taps")
+    edits_parser.add_argument("--debounce", type=float, default=0.4)
+    edits_parser.set_defaults(func=bench_edits)
+
+    ingest_parser = subparsers.add_parser("ingest", help="bulk import and streaming export throughput")
+    ingest_parser.add_argument("--rows", type=int, default=200000)
+    ingest_parser.add_argument("--chunk-size", type=int, default=database.IMPORT_CHUNK_SIZE)
+    ingest_parser.set_defaults(func=bench_ingest)
+
+    metrics_parser = subparsers.add_parser("metrics", help="timing overhead and a sample of the metrics registry")
+    metrics_parser.add_argument("--iterations", type=int, default=100000)
+    metrics_parser.add_argument("--users", type=int, default=20)
+    metrics_parser.set_defaults(func=bench_metrics)
+
+    matching_parser = subparsers.add_parser("matching", help="route matching: database scan vs. in-memory index")
+    matching_parser.add_argument("--orders", type=int, default=20000)
+    matching_parser.add_argument("--drivers", type=int, default=200)
+    matching_parser.add_argument("--pages", type=int, default=200)
+    matching_parser.set_defaults(func=bench_matching)
+
+    schedule_parser = subparsers.add_parser("schedule", help="release scheduler precision for many bookings")
+    schedule_parser.add_argument("--orders", type=int, default=100000)
+    schedule_parser.add_argument("--seconds", type=float, default=5.0, help="spread of the release times")
+    schedule_parser.set_defaults(func=bench_schedule)
+
+    quote_parser = subparsers.add_parser("quote", help="fare quote latency from the precomputed price matrix")
+    quote_parser.add_argument("--quotes", type=int, default=200000)
+    quote_parser.add_argument("--fares", default=fares.FARES_FILE, help="fares file to price with")
+    quote_parser.set_defaults(func=bench_quote)
+
+    expiry_parser = subparsers.add_parser("expiry", help="expiry sweeps over stale waiting orders")
+    expiry_parser.add_argument("--history", type=int, default=100000, help="finished orders")
+    expiry_parser.add_argument("--stale", type=int, default=5000, help="abandoned waiting orders")
+    expiry_parser.add_argument("--batch-size", type=int, default=database.EXPIRE_BATCH_SIZE)
+    expiry_parser.set_defaults(func=bench_expiry)
+
+    e2e_parser = subparsers.add_parser("e2e", help="both bots end to end against a local fake Bot API server")
+    e2e_parser.add_argument("--clients", type=int, default=100)
+    e2e_parser.add_argument("--drivers", type=int, default=10)
+    e2e_parser.add_argument("--latency", type=float, default=0.01, help="mean seconds per Bot API call")
+    e2e_parser.add_argument("--race-window", type=float, default=0.05, help="drivers tap within this many seconds")
+    e2e_parser.add_argument("--concurrency", type=int, default=32)
+    e2e_parser.add_argument("--seed", type=int, default=42)
+    e2e_parser.add_argument("--timeout", type=float, default=120.0)
+    e2e_parser.add_argument("--output", help="write the results as JSON")
+    e2e_parser.add_argument("--baseline", help="fail on a regression against this JSON result")
+    e2e_parser.add_argument("--tolerance", type=float, default=0.2, help="allowed relative regression")
+    e2e_parser.set_defaults(func=bench_e2e)
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.ERROR)
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
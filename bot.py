@@ -4,9 +4,12 @@ import os
 import json
 
 import re
+from collections import OrderedDict
 
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, ReplyKeyboardRemove, KeyboardButton, BotCommand
-from datetime import datetime, timedelta
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardRemove, BotCommand
+from datetime import timedelta
+from telegram.error import BadRequest
+from telegram.request import BaseRequest, HTTPXRequest
 from telegram.ext import (
     Application,
     CommandHandler,
@@ -16,17 +19,110 @@ from telegram.ext import (
     CallbackQueryHandler,
     filters,
 )
-from database import initialize_database, insert_order, get_user_orders
+from database import initialize_database
+from async_database import insert_order, get_user_orders_page, get_user_orders_version, shutdown_executor
+from persistence import SQLitePersistence, FLUSH_INTERVAL
+from update_processor import KeyedUpdateProcessor, CONCURRENT_UPDATES
+from instrumentation import InstrumentedRequest, instrument_handlers
+from metrics import REGISTRY
+from keyboards import Keyboards, MINUTE_STEP
+from matching import CITIES, TARIFFS
+from scheduling import TIMEZONE, local_now, resolve_trip_time, format_trip_time, set_timezone
+from edits import EditCoalescer, EDIT_DEBOUNCE
+from fares import FARES_FILE, format_price, load_fares
 
 # ... (rest of the code)
 
+# Orders per page of the "Мои заказы" history
+HISTORY_PAGE_SIZE = 5
+# Users whose last rendered history page is kept in memory
+HISTORY_CACHE_SIZE = 1000
+
+# Last rendered history page per user: user_id -> (page, orders version, text, keyboard)
+_history_pages = OrderedDict()
+
+def format_history_order(order):
+    """Formats one order row for the client's order history."""
+    order_id, _, from_city, to_city, tariff, trip_time, _, status, price = order
+    text = f"№{order_id}: {from_city} → {to_city}, {tariff}, {format_trip_time(trip_time, with_date=True)}"
+    if price is not None:
+        text += f", {format_price(price)}"
+    return f"{text}\nСтатус: {status}"
+
+def price_line(fares, data):
+    """The price line of an order confirmation, with a note on surge; empty for unpriced routes."""
+    if data.get('price') is None:
+        return ""
+    surge = " (повышенный спрос)" if fares.surge(data['trip_time']) > 1 else ""
+    return f"  - Стоимость: {format_price(data['price'])}{surge}\n"
+
+async def render_history_page(user_id, before_id=None, after_id=None):
+    """Builds the text and inline keyboard of one page of a user's orders.
+
+    The last page rendered for each user is reused until one of the user's
+    orders is created or changes status.
+    """
+    page = (before_id, after_id)
+    version = await get_user_orders_version(user_id)
+    cached = _history_pages.get(user_id)
+    if cached is not None and version is not None and cached[:2] == (page, version):
+        _history_pages.move_to_end(user_id)
+        return cached[2:]
+
+    # Fetch one extra row to find out whether there is a page in that direction
+    orders = await get_user_orders_page(user_id, before_id=before_id, after_id=after_id, limit=HISTORY_PAGE_SIZE + 1)
+    if after_id is not None:
+        has_newer = len(orders) > HISTORY_PAGE_SIZE
+        orders = orders[-HISTORY_PAGE_SIZE:]
+        has_older = True
+    else:
+        has_older = len(orders) > HISTORY_PAGE_SIZE
+        orders = orders[:HISTORY_PAGE_SIZE]
+        has_newer = before_id is not None
+
+    if not orders:
+        text, reply_markup = "У вас пока нет заказов.", None
+    else:
+        text = "Ваши заказы:\n\n" + "\n\n".join(format_history_order(order) for order in orders)
+        navigation = []
+        if has_newer:
+            navigation.append(InlineKeyboardButton("« Новее", callback_data=f"history_after_{orders[0][0]}"))
+        if has_older:
+            navigation.append(InlineKeyboardButton("Старше »", callback_data=f"history_before_{orders[-1][0]}"))
+        reply_markup = InlineKeyboardMarkup([navigation]) if navigation else None
+
+    if version is not None:
+        _history_pages[user_id] = (page, version, text, reply_markup)
+        _history_pages.move_to_end(user_id)
+        while len(_history_pages) > HISTORY_CACHE_SIZE:
+            _history_pages.popitem(last=False)
+    return text, reply_markup
+
 async def my_orders(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    """Displays the user's past orders (placeholder)."""
+    """Displays the first page of the user's orders, newest first."""
     query = update.callback_query
     await query.answer()
-    await query.edit_message_text(
-        text="Этот раздел находится в разработке.",
-    )
+    text, reply_markup = await render_history_page(query.from_user.id)
+    await query.edit_message_text(text=text, reply_markup=reply_markup)
+    return MAIN_MENU
+
+async def history_page(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Edits the order history message in place to show older or newer orders."""
+    query = update.callback_query
+    await query.answer()
+
+    _, direction, order_id = query.data.split("_")
+    if direction == "before":
+        text, reply_markup = await render_history_page(query.from_user.id, before_id=int(order_id))
+    else:
+        text, reply_markup = await render_history_page(query.from_user.id, after_id=int(order_id))
+
+    try:
+        await query.edit_message_text(text=text, reply_markup=reply_markup)
+    except BadRequest as e:
+        # Pressing a button of an unchanged page is not an error worth surfacing
+        if "not modified" not in str(e):
+            raise
     return MAIN_MENU
 
 async def rules(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -48,9 +144,8 @@ logger = logging.getLogger(__name__)
 MAIN_MENU, CITY_FROM, CITY_TO, TARIFF, PHONE_NUMBER, TRIP_TIME = range(6)
 AWAITING_SUPPORT_MESSAGE = range(6, 7)
 
-# Data
-CITIES = ["Октябрьский", "Туймазы", "Уфа"]
-TARIFFS = ["Стандарт", "Комфорт", "Бизнес"]
+# Every static keyboard of the order flow, built once
+KEYBOARDS = Keyboards(CITIES, TARIFFS)
 
 
 
@@ -59,24 +154,16 @@ TARIFFS = ["Стандарт", "Комфорт", "Бизнес"]
 
 async def ask_for_trip_time(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Asks for the trip time and moves to the next state."""
-    now = datetime.now()
-    # Round up to the next hour
+    # Round up to the next hour on the service clock, which resolve_trip_time reads the picked time in
+    now = local_now()
     next_hour = (now + timedelta(hours=1)).replace(minute=0, second=0, microsecond=0)
     
     context.user_data['hour'] = next_hour.hour
     context.user_data['minute'] = next_hour.minute
 
-    keyboard = [
-        [InlineKeyboardButton("+", callback_data="hour_up"), InlineKeyboardButton("+", callback_data="minute_up")],
-        [InlineKeyboardButton(f"{next_hour.hour:02d}:{next_hour.minute:02d}", callback_data="time_display")],
-        [InlineKeyboardButton("-", callback_data="hour_down"), InlineKeyboardButton("-", callback_data="minute_down")],
-        [InlineKeyboardButton("Подтвердить", callback_data="confirm_time")]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-
     await update.message.reply_text(
         "Выберите время поездки:",
-        reply_markup=reply_markup,
+        reply_markup=KEYBOARDS.time(next_hour.hour, next_hour.minute),
     )
     return TRIP_TIME
 
@@ -84,18 +171,10 @@ async def ask_for_trip_time(update: Update, context: ContextTypes.DEFAULT_TYPE)
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Displays the main menu."""
     logger.info(f"User {update.effective_user.id} started the bot.")
-    
-    keyboard = [
-        [InlineKeyboardButton("Заказать такси", callback_data="new_order")],
-        [InlineKeyboardButton("Мои заказы", callback_data="my_orders")],
-        [InlineKeyboardButton("Поддержка", callback_data="support")],
-        [InlineKeyboardButton("Правила", callback_data="rules")],
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
+
     await update.message.reply_text(
         "Здравствуйте! Я бот для заказа межгородского такси. Выберите действие:",
-        reply_markup=reply_markup,
+        reply_markup=KEYBOARDS.main_menu,
     )
     return MAIN_MENU
 
@@ -104,12 +183,9 @@ async def start_order_flow(update: Update, context: ContextTypes.DEFAULT_TYPE) -
     query = update.callback_query
     await query.answer()
 
-    keyboard = [[InlineKeyboardButton(city, callback_data=city)] for city in CITIES]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-
     await query.edit_message_text(
         "Из какого города вы хотите поехать?",
-        reply_markup=reply_markup,
+        reply_markup=KEYBOARDS.city_from,
     )
     return CITY_FROM
 
@@ -121,13 +197,9 @@ async def city_from(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     from_city = query.data
     context.user_data["from_city"] = from_city
 
-    remaining_cities = [city for city in CITIES if city != from_city]
-    keyboard = [[InlineKeyboardButton(city, callback_data=city)] for city in remaining_cities]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-
     await query.edit_message_text(
         text=f"Город отправления: {from_city}.\nТеперь выберите город назначения.",
-        reply_markup=reply_markup
+        reply_markup=KEYBOARDS.city_to.get(from_city, KEYBOARDS.city_from)
     )
     return CITY_TO
 
@@ -139,12 +211,9 @@ async def city_to(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     to_city = query.data
     context.user_data["to_city"] = to_city
 
-    keyboard = [[InlineKeyboardButton(t, callback_data=t)] for t in TARIFFS]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-
     await query.edit_message_text(
         text=f"Город назначения: {to_city}.\nТеперь выберите тариф.",
-        reply_markup=reply_markup
+        reply_markup=KEYBOARDS.tariffs_for(context.user_data.get("from_city"), to_city)
     )
     return TARIFF
 
@@ -158,13 +227,10 @@ async def tariff(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
 
     await query.edit_message_text(text=f"Тариф: {selected_tariff}. Отлично!")
 
-    contact_button = KeyboardButton("Поделиться номером телефона", request_contact=True)
-    reply_markup = ReplyKeyboardMarkup([[contact_button]], one_time_keyboard=True, resize_keyboard=True)
-    
     await context.bot.send_message(
         chat_id=query.from_user.id,
         text="Пожалуйста, поделитесь своим номером с помощью кнопки или просто напишите его в чат (для заказа другу).",
-        reply_markup=reply_markup,
+        reply_markup=KEYBOARDS.contact,
     )
     return PHONE_NUMBER
 
@@ -201,15 +267,20 @@ async def trip_time_text(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         )
         return TRIP_TIME
 
-    context.user_data["trip_time"] = user_time
+    hour, minute = map(int, user_time.split(":"))
+    context.user_data["trip_time"] = resolve_trip_time(hour, minute)
     data = context.user_data
-    
+    fares = context.bot_data["fares"]
+    data["price"] = fares.quote(data['from_city'], data['to_city'], data['tariff'], data['trip_time'])
+
+    await context.bot_data["edit_coalescer"].discard(update.effective_chat.id)
     await update.message.reply_text(
         f"Спасибо! Ваш заказ принят.\n"
         f"  - Откуда: {data['from_city']}\n"
         f"  - Куда: {data['to_city']}\n"
         f"  - Тариф: {data['tariff']}\n"
-        f"  - Время: {data['trip_time']}\n"
+        f"  - Время: {format_trip_time(data['trip_time'])}\n"
+        f"{price_line(fares, data)}"
         f"  - Телефон: {data['phone_number']}\n\n"
         "В ближайшее время с вами свяжется водитель.",
         reply_markup=ReplyKeyboardRemove(),
@@ -217,13 +288,14 @@ async def trip_time_text(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 
     # Save order to the database
     user_id = update.effective_user.id
-    insert_order(
+    await insert_order(
         user_id=user_id,
         from_city=data['from_city'],
         to_city=data['to_city'],
         tariff=data['tariff'],
         trip_time=data['trip_time'],
-        phone_number=data['phone_number']
+        phone_number=data['phone_number'],
+        price=data.get('price'),
     )
 
     context.user_data.clear()
@@ -248,24 +320,18 @@ async def adjust_time(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int
     elif action == "hour_down":
         hour = (hour - 1) % 24
     elif action == "minute_up":
-        minute = (minute + 15) % 60
+        minute = (minute + MINUTE_STEP) % 60
     elif action == "minute_down":
-        minute = (minute - 15) % 60
+        minute = (minute - MINUTE_STEP) % 60
     
     context.user_data['hour'] = hour
     context.user_data['minute'] = minute
 
-    keyboard = [
-        [InlineKeyboardButton("+", callback_data="hour_up"), InlineKeyboardButton("+", callback_data="minute_up")],
-        [InlineKeyboardButton(f"{hour:02d}:{minute:02d}", callback_data="time_display")],
-        [InlineKeyboardButton("-", callback_data="hour_down"), InlineKeyboardButton("-", callback_data="minute_down")],
-        [InlineKeyboardButton("Подтвердить", callback_data="confirm_time")]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-
-    await query.edit_message_text(
-        text="Выберите время поездки:",
-        reply_markup=reply_markup
+    # Quick taps only update the state; the last render is sent after a short pause
+    context.bot_data["edit_coalescer"].edit(
+        query.message.chat_id,
+        query.message.message_id,
+        lambda: query.edit_message_text(text="Выберите время поездки:", reply_markup=KEYBOARDS.time(hour, minute)),
     )
 
     return TRIP_TIME
@@ -277,30 +343,35 @@ async def trip_time(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
 
     hour = context.user_data.get('hour', 0)
     minute = context.user_data.get('minute', 0)
-    user_time = f"{hour:02d}:{minute:02d}"
 
-    context.user_data["trip_time"] = user_time
+    context.user_data["trip_time"] = resolve_trip_time(hour, minute)
     data = context.user_data
-    
+    fares = context.bot_data["fares"]
+    data["price"] = fares.quote(data['from_city'], data['to_city'], data['tariff'], data['trip_time'])
+
+    # A late time-picker edit must not overwrite the confirmation
+    await context.bot_data["edit_coalescer"].discard(query.message.chat_id, query.message.message_id)
     await query.edit_message_text(
         f"Спасибо! Ваш заказ принят.\n"
         f"  - Откуда: {data['from_city']}\n"
         f"  - Куда: {data['to_city']}\n"
         f"  - Тариф: {data['tariff']}\n"
-        f"  - Время: {data['trip_time']}\n"
+        f"  - Время: {format_trip_time(data['trip_time'])}\n"
+        f"{price_line(fares, data)}"
         f"  - Телефон: {data['phone_number']}\n\n"
         "В ближайшее время с вами свяжется водитель.",
     )
 
     # Save order to the database
     user_id = query.from_user.id
-    insert_order(
+    await insert_order(
         user_id=user_id,
         from_city=data['from_city'],
         to_city=data['to_city'],
         tariff=data['tariff'],
         trip_time=data['trip_time'],
-        phone_number=data['phone_number']
+        phone_number=data['phone_number'],
+        price=data.get('price'),
     )
 
     context.user_data.clear()
@@ -308,6 +379,7 @@ async def trip_time(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
 
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Cancels a conversation."""
+    await context.bot_data["edit_coalescer"].discard(update.effective_chat.id)
     if update.callback_query:
         await update.callback_query.answer()
         await update.callback_query.edit_message_text("Действие отменено.")
@@ -367,27 +439,47 @@ async def post_init(application: Application) -> None:
         BotCommand("cancel", "Отменить текущее действие"),
     ])
 
-def main() -> None:
-    """Run the bot."""
-    initialize_database()
-    try:
-        with open('config.json', 'r', encoding='utf-8') as f:
-            config = json.load(f)
-        token = config.get('CLIENT_TELEGRAM_TOKEN')
-        support_chat_id = config.get('SUPPORT_CHAT_ID')
-    except FileNotFoundError:
-        logger.error("config.json not found.")
-        return
-    except json.JSONDecodeError:
-        logger.error("Error decoding config.json.")
-        return
+async def post_stop(application: Application) -> None:
+    """Sends time-picker edits that are still waiting out their debounce."""
+    await application.bot_data["edit_coalescer"].flush()
+
+async def post_shutdown(application: Application) -> None:
+    """Stops the database executor."""
+    shutdown_executor()
+
+def build_application(config: dict, request: BaseRequest | None = None) -> Application | None:
+    """Builds the client bot application from the parsed config.json."""
+    token = config.get('CLIENT_TELEGRAM_TOKEN')
+    support_chat_id = config.get('SUPPORT_CHAT_ID')
 
     if not token or token == "YOUR_CLIENT_TOKEN_HERE":
         logger.error("CLIENT_TELEGRAM_TOKEN not found or is a placeholder in config.json.")
-        return
-
-    application = Application.builder().token(token).post_init(post_init).build()
+        return None
+
+    set_timezone(config.get('TIMEZONE', TIMEZONE))
+    persistence = SQLitePersistence("client", flush_interval=config.get('PERSISTENCE_FLUSH_INTERVAL', FLUSH_INTERVAL))
+    update_processor = KeyedUpdateProcessor(config.get('CONCURRENT_UPDATES', CONCURRENT_UPDATES))
+    builder = Application.builder().token(token)
+    if config.get('BOT_API_URL'):
+        # Self-hosted or fake Bot API server instead of api.telegram.org
+        builder = builder.base_url(f"{config['BOT_API_URL']}/bot")
+    # Shared connection pool when several bots run in one process; every
+    # Bot API call is timed either way
+    builder = builder.request(InstrumentedRequest(request or HTTPXRequest(connection_pool_size=256), "client"))
+    application = (
+        builder
+        .persistence(persistence)
+        .concurrent_updates(update_processor)
+        .post_init(post_init)
+        .post_stop(post_stop)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
     application.bot_data["SUPPORT_CHAT_ID"] = support_chat_id
+    application.bot_data["edit_coalescer"] = EditCoalescer(config.get('EDIT_DEBOUNCE', EDIT_DEBOUNCE))
+    application.bot_data["fares"] = load_fares(CITIES, TARIFFS, config.get('FARES_FILE', FARES_FILE))
+    # Tariff buttons show the route's prices
+    KEYBOARDS.set_fares(application.bot_data["fares"])
 
     # Combined conversation handler
     conv_handler = ConversationHandler(
@@ -396,6 +488,7 @@ def main() -> None:
             MAIN_MENU: [
                 CallbackQueryHandler(start_order_flow, pattern="^new_order$"),
                 CallbackQueryHandler(my_orders, pattern="^my_orders$"),
+                CallbackQueryHandler(history_page, pattern=r"^history_(before|after)_\d+$"),
                 CallbackQueryHandler(support_start, pattern="^support$"),
                 CallbackQueryHandler(rules, pattern="^rules$"),
             ],
@@ -414,11 +507,37 @@ def main() -> None:
             AWAITING_SUPPORT_MESSAGE: [MessageHandler(filters.TEXT & ~filters.COMMAND, support_message)],
         },
         fallbacks=[CommandHandler("cancel", cancel)],
-        per_message=False
+        per_message=False,
+        name="order_conversation",
+        persistent=True,
     )
 
     application.add_handler(conv_handler)
 
+    instrument_handlers(application, "client")
+    REGISTRY.expose("updates", "Update processing counters", update_processor.metrics, bot="client")
+    REGISTRY.expose("persistence", "Write-behind persistence counters", persistence.metrics, bot="client")
+    REGISTRY.expose("edits", "Time-picker edit counters", application.bot_data["edit_coalescer"].metrics, bot="client")
+    REGISTRY.expose("fares", "Fare quote counters", application.bot_data["fares"].metrics, bot="client")
+    return application
+
+def main() -> None:
+    """Run the bot."""
+    try:
+        with open('config.json', 'r', encoding='utf-8') as f:
+            config = json.load(f)
+    except FileNotFoundError:
+        logger.error("config.json not found.")
+        return
+    except json.JSONDecodeError:
+        logger.error("Error decoding config.json.")
+        return
+
+    application = build_application(config)
+    if application is None:
+        return
+
+    initialize_database(config.get('STORAGE', {}))
     application.run_polling()
 
 if __name__ == "__main__":
@@ -1,202 +1,1219 @@
-
 import sqlite3
+import itertools
 import logging
+import math
+import queue
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import timedelta
+
+import scheduling
+from metrics import REGISTRY, timed
 
 logger = logging.getLogger(__name__)
 
+# Run time histogram of every query function below, labelled by function name
+_timed = timed("db_call_seconds", "Time spent in database.py functions")
+
 DB_FILE = "orders.db"
 
-def initialize_database():
-    try:
-        conn = sqlite3.connect(DB_FILE, check_same_thread=False)
-        cursor = conn.cursor()
-        
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS orders (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                from_city TEXT NOT NULL,
-                to_city TEXT NOT NULL,
-                tariff TEXT NOT NULL,
-                trip_time TEXT NOT NULL,
-                phone_number TEXT NOT NULL,
-                status TEXT NOT NULL DEFAULT 'Ожидает'
-            )
+# Connection pool defaults
+POOL_SIZE = 4
+CACHED_STATEMENTS = 128
+HEALTH_CHECK_INTERVAL = 30.0
+
+# Driver cache defaults
+DRIVER_CACHE_SIZE = 1024
+DRIVER_CACHE_TTL = 300.0
+# Seconds between checks for driver changes made by the other bot process
+DRIVER_CACHE_CHECK_INTERVAL = 1.0
+
+# Storage defaults, overridable through the "STORAGE" section of config.json.
+# WAL lets the client and driver processes read while the other one writes.
+DEFAULT_STORAGE_SETTINGS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "busy_timeout": 5000,
+    "mmap_size": 64 * 1024 * 1024,
+    "cache_size": -8000,
+    "pool_size": POOL_SIZE,
+    "cached_statements": CACHED_STATEMENTS,
+}
+JOURNAL_MODES = {"DELETE", "TRUNCATE", "PERSIST", "MEMORY", "WAL", "OFF"}
+SYNCHRONOUS_MODES = {"OFF", "NORMAL", "FULL", "EXTRA"}
+
+# Explicit column list so order rows keep their shape as the table grows
+ORDER_COLUMNS = "id, user_id, from_city, to_city, tariff, trip_time, phone_number, status, price"
+
+# Bulk import/export: the fields of an imported order (status, driver_id,
+# created_at and price are optional) and the columns written by an export
+IMPORT_FIELDS = ("user_id", "from_city", "to_city", "tariff", "trip_time", "phone_number",
+                 "status", "driver_id", "created_at", "price")
+EXPORT_COLUMNS = ("id",) + IMPORT_FIELDS
+IMPORT_CHUNK_SIZE = 1000
+EXPORT_BATCH_SIZE = 1000
+# Most orders one expiry sweep changes, to keep its write transaction short
+EXPIRE_BATCH_SIZE = 500
+
+
+class ConnectionPool:
+    """A small thread-safe pool of long-lived SQLite connections.
+
+    Connections are opened lazily up to ``size`` and handed out in LIFO order,
+    so a quiet process keeps reusing one warm connection together with its
+    prepared statement cache. A connection that has been idle for longer than
+    ``health_check_interval`` seconds is pinged before it is handed out and
+    replaced if the ping fails.
+    """
+
+    def __init__(self, db_file, size=POOL_SIZE, cached_statements=CACHED_STATEMENTS,
+                 health_check_interval=HEALTH_CHECK_INTERVAL, pragmas=()):
+        if size < 1:
+            raise ValueError("Pool size must be at least 1.")
+        self.db_file = db_file
+        self.size = size
+        self.cached_statements = cached_statements
+        self.health_check_interval = health_check_interval
+        self.pragmas = list(pragmas)
+        self._idle = queue.LifoQueue()
+        self._last_used = {}
+        self._created = 0
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        conn = sqlite3.connect(
+            self.db_file,
+            check_same_thread=False,
+            cached_statements=self.cached_statements,
+        )
+        for name, value in self.pragmas:
+            conn.execute(f"PRAGMA {name} = {value}")
+        self._last_used[id(conn)] = time.monotonic()
+        return conn
+
+    def _discard(self, conn):
+        self._last_used.pop(id(conn), None)
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+
+    def _is_healthy(self, conn):
+        idle_for = time.monotonic() - self._last_used.get(id(conn), 0.0)
+        if idle_for < self.health_check_interval:
+            return True
+        try:
+            conn.execute("SELECT 1").fetchone()
+            return True
+        except sqlite3.Error as e:
+            logger.warning(f"Dropping unhealthy database connection: {e}")
+            return False
+
+    def acquire(self, timeout=None):
+        """Checks a connection out of the pool, opening a new one if allowed."""
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                can_create = self._created < self.size
+                if can_create:
+                    self._created += 1
+            if can_create:
+                try:
+                    return self._connect()
+                except sqlite3.Error:
+                    with self._lock:
+                        self._created -= 1
+                    raise
+            try:
+                conn = self._idle.get(timeout=timeout)
+            except queue.Empty:
+                raise sqlite3.OperationalError("Timed out waiting for a database connection.")
+
+        if not self._is_healthy(conn):
+            self._discard(conn)
+            try:
+                conn = self._connect()
+            except sqlite3.Error:
+                # The discarded connection's slot is free again
+                with self._lock:
+                    self._created -= 1
+                raise
+        return conn
+
+    def release(self, conn):
+        """Returns a connection to the pool, rolling back any open transaction."""
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error as e:
+            logger.warning(f"Failed to reset pooled connection, discarding it: {e}")
+            self._discard(conn)
+            with self._lock:
+                self._created -= 1
+            return
+        self._last_used[id(conn)] = time.monotonic()
+        self._idle.put(conn)
+
+    @contextmanager
+    def connection(self, timeout=None):
+        """Context manager that checks a connection out and always returns it."""
+        conn = self.acquire(timeout=timeout)
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def close(self):
+        """Closes all idle connections. Checked-out connections are left alone."""
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self._discard(conn)
+            with self._lock:
+                self._created -= 1
+
+
+class DriverCache:
+    """Bounded LRU cache of driver rows by Telegram ID and by phone number.
+
+    Entries expire after ``ttl`` seconds. Writes in this process clear the
+    cache explicitly; writes from the other bot process are noticed by
+    reading the trigger-maintained drivers version in ``table_versions``,
+    at most once per ``check_interval`` seconds and outside the lock, so a
+    hit is a dictionary lookup and another process's change shows up here
+    within ``check_interval``.
+    """
+
+    def __init__(self, size=DRIVER_CACHE_SIZE, ttl=DRIVER_CACHE_TTL, check_interval=DRIVER_CACHE_CHECK_INTERVAL):
+        self.size = size
+        self.ttl = ttl
+        self.check_interval = check_interval
+        self.metrics = {"hits": 0, "misses": 0, "invalidations": 0, "version_checks": 0}
+        self.generation = 0
+        self._entries = OrderedDict()
+        self._drivers_version = None
+        self._next_check = 0.0
+        self._lock = threading.RLock()
+
+    def _check_version(self, conn):
+        """Clears the cache if the drivers table changed since the last check."""
+        now = time.monotonic()
+        if now < self._next_check:
+            return
+        self._next_check = now + self.check_interval
+        drivers_version = conn.execute("SELECT version FROM table_versions WHERE name = 'drivers'").fetchone()[0]
+        with self._lock:
+            self.metrics["version_checks"] += 1
+            if self._drivers_version is not None and drivers_version != self._drivers_version:
+                self.invalidate()
+            self._drivers_version = drivers_version
+
+    def get(self, conn, kind, key):
+        """Returns the cached row for ``kind`` ("telegram_id" or "phone") and ``key``, or None."""
+        self._check_version(conn)
+        with self._lock:
+            entry = self._entries.get((kind, key))
+            if entry is None or time.monotonic() - entry[1] > self.ttl:
+                self.metrics["misses"] += 1
+                return None
+            self._entries.move_to_end((kind, key))
+            self.metrics["hits"] += 1
+            return entry[0]
+
+    def put(self, driver, generation):
+        """Caches a driver row read while the cache was at ``generation``."""
+        with self._lock:
+            # Skip rows read before an invalidation; they may be stale already
+            if driver is None or generation != self.generation:
+                return
+            now = time.monotonic()
+            for key in (("telegram_id", driver[0]), ("phone", driver[1])):
+                self._entries[key] = (driver, now)
+                self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self):
+        """Drops every cached driver."""
+        with self._lock:
+            self._entries.clear()
+            self.generation += 1
+            # Take the drivers version afresh on the next lookup
+            self._drivers_version = None
+            self._next_check = 0.0
+            self.metrics["invalidations"] += 1
+
+
+_pool = None
+_pool_lock = threading.Lock()
+_storage_settings = dict(DEFAULT_STORAGE_SETTINGS)
+_driver_cache = DriverCache()
+REGISTRY.expose("driver_cache", "Driver cache counters", _driver_cache.metrics)
+
+
+def _validate_storage_settings(settings):
+    """Merges ``settings`` over the defaults and checks every value.
+
+    PRAGMA statements cannot take bound parameters, so values are checked
+    against known modes or converted to int before they reach SQL.
+    """
+    unknown = set(settings) - set(DEFAULT_STORAGE_SETTINGS)
+    if unknown:
+        raise ValueError(f"Unknown STORAGE settings: {', '.join(sorted(unknown))}")
+
+    merged = {**DEFAULT_STORAGE_SETTINGS, **settings}
+    merged["journal_mode"] = str(merged["journal_mode"]).upper()
+    merged["synchronous"] = str(merged["synchronous"]).upper()
+    if merged["journal_mode"] not in JOURNAL_MODES:
+        raise ValueError(f"Unsupported journal_mode: {merged['journal_mode']}")
+    if merged["synchronous"] not in SYNCHRONOUS_MODES:
+        raise ValueError(f"Unsupported synchronous mode: {merged['synchronous']}")
+    for key in ("busy_timeout", "mmap_size", "cache_size", "pool_size", "cached_statements"):
+        merged[key] = int(merged[key])
+    return merged
+
+
+def _connection_pragmas():
+    """Per-connection PRAGMAs applied to every pooled connection."""
+    return [
+        ("synchronous", _storage_settings["synchronous"]),
+        ("busy_timeout", _storage_settings["busy_timeout"]),
+        ("mmap_size", _storage_settings["mmap_size"]),
+        ("cache_size", _storage_settings["cache_size"]),
+    ]
+
+
+def _create_pool(db_file=None, size=None, cached_statements=None,
+                 health_check_interval=HEALTH_CHECK_INTERVAL):
+    global _pool
+    if _pool is not None:
+        _pool.close()
+    _driver_cache.invalidate()
+    _pool = ConnectionPool(
+        db_file or DB_FILE,
+        size=size or _storage_settings["pool_size"],
+        cached_statements=cached_statements or _storage_settings["cached_statements"],
+        health_check_interval=health_check_interval,
+        pragmas=_connection_pragmas(),
+    )
+    return _pool
+
+
+def configure_pool(db_file=None, size=None, cached_statements=None,
+                   health_check_interval=HEALTH_CHECK_INTERVAL):
+    """(Re)creates the process-wide connection pool."""
+    with _pool_lock:
+        return _create_pool(db_file, size, cached_statements, health_check_interval)
+
+
+def configure_storage(settings=None):
+    """Applies the "STORAGE" section of config.json and rebuilds the pool."""
+    global _storage_settings
+    _storage_settings = _validate_storage_settings(settings or {})
+    return configure_pool()
+
+
+def get_pool():
+    """Returns the process-wide connection pool, creating it on first use."""
+    if _pool is None or _pool.db_file != DB_FILE:
+        with _pool_lock:
+            if _pool is None or _pool.db_file != DB_FILE:
+                _create_pool()
+    return _pool
+
+
+def get_connection():
+    """Checks out a pooled connection: ``with get_connection() as conn: ...``."""
+    return get_pool().connection()
+
+
+def close_pool():
+    """Closes the idle connections of the process-wide pool."""
+    if _pool is not None:
+        _pool.close()
+
+def get_driver_cache():
+    """Returns the process-wide driver cache, e.g. to read its counters."""
+    return _driver_cache
+
+def _add_column(cursor, table, column, definition):
+    """Adds a column unless it is already there (databases created before migrations)."""
+    cursor.execute(f"PRAGMA table_info({table})")
+    if column not in {row[1] for row in cursor.fetchall()}:
+        cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+def _migration_order_driver_id(cursor):
+    _add_column(cursor, "orders", "driver_id", "INTEGER")
+
+def _migration_waiting_orders_index(cursor):
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_orders_waiting
+        ON orders (id) WHERE status = 'Ожидает'
+    """)
+
+def _migration_user_orders_index(cursor):
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_orders_user_id ON orders (user_id, id DESC)")
+
+def _migration_order_created_at(cursor):
+    _add_column(cursor, "orders", "created_at", "TEXT")
+
+def _migration_order_dispatch(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS order_dispatch (
+            order_id INTEGER PRIMARY KEY REFERENCES orders (id),
+            created_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            dispatched_at TEXT
+        )
+    """)
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_order_dispatch_pending
+        ON order_dispatch (order_id) WHERE dispatched_at IS NULL
+    """)
+
+def _migration_outbox(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id INTEGER NOT NULL,
+            text TEXT NOT NULL,
+            created_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            next_attempt_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            last_error TEXT,
+            sent_at TEXT,
+            failed_at TEXT
+        )
+    """)
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_outbox_pending
+        ON outbox (next_attempt_at) WHERE sent_at IS NULL AND failed_at IS NULL
+    """)
+
+def _migration_persistence(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS persistence (
+            kind TEXT NOT NULL,
+            key TEXT NOT NULL,
+            value TEXT NOT NULL,
+            PRIMARY KEY (kind, key)
+        ) WITHOUT ROWID
+    """)
+
+def _migration_table_versions(cursor):
+    # Bumped by triggers on every change, so other processes can tell that
+    # their cached drivers are stale
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS table_versions (
+            name TEXT PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+    cursor.execute("INSERT OR IGNORE INTO table_versions (name) VALUES ('drivers')")
+    for event in ("INSERT", "UPDATE", "DELETE"):
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS drivers_version_{event.lower()} AFTER {event} ON drivers
+            BEGIN
+                UPDATE table_versions SET version = version + 1 WHERE name = 'drivers';
+            END
         """)
 
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS drivers (
-                telegram_id INTEGER PRIMARY KEY,
-                phone_number TEXT UNIQUE NOT NULL,
-                full_name TEXT NOT NULL,
-                car_number TEXT NOT NULL
-            )
+def _migration_user_orders_version(cursor):
+    # One version row per client, bumped whenever one of their orders is
+    # created or changes status, so a rendered order history can be reused
+    for event, columns in (("INSERT", ""), ("UPDATE", " OF status")):
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS orders_user_version_{event.lower()} AFTER {event}{columns} ON orders
+            BEGIN
+                INSERT INTO table_versions (name, version) VALUES ('orders:' || NEW.user_id, 1)
+                ON CONFLICT (name) DO UPDATE SET version = version + 1;
+            END
         """)
-        
+
+def _migration_driver_routes(cursor):
+    # Routes and tariffs each driver serves; no rows means every route
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS driver_routes (
+            telegram_id INTEGER NOT NULL,
+            from_city TEXT NOT NULL,
+            to_city TEXT NOT NULL,
+            tariff TEXT NOT NULL,
+            PRIMARY KEY (telegram_id, from_city, to_city, tariff)
+        ) WITHOUT ROWID
+    """)
+
+def _migration_driver_sessions(cursor):
+    # One row per driver with their last shift; times are Unix timestamps
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS driver_sessions (
+            telegram_id INTEGER PRIMARY KEY,
+            city TEXT,
+            started_at REAL,
+            last_seen_at REAL,
+            online INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+
+def _migration_trip_timestamps(cursor):
+    # Trip times used to be a bare "HH:MM"; date them by when the order was
+    # placed. Orders without created_at predate migration 4, so their trip is
+    # long gone: date them yesterday rather than moving them into the future.
+    cursor.execute("SELECT id, trip_time, created_at FROM orders WHERE length(trip_time) = 5")
+    yesterday = scheduling.local_now() - timedelta(days=1)
+    updates = []
+    for order_id, trip_time, created_at in cursor.fetchall():
+        try:
+            hour, minute = map(int, trip_time.split(":"))
+            if created_at:
+                trip = scheduling.resolve_trip_time(hour, minute, scheduling.from_utc(created_at))
+            else:
+                trip = yesterday.replace(hour=hour, minute=minute).strftime(scheduling.TRIP_TIME_FORMAT)
+            updates.append((trip, order_id))
+        except ValueError:
+            logger.warning(f"Leaving unparseable trip time {trip_time!r} of order {order_id} as it is")
+    cursor.executemany("UPDATE orders SET trip_time = ? WHERE id = ?", updates)
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_orders_waiting_trip_time
+        ON orders (trip_time) WHERE status = 'Ожидает'
+    """)
+
+def _migration_order_price(cursor):
+    # Quoted fare in rubles; NULL for orders placed before fares existed
+    _add_column(cursor, "orders", "price", "INTEGER")
+
+# Schema migrations as (version, description, function). They are applied in
+# order on top of the base tables; append new ones, never edit shipped ones.
+MIGRATIONS = [
+    (1, "add orders.driver_id", _migration_order_driver_id),
+    (2, "partial index on waiting orders", _migration_waiting_orders_index),
+    (3, "index on orders (user_id, id DESC)", _migration_user_orders_index),
+    (4, "add orders.created_at", _migration_order_created_at),
+    (5, "order_dispatch outbox", _migration_order_dispatch),
+    (6, "client notification outbox", _migration_outbox),
+    (7, "bot persistence store", _migration_persistence),
+    (8, "drivers version for cache invalidation", _migration_table_versions),
+    (9, "per-client order history version", _migration_user_orders_version),
+    (10, "driver routes and tariffs", _migration_driver_routes),
+    (11, "driver shifts", _migration_driver_sessions),
+    (12, "dated trip times and index on waiting trip times", _migration_trip_timestamps),
+    (13, "add orders.price", _migration_order_price),
+]
+
+def get_schema_version(conn):
+    """Returns the highest applied migration version (0 for a fresh database)."""
+    cursor = conn.cursor()
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            description TEXT NOT NULL,
+            applied_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    cursor.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version")
+    return cursor.fetchone()[0]
+
+def run_migrations(conn):
+    """Applies all pending migrations in a single write transaction.
+
+    BEGIN IMMEDIATE takes the write lock before the current version is read,
+    so the client and driver processes starting together cannot both apply
+    the same migration.
+    """
+    cursor = conn.cursor()
+    cursor.execute("BEGIN IMMEDIATE")
+    try:
+        current_version = get_schema_version(conn)
+        for version, description, migrate in MIGRATIONS:
+            if version <= current_version:
+                continue
+            migrate(cursor)
+            cursor.execute(
+                "INSERT INTO schema_version (version, description) VALUES (?, ?)",
+                (version, description),
+            )
+            logger.info(f"Applied migration {version}: {description}")
         conn.commit()
-        logger.info("Database initialized successfully.")
+    except sqlite3.Error:
+        conn.rollback()
+        raise
+
+@_timed
+def initialize_database(storage_settings=None):
+    """Applies storage settings, creates the tables and runs pending migrations."""
+    try:
+        if storage_settings is not None:
+            configure_storage(storage_settings)
+
+        with get_connection() as conn:
+            cursor = conn.cursor()
+
+            cursor.execute(f"PRAGMA journal_mode = {_storage_settings['journal_mode']}")
+            journal_mode = cursor.fetchone()[0]
+
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS orders (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_id INTEGER NOT NULL,
+                    from_city TEXT NOT NULL,
+                    to_city TEXT NOT NULL,
+                    tariff TEXT NOT NULL,
+                    trip_time TEXT NOT NULL,
+                    phone_number TEXT NOT NULL,
+                    status TEXT NOT NULL DEFAULT 'Ожидает'
+                )
+            """)
+
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS drivers (
+                    telegram_id INTEGER PRIMARY KEY,
+                    phone_number TEXT UNIQUE NOT NULL,
+                    full_name TEXT NOT NULL,
+                    car_number TEXT NOT NULL
+                )
+            """)
+
+            conn.commit()
+
+            run_migrations(conn)
+        logger.info(f"Database initialized successfully (journal_mode={journal_mode}).")
 
     except sqlite3.Error as e:
         logger.error(f"Database error: {e}")
-    finally:
-        if conn:
-            conn.close()
 
-def insert_order(user_id, from_city, to_city, tariff, trip_time, phone_number):
-    """Inserts a new order into the database."""
-    try:
-        conn = sqlite3.connect(DB_FILE, check_same_thread=False)
-        cursor = conn.cursor()
-        
-        cursor.execute("""
-            INSERT INTO orders (user_id, from_city, to_city, tariff, trip_time, phone_number)
-            VALUES (?, ?, ?, ?, ?, ?)
-        """, (user_id, from_city, to_city, tariff, trip_time, phone_number))
-        
-        conn.commit()
-        logger.info(f"New order inserted for user {user_id}")
+@_timed
+def insert_order(user_id, from_city, to_city, tariff, trip_time, phone_number, price=None):
+    """Inserts a new order and queues it for dispatch. Returns the order ID."""
+    try:
+        with get_connection() as conn:
+            cursor = conn.cursor()
+
+            cursor.execute("""
+                INSERT INTO orders (user_id, from_city, to_city, tariff, trip_time, phone_number, price, created_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+            """, (user_id, from_city, to_city, tariff, trip_time, phone_number, price))
+            order_id = cursor.lastrowid
+            cursor.execute("INSERT INTO order_dispatch (order_id) VALUES (?)", (order_id,))
+
+            conn.commit()
+        logger.info(f"New order {order_id} inserted for user {user_id}")
+        return order_id
 
     except sqlite3.Error as e:
         logger.error(f"Failed to insert order: {e}")
-    finally:
-        if conn:
-            conn.close()
+        return None
+
+@_timed
+def get_waiting_orders(due_before=None):
+    """Retrieves the orders with the status 'Ожидает'.
 
-def get_waiting_orders():
-    """Retrieves all orders with the status 'Ожидает'."""
+    With ``due_before`` (a stored trip time) only orders whose trip is no
+    later than that are returned; bookings further ahead are left out.
+    """
     try:
-        conn = sqlite3.connect(DB_FILE, check_same_thread=False)
-        cursor = conn.cursor()
-        
-        cursor.execute("SELECT * FROM orders WHERE status = 'Ожидает'")
-        orders = cursor.fetchall()
-        return orders
+        with get_connection() as conn:
+            cursor = conn.cursor()
+
+            if due_before is not None:
+                cursor.execute(
+                    f"SELECT {ORDER_COLUMNS} FROM orders WHERE status = 'Ожидает' AND trip_time <= ?",
+                    (due_before,),
+                )
+            else:
+                cursor.execute(f"SELECT {ORDER_COLUMNS} FROM orders WHERE status = 'Ожидает'")
+            orders = cursor.fetchall()
+            return orders
 
     except sqlite3.Error as e:
         logger.error(f"Failed to get waiting orders: {e}")
         return []
-    finally:
-        if conn:
-            conn.close()
 
+@_timed
+def get_scheduled_orders(due_after):
+    """Retrieves the waiting orders with a trip time later than ``due_after``, soonest first."""
+    try:
+        with get_connection() as conn:
+            cursor = conn.cursor()
+
+            cursor.execute(f"""
+                SELECT {ORDER_COLUMNS} FROM orders
+                WHERE status = 'Ожидает' AND trip_time > ?
+                ORDER BY trip_time
+            """, (due_after,))
+            return cursor.fetchall()
+
+    except sqlite3.Error as e:
+        logger.error(f"Failed to get scheduled orders: {e}")
+        return []
+
+@_timed
 def get_order_by_id(order_id):
     """Retrievess a single order by its ID."""
     try:
-        conn = sqlite3.connect(DB_FILE, check_same_thread=False)
-        cursor = conn.cursor()
+        with get_connection() as conn:
+            cursor = conn.cursor()
 
-        cursor.execute("SELECT * FROM orders WHERE id = ?", (order_id,))
-        order = cursor.fetchone()
-        return order
+            cursor.execute(f"SELECT {ORDER_COLUMNS} FROM orders WHERE id = ?", (order_id,))
+            order = cursor.fetchone()
+            return order
 
     except sqlite3.Error as e:
         logger.error(f"Failed to get order by ID: {e}")
         return None
-    finally:
-        if conn:
-            conn.close()
 
+@_timed
 def get_user_orders(user_id):
     """Retrieves all orders for a specific user."""
     try:
-        conn = sqlite3.connect(DB_FILE, check_same_thread=False)
-        cursor = conn.cursor()
-        
-        cursor.execute("SELECT * FROM orders WHERE user_id = ? ORDER BY id DESC", (user_id,))
-        orders = cursor.fetchall()
-        return orders
+        with get_connection() as conn:
+            cursor = conn.cursor()
+
+            cursor.execute(f"SELECT {ORDER_COLUMNS} FROM orders WHERE user_id = ? ORDER BY id DESC", (user_id,))
+            orders = cursor.fetchall()
+            return orders
 
     except sqlite3.Error as e:
         logger.error(f"Failed to get user orders: {e}")
         return []
-    finally:
-        if conn:
-            conn.close()
 
+@_timed
+def get_user_orders_page(user_id, before_id=None, after_id=None, limit=10):
+    """Retrieves one page of a user's orders, newest first, using keyset pagination.
+
+    Pass ``before_id`` for older orders or ``after_id`` for newer ones; both
+    walk the (user_id, id DESC) index, so long histories cost no more than
+    short ones.
+    """
+    try:
+        with get_connection() as conn:
+            cursor = conn.cursor()
+
+            if after_id is not None:
+                cursor.execute(f"""
+                    SELECT {ORDER_COLUMNS} FROM orders
+                    WHERE user_id = ? AND id > ?
+                    ORDER BY id LIMIT ?
+                """, (user_id, after_id, limit))
+                orders = cursor.fetchall()
+                orders.reverse()
+            elif before_id is not None:
+                cursor.execute(f"""
+                    SELECT {ORDER_COLUMNS} FROM orders
+                    WHERE user_id = ? AND id < ?
+                    ORDER BY id DESC LIMIT ?
+                """, (user_id, before_id, limit))
+                orders = cursor.fetchall()
+            else:
+                cursor.execute(f"""
+                    SELECT {ORDER_COLUMNS} FROM orders
+                    WHERE user_id = ?
+                    ORDER BY id DESC LIMIT ?
+                """, (user_id, limit))
+                orders = cursor.fetchall()
+            return orders
+
+    except sqlite3.Error as e:
+        logger.error(f"Failed to get user orders page: {e}")
+        return []
+
+@_timed
+def get_user_orders_version(user_id):
+    """Returns a number that changes whenever one of the user's orders changes."""
+    try:
+        with get_connection() as conn:
+            cursor = conn.cursor()
+
+            cursor.execute("SELECT version FROM table_versions WHERE name = ?", (f"orders:{user_id}",))
+            row = cursor.fetchone()
+            return row[0] if row else 0
+
+    except sqlite3.Error as e:
+        logger.error(f"Failed to get user orders version: {e}")
+        return None
+
+@_timed
 def update_order_status(order_id, new_status):
     """Updates the status of a specific order."""
     try:
-        conn = sqlite3.connect(DB_FILE, check_same_thread=False)
-        cursor = conn.cursor()
-        
-        cursor.execute("UPDATE orders SET status = ? WHERE id = ?", (new_status, order_id))
-        
-        conn.commit()
+        with get_connection() as conn:
+            cursor = conn.cursor()
+
+            cursor.execute("UPDATE orders SET status = ? WHERE id = ?", (new_status, order_id))
+
+            conn.commit()
         logger.info(f"Order {order_id} status updated to {new_status}")
 
     except sqlite3.Error as e:
         logger.error(f"Failed to update order status: {e}")
-    finally:
-        if conn:
-            conn.close()
 
+@_timed
+def accept_order(order_id, driver_id, notification=None):
+    """Assigns a waiting order to a registered driver in a single statement.
+
+    The update only matches while the order is still 'Ожидает', so when several
+    drivers race for the same order exactly one of them wins. Returns the order
+    row followed by the driver's full_name and car_number, or None if the order
+    was already taken, does not exist or the driver is not registered.
+
+    If ``notification`` is given, ``notification(row)`` is queued in the
+    outbox for the order's client in the same transaction.
+    """
+    try:
+        with get_connection() as conn:
+            cursor = conn.cursor()
+
+            cursor.execute(f"""
+                UPDATE orders SET status = 'Принят', driver_id = ?
+                WHERE id = ? AND status = 'Ожидает'
+                    AND EXISTS (SELECT 1 FROM drivers WHERE telegram_id = ?)
+                RETURNING {ORDER_COLUMNS},
+                    (SELECT full_name FROM drivers WHERE telegram_id = ?),
+                    (SELECT car_number FROM drivers WHERE telegram_id = ?)
+            """, (driver_id, order_id, driver_id, driver_id, driver_id))
+            accepted = cursor.fetchone()
+            if accepted and notification:
+                cursor.execute(
+                    "INSERT INTO outbox (chat_id, text) VALUES (?, ?)",
+                    (accepted[1], notification(accepted)),
+                )
+
+            conn.commit()
+        if accepted:
+            logger.info(f"Order {order_id} accepted by driver {driver_id}")
+        return accepted
+
+    except sqlite3.Error as e:
+        logger.error(f"Failed to accept order: {e}")
+        return None
+
+@_timed
+def expire_orders(before, limit=EXPIRE_BATCH_SIZE, notification=None):
+    """Marks up to ``limit`` waiting orders with a trip time before ``before`` as 'Истёк'.
+
+    A single UPDATE ... RETURNING that finds the orders through the partial
+    index on waiting trip times, oldest trip first. If ``notification`` is
+    given, ``notification(rows)`` is queued in the outbox once per client
+    with that client's expired rows, in the same transaction. Returns the
+    expired order rows.
+    """
+    try:
+        with get_connection() as conn:
+            cursor = conn.cursor()
+
+            cursor.execute(f"""
+                UPDATE orders SET status = 'Истёк'
+                WHERE id IN (
+                    SELECT id FROM orders
+                    WHERE status = 'Ожидает' AND trip_time < ?
+                    ORDER BY trip_time LIMIT ?
+                )
+                RETURNING {ORDER_COLUMNS}
+            """, (before, limit))
+            expired = cursor.fetchall()
+            if expired and notification:
+                # One notice per client, however many of their orders expired
+                by_client = {}
+                for order in expired:
+                    by_client.setdefault(order[1], []).append(order)
+                cursor.executemany(
+                    "INSERT INTO outbox (chat_id, text) VALUES (?, ?)",
+                    [(chat_id, notification(orders)) for chat_id, orders in by_client.items()],
+                )
+
+            conn.commit()
+        if expired:
+            logger.info(f"Expired {len(expired)} orders with a trip time before {before}")
+        return expired
+
+    except sqlite3.Error as e:
+        logger.error(f"Failed to expire orders: {e}")
+        return []
+
+def _import_row(order):
+    """The IMPORT_FIELDS values of an imported order, with its trip time in the stored format."""
+    # Empty CSV cells count as missing; 0 is a value
+    row = {field: None if order.get(field) == "" else order.get(field) for field in IMPORT_FIELDS}
+    created_at = row["created_at"]
+    placed = scheduling.from_utc(created_at) if created_at else None
+    row["trip_time"] = scheduling.normalize_trip_time(row["trip_time"], placed)
+    return [row[field] for field in IMPORT_FIELDS]
+
+@_timed
+def import_orders(orders, chunk_size=IMPORT_CHUNK_SIZE):
+    """Inserts orders in bulk, one transaction per ``chunk_size`` rows. Returns how many were imported, or None on an error.
+
+    ``orders`` is an iterable of dicts with the keys of IMPORT_FIELDS and is
+    consumed lazily. Imported orders are history: they are not queued for
+    dispatch. A missing status means 'Ожидает' and a missing created_at the
+    time of the import. A bare "HH:MM" trip time is dated like migration 12
+    does, by created_at; a trip time that does not parse is an error. On an
+    error the current chunk is rolled back, the import stops and the chunks
+    before it stay committed; the log says how many rows that was.
+    """
+    imported = 0
+    try:
+        with get_connection() as conn:
+            cursor = conn.cursor()
+            rows = (_import_row(order) for order in orders)
+            while True:
+                chunk = list(itertools.islice(rows, chunk_size))
+                if not chunk:
+                    break
+                cursor.executemany("""
+                    INSERT INTO orders (user_id, from_city, to_city, tariff, trip_time, phone_number,
+                                        status, driver_id, created_at, price)
+                    VALUES (?, ?, ?, ?, ?, ?, COALESCE(?, 'Ожидает'), ?, COALESCE(?, CURRENT_TIMESTAMP), ?)
+                """, chunk)
+                conn.commit()
+                imported += len(chunk)
+        logger.info(f"Imported {imported} orders")
+        return imported
+
+    except (sqlite3.Error, ValueError) as e:
+        logger.error(f"Failed to import orders after {imported} rows: {e}")
+        return None
+
+def export_orders(after_id=0, batch_size=EXPORT_BATCH_SIZE):
+    """Yields order rows (EXPORT_COLUMNS) in ID order without loading the table into memory.
+
+    Rows are read in keyset batches of ``batch_size``, each in its own short
+    read, so a long export neither holds a pooled connection nor keeps an old
+    snapshot open that would stop WAL checkpoints.
+    """
+    while True:
+        try:
+            with get_connection() as conn:
+                cursor = conn.cursor()
+
+                cursor.execute(f"""
+                    SELECT {', '.join(EXPORT_COLUMNS)} FROM orders
+                    WHERE id > ? ORDER BY id LIMIT ?
+                """, (after_id, batch_size))
+                batch = cursor.fetchall()
+
+        except sqlite3.Error as e:
+            logger.error(f"Failed to export orders after ID {after_id}: {e}")
+            raise
+        if not batch:
+            return
+        yield from batch
+        after_id = batch[-1][0]
+
+@_timed
+def get_pending_dispatches(limit=20):
+    """Retrieves orders that have been placed but not yet pushed to drivers."""
+    try:
+        with get_connection() as conn:
+            cursor = conn.cursor()
+
+            columns = ", ".join(f"o.{column}" for column in ORDER_COLUMNS.split(", "))
+            cursor.execute(f"""
+                SELECT {columns} FROM order_dispatch d
+                JOIN orders o ON o.id = d.order_id
+                WHERE d.dispatched_at IS NULL
+                ORDER BY d.order_id LIMIT ?
+            """, (limit,))
+            orders = cursor.fetchall()
+            return orders
+
+    except sqlite3.Error as e:
+        logger.error(f"Failed to get pending dispatches: {e}")
+        return []
+
+@_timed
+def mark_dispatched(order_ids):
+    """Marks orders as pushed to drivers so they are not dispatched again."""
+    try:
+        with get_connection() as conn:
+            cursor = conn.cursor()
+
+            cursor.executemany(
+                "UPDATE order_dispatch SET dispatched_at = CURRENT_TIMESTAMP WHERE order_id = ?",
+                [(order_id,) for order_id in order_ids],
+            )
+
+            conn.commit()
+
+    except sqlite3.Error as e:
+        logger.error(f"Failed to mark orders as dispatched: {e}")
+
+@_timed
+def get_due_notifications(limit=50):
+    """Retrieves the oldest due undelivered outbox message of each chat, up to ``limit`` chats."""
+    try:
+        with get_connection() as conn:
+            cursor = conn.cursor()
+
+            # One row per chat, so a chat with a long backlog cannot fill the batch
+            cursor.execute("""
+                SELECT id, chat_id, text, attempts FROM (
+                    SELECT id, chat_id, text, attempts, next_attempt_at,
+                           ROW_NUMBER() OVER (PARTITION BY chat_id ORDER BY id) AS position
+                    FROM outbox
+                    WHERE sent_at IS NULL AND failed_at IS NULL AND next_attempt_at <= CURRENT_TIMESTAMP
+                )
+                WHERE position = 1
+                ORDER BY next_attempt_at, id LIMIT ?
+            """, (limit,))
+            return cursor.fetchall()
+
+    except sqlite3.Error as e:
+        logger.error(f"Failed to get due notifications: {e}")
+        return []
+
+@_timed
+def mark_notifications_sent(notification_ids):
+    """Marks outbox messages as delivered."""
+    try:
+        with get_connection() as conn:
+            cursor = conn.cursor()
+
+            cursor.executemany(
+                "UPDATE outbox SET sent_at = CURRENT_TIMESTAMP, attempts = attempts + 1 WHERE id = ?",
+                [(notification_id,) for notification_id in notification_ids],
+            )
+
+            conn.commit()
+
+    except sqlite3.Error as e:
+        logger.error(f"Failed to mark notifications as sent: {e}")
+
+@_timed
+def reschedule_notification(notification_id, delay, error, give_up=False):
+    """Records a failed delivery attempt.
+
+    The next attempt is scheduled ``delay`` seconds from now, or never if
+    ``give_up`` is set.
+    """
+    try:
+        with get_connection() as conn:
+            cursor = conn.cursor()
+
+            cursor.execute("""
+                UPDATE outbox
+                SET attempts = attempts + 1,
+                    last_error = ?,
+                    next_attempt_at = datetime('now', ?),
+                    failed_at = CASE WHEN ? THEN CURRENT_TIMESTAMP END
+                WHERE id = ?
+            """, (error, f"+{max(1, math.ceil(delay))} seconds", give_up, notification_id))
+
+            conn.commit()
+
+    except sqlite3.Error as e:
+        logger.error(f"Failed to reschedule notification: {e}")
+
+@_timed
+def load_persisted(kind):
+    """Retrieves all persisted (key, value) pairs of one kind."""
+    try:
+        with get_connection() as conn:
+            cursor = conn.cursor()
+
+            cursor.execute("SELECT key, value FROM persistence WHERE kind = ?", (kind,))
+            return cursor.fetchall()
+
+    except sqlite3.Error as e:
+        logger.error(f"Failed to load persisted {kind}: {e}")
+        return []
+
+@_timed
+def save_persisted(changes):
+    """Writes a batch of (kind, key, value) changes in one transaction.
+
+    A value of None deletes the entry.
+    """
+    try:
+        with get_connection() as conn:
+            cursor = conn.cursor()
+
+            cursor.executemany(
+                "DELETE FROM persistence WHERE kind = ? AND key = ?",
+                [(kind, key) for kind, key, value in changes if value is None],
+            )
+            cursor.executemany(
+                "INSERT OR REPLACE INTO persistence (kind, key, value) VALUES (?, ?, ?)",
+                [change for change in changes if change[2] is not None],
+            )
+
+            conn.commit()
+        return True
+
+    except sqlite3.Error as e:
+        logger.error(f"Failed to save persisted data: {e}")
+        return False
+
+@_timed
+def get_driver_telegram_ids():
+    """Retrieves the Telegram IDs of all registered drivers."""
+    try:
+        with get_connection() as conn:
+            cursor = conn.cursor()
+
+            cursor.execute("SELECT telegram_id FROM drivers")
+            return [row[0] for row in cursor.fetchall()]
+
+    except sqlite3.Error as e:
+        logger.error(f"Failed to get driver IDs: {e}")
+        return []
+
+@_timed
 def get_driver_by_phone(phone_number):
-    """Retrieves a driver by their phone number."""
+    """Retrieves a driver by their phone number, from the driver cache when possible."""
     try:
-        conn = sqlite3.connect(DB_FILE, check_same_thread=False)
-        cursor = conn.cursor()
-        
-        cursor.execute("SELECT * FROM drivers WHERE phone_number = ?", (phone_number,))
-        driver = cursor.fetchone()
-        return driver
+        with get_connection() as conn:
+            driver = _driver_cache.get(conn, "phone", phone_number)
+            if driver is None:
+                generation = _driver_cache.generation
+                cursor = conn.cursor()
+
+                cursor.execute("SELECT * FROM drivers WHERE phone_number = ?", (phone_number,))
+                driver = cursor.fetchone()
+                _driver_cache.put(driver, generation)
+            return driver
 
     except sqlite3.Error as e:
         logger.error(f"Failed to get driver by phone: {e}")
         return None
-    finally:
-        if conn:
-            conn.close()
 
+@_timed
 def get_driver_by_telegram_id(telegram_id):
-    """Retrieves a driver by their Telegram ID."""
+    """Retrieves a driver by their Telegram ID, from the driver cache when possible."""
     try:
-        conn = sqlite3.connect(DB_FILE, check_same_thread=False)
-        cursor = conn.cursor()
-        
-        cursor.execute("SELECT * FROM drivers WHERE telegram_id = ?", (telegram_id,))
-        driver = cursor.fetchone()
-        return driver
+        with get_connection() as conn:
+            driver = _driver_cache.get(conn, "telegram_id", telegram_id)
+            if driver is None:
+                generation = _driver_cache.generation
+                cursor = conn.cursor()
+
+                cursor.execute("SELECT * FROM drivers WHERE telegram_id = ?", (telegram_id,))
+                driver = cursor.fetchone()
+                _driver_cache.put(driver, generation)
+            return driver
 
     except sqlite3.Error as e:
         logger.error(f"Failed to get driver by Telegram ID: {e}")
         return None
-    finally:
-        if conn:
-            conn.close()
 
+@_timed
 def add_driver(telegram_id, phone_number, full_name, car_number):
     """Adds a new driver to the database."""
     try:
-        conn = sqlite3.connect(DB_FILE, check_same_thread=False)
-        cursor = conn.cursor()
-        
-        cursor.execute("""
-            INSERT INTO drivers (telegram_id, phone_number, full_name, car_number)
-            VALUES (?, ?, ?, ?)
-        """, (telegram_id, phone_number, full_name, car_number))
-        
-        conn.commit()
+        with get_connection() as conn:
+            cursor = conn.cursor()
+
+            cursor.execute("""
+                INSERT INTO drivers (telegram_id, phone_number, full_name, car_number)
+                VALUES (?, ?, ?, ?)
+            """, (telegram_id, phone_number, full_name, car_number))
+
+            conn.commit()
+        _driver_cache.invalidate()
         logger.info(f"New driver added: {full_name} ({telegram_id})")
 
     except sqlite3.Error as e:
         logger.error(f"Failed to add driver: {e}")
-    finally:
-        if conn:
-            conn.close()
 
+@_timed
 def update_driver_telegram_id(phone_number, telegram_id):
     """Updates the telegram_id for a driver with the given phone number."""
     try:
-        conn = sqlite3.connect(DB_FILE, check_same_thread=False)
-        cursor = conn.cursor()
+        with get_connection() as conn:
+            cursor = conn.cursor()
 
-        cursor.execute("UPDATE drivers SET telegram_id = ? WHERE phone_number = ?", (telegram_id, phone_number))
+            cursor.execute("""
+                UPDATE driver_routes SET telegram_id = ?
+                WHERE telegram_id = (SELECT telegram_id FROM drivers WHERE phone_number = ?)
+            """, (telegram_id, phone_number))
+            cursor.execute("UPDATE drivers SET telegram_id = ? WHERE phone_number = ?", (telegram_id, phone_number))
 
-        conn.commit()
+            conn.commit()
+        _driver_cache.invalidate()
         logger.info(f"Updated telegram_id for driver with phone number {phone_number}")
 
     except sqlite3.Error as e:
         logger.error(f"Failed to update telegram_id: {e}")
-    finally:
-        if conn:
-            conn.close()
+
+@_timed
+def get_driver_routes():
+    """Retrieves all declared routes as (telegram_id, from_city, to_city, tariff) rows."""
+    try:
+        with get_connection() as conn:
+            cursor = conn.cursor()
+
+            cursor.execute("SELECT telegram_id, from_city, to_city, tariff FROM driver_routes")
+            return cursor.fetchall()
+
+    except sqlite3.Error as e:
+        logger.error(f"Failed to get driver routes: {e}")
+        return []
+
+@_timed
+def set_driver_routes(telegram_id, routes):
+    """Replaces the (from_city, to_city, tariff) routes a driver serves; an empty list means all routes."""
+    try:
+        with get_connection() as conn:
+            cursor = conn.cursor()
+
+            cursor.execute("DELETE FROM driver_routes WHERE telegram_id = ?", (telegram_id,))
+            cursor.executemany("""
+                INSERT INTO driver_routes (telegram_id, from_city, to_city, tariff)
+                VALUES (?, ?, ?, ?)
+            """, [(telegram_id, *route) for route in routes])
+
+            conn.commit()
+        logger.info(f"Driver {telegram_id} now serves {len(routes) or 'all'} routes")
+        return True
+
+    except sqlite3.Error as e:
+        logger.error(f"Failed to set driver routes: {e}")
+        return False
+
+@_timed
+def load_driver_sessions():
+    """Retrieves the open shifts as (telegram_id, city, started_at, last_seen_at) rows."""
+    try:
+        with get_connection() as conn:
+            cursor = conn.cursor()
+
+            cursor.execute("SELECT telegram_id, city, started_at, last_seen_at FROM driver_sessions WHERE online = 1")
+            return cursor.fetchall()
+
+    except sqlite3.Error as e:
+        logger.error(f"Failed to load driver sessions: {e}")
+        return []
+
+@_timed
+def save_driver_sessions(sessions):
+    """Writes a batch of shift changes in one transaction.
+
+    ``sessions`` holds (telegram_id, city, started_at, last_seen_at) rows;
+    a row with city None ends the driver's shift.
+    """
+    try:
+        with get_connection() as conn:
+            cursor = conn.cursor()
+
+            cursor.executemany("""
+                INSERT INTO driver_sessions (telegram_id, city, started_at, last_seen_at, online)
+                VALUES (?, ?, ?, ?, 1)
+                ON CONFLICT (telegram_id) DO UPDATE SET
+                    city = excluded.city,
+                    started_at = excluded.started_at,
+                    last_seen_at = excluded.last_seen_at,
+                    online = 1
+            """, [row for row in sessions if row[1] is not None])
+            cursor.executemany(
+                "UPDATE driver_sessions SET online = 0 WHERE telegram_id = ?",
+                [(row[0],) for row in sessions if row[1] is None],
+            )
+
+            conn.commit()
+        return True
+
+    except sqlite3.Error as e:
+        logger.error(f"Failed to save driver sessions: {e}")
+        return False
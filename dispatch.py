@@ -0,0 +1,76 @@
+"""Push new orders to drivers as soon as they are placed.
+
+The client bot only writes the order and an ``order_dispatch`` row in one
+transaction; it never talks to drivers itself. The driver bot runs an
+``OrderDispatcher`` that drains that outbox in the background and hands each
+order to a fan-out callback, so placing an order never waits on Telegram.
+"""
+import asyncio
+import logging
+
+from async_database import get_pending_dispatches, mark_dispatched
+
+logger = logging.getLogger(__name__)
+
+# Dispatcher defaults
+POLL_INTERVAL = 1.0
+BATCH_SIZE = 20
+
+
+class OrderDispatcher:
+    """Background task that drains the ``order_dispatch`` outbox.
+
+    ``fan_out`` is an ``async def fan_out(order)`` callback that delivers one
+    order row; it should handle its own per-recipient errors. Each order is
+    marked as dispatched right after its callback returns, so a crash repeats
+    at most the order that was in flight.
+    """
+
+    def __init__(self, fan_out, poll_interval=POLL_INTERVAL, batch_size=BATCH_SIZE):
+        self.fan_out = fan_out
+        self.poll_interval = poll_interval
+        self.batch_size = batch_size
+        self.dispatched_count = 0
+        self._task = None
+
+    def start(self):
+        """Starts draining the outbox on the running event loop."""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run(), name="order-dispatcher")
+
+    async def stop(self):
+        """Stops the background task, cancelling a fan-out in progress.
+
+        The interrupted order is not marked as dispatched, so it is pushed
+        again, to every driver, after a restart.
+        """
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def dispatch_pending(self):
+        """Dispatches one batch of pending orders. Returns how many were handled."""
+        orders = await get_pending_dispatches(self.batch_size)
+        for order in orders:
+            try:
+                await self.fan_out(order)
+            except Exception as e:
+                logger.error(f"Failed to dispatch order {order[0]}: {e}")
+            await mark_dispatched([order[0]])
+            self.dispatched_count += 1
+        return len(orders)
+
+    async def _run(self):
+        while True:
+            try:
+                handled = await self.dispatch_pending()
+            except Exception as e:
+                logger.error(f"Order dispatcher error: {e}")
+                handled = 0
+            # Keep draining while there is a backlog, otherwise wait for new orders
+            if handled < self.batch_size:
+                await asyncio.sleep(self.poll_interval)
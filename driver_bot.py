@@ -1,10 +1,15 @@
 
+import asyncio
+import itertools
 import logging
 import os
 import json
-import httpx
+from datetime import timedelta
 
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, BotCommand, ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove
+from telegram.constants import ChatType
+from telegram.error import BadRequest, RetryAfter
+from telegram.request import BaseRequest, HTTPXRequest
 from telegram.ext import (
     Application,
     CommandHandler,
@@ -12,18 +17,35 @@ from telegram.ext import (
     CallbackQueryHandler,
     ConversationHandler,
     MessageHandler,
+    TypeHandler,
     filters,
 )
 
-from database import (
-    get_waiting_orders, 
-    update_order_status, 
-    get_order_by_id,
+from database import initialize_database
+from async_database import (
+    get_waiting_orders,
+    get_scheduled_orders,
+    accept_order,
     get_driver_by_phone,
     add_driver,
     get_driver_by_telegram_id,
     update_driver_telegram_id,
+    get_driver_telegram_ids,
+    get_driver_routes,
+    set_driver_routes,
+    shutdown_executor,
 )
+from dispatch import OrderDispatcher
+from notifications import NotificationClient, OutboxWorker, RateLimiter, GLOBAL_RATE, TELEGRAM_API_URL
+from persistence import SQLitePersistence, FLUSH_INTERVAL
+from update_processor import KeyedUpdateProcessor, CONCURRENT_UPDATES
+from instrumentation import InstrumentedRequest, instrument_handlers
+from matching import MatchingIndex, CITIES, ROUTES, TARIFFS
+from presence import PresenceRegistry, HEARTBEAT_TTL
+from scheduling import ReleaseScheduler, RELEASE_LEAD, TIMEZONE, due_cutoff, format_trip_time, set_timezone
+from fares import format_price
+from expiry import OrderSweeper, EXPIRE_AFTER, SWEEP_INTERVAL
+from metrics import REGISTRY
 
 # Enable logging
 logging.basicConfig(
@@ -34,34 +56,196 @@ logger = logging.getLogger(__name__)
 # States for registration conversation
 PHONE_NUMBER, FULL_NAME, CAR_NUMBER = range(3)
 
+# Number of waiting orders shown per page
+ORDERS_PAGE_SIZE = 5
+# Attempts per pushed message while the Bot API answers 429
+MAX_SEND_ATTEMPTS = 3
+
+
+def format_order(order):
+    """Formats an order row for the driver."""
+    order_id, user_id, from_city, to_city, tariff, trip_time, phone_number, status, price = order[:9]
+    return (
+        f"Заказ ID: {order_id}\n"
+        f"Откуда: {from_city}\n"
+        f"Куда: {to_city}\n"
+        f"Тариф: {tariff}\n"
+        f"Время: {format_trip_time(trip_time)}\n"
+        + (f"Цена: {format_price(price)}\n" if price is not None else "")
+        + f"Телефон: {phone_number}"
+    )
 
-async def show_waiting_orders(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Displays waiting orders to the driver."""
-    await update.message.reply_text("Вот доступные заказы:", reply_markup=ReplyKeyboardRemove())
-    orders = get_waiting_orders()
-    if not orders:
-        await update.message.reply_text("Нет доступных заказов.")
+def format_acceptance(order):
+    """Formats the client notification for an accepted order row."""
+    driver_name, driver_car = order[-2:]
+    return (
+        f"Ваш заказ принят!\n\n"
+        f"Водитель: {driver_name}\n"
+        f"Машина: {driver_car}"
+    )
+
+def format_expiry(orders):
+    """Formats the client notification for one client's orders that expired without a driver."""
+    trips = [
+        f"№{order_id} ({from_city} → {to_city}, {format_trip_time(trip_time, with_date=True)})"
+        for order_id, _, from_city, to_city, _, trip_time in (order[:6] for order in orders)
+    ]
+    if len(trips) == 1:
+        summary = f"ваш заказ {trips[0]} никто не принял, и он закрыт."
+    else:
+        summary = "ваши заказы никто не принял, и они закрыты:\n" + "\n".join(trips)
+    return (
+        f"К сожалению, {summary}\n\n"
+        f"Чтобы заказать такси снова, нажмите /start."
+    )
+
+def accept_keyboard(order_id):
+    """Inline keyboard with a single accept button for one order."""
+    return InlineKeyboardMarkup([[InlineKeyboardButton("Взять заказ", callback_data=f"accept_{order_id}")]])
+
+def routes_keyboard(selection):
+    """Toggle buttons for the route and tariff indexes in ``selection``, plus save buttons."""
+    keyboard = [
+        [InlineKeyboardButton(
+            f"{'✅' if i in selection['routes'] else '▫️'} {from_city} → {to_city}",
+            callback_data=f"routes_route_{i}",
+        )]
+        for i, (from_city, to_city) in enumerate(ROUTES)
+    ]
+    keyboard.append([
+        InlineKeyboardButton(f"{'✅' if i in selection['tariffs'] else '▫️'} {tariff}", callback_data=f"routes_tariff_{i}")
+        for i, tariff in enumerate(TARIFFS)
+    ])
+    keyboard.append([
+        InlineKeyboardButton("Сохранить", callback_data="routes_save"),
+        InlineKeyboardButton("Все заказы", callback_data="routes_all"),
+    ])
+    return InlineKeyboardMarkup(keyboard)
+
+async def send_paced(bot, limiter, chat_id, text, reply_markup=None):
+    """Sends a message once ``limiter`` allows it, retrying as long as a 429 asks to wait."""
+    for attempt in range(1, MAX_SEND_ATTEMPTS + 1):
+        await limiter.acquire()
+        try:
+            return await bot.send_message(chat_id=chat_id, text=text, reply_markup=reply_markup)
+        except RetryAfter as e:
+            if attempt == MAX_SEND_ATTEMPTS:
+                raise
+            delay = e.retry_after
+            await asyncio.sleep(delay.total_seconds() if isinstance(delay, timedelta) else delay)
+
+async def push_order(bot, limiter, order, driver_ids, channel_id=None):
+    """Sends a new order to the orders channel and to the given drivers."""
+    text = f"Новый заказ!\n\n{format_order(order)}"
+    reply_markup = accept_keyboard(order[0])
+
+    chat_ids = list(driver_ids)
+    if channel_id:
+        chat_ids.insert(0, channel_id)
+
+    results = await asyncio.gather(
+        *(send_paced(bot, limiter, chat_id, text, reply_markup) for chat_id in chat_ids),
+        return_exceptions=True,
+    )
+    for chat_id, result in zip(chat_ids, results):
+        if isinstance(result, Exception):
+            logger.warning(f"Failed to push order {order[0]} to {chat_id}: {result}")
+    logger.info(f"Order {order[0]} pushed to {len(chat_ids)} chats")
+
+async def notify_shifts_expired(bot, limiter, driver_ids):
+    """Tells drivers whose shift ended for lack of activity that they no longer get orders."""
+    text = (
+        "Ваша смена завершена: от вас давно не было действий, и новые заказы больше не приходят.\n"
+        "Чтобы продолжить работу, нажмите /shift_start."
+    )
+    results = await asyncio.gather(
+        *(send_paced(bot, limiter, driver_id, text) for driver_id in driver_ids),
+        return_exceptions=True,
+    )
+    for driver_id, result in zip(driver_ids, results):
+        if isinstance(result, Exception):
+            logger.warning(f"Failed to notify driver {driver_id} about the end of their shift: {result}")
+
+async def dispatch_order(application, order):
+    """Releases a new order to drivers now, or schedules it for shortly before the trip."""
+    # Orders queued while the bot was down may have expired or been taken since
+    if order[7] != 'Ожидает':
         return
+    await application.bot_data['scheduler'].add(order)
+
+async def release_order(application, order):
+    """Indexes a due order and pushes it to the online drivers serving its route."""
+    index = application.bot_data['matching_index']
+    index.add_order(order)
+    driver_ids = application.bot_data['presence'].online(index.drivers_for(order))
+    await push_order(
+        application.bot, application.bot_data['send_limiter'], order, driver_ids,
+        application.bot_data.get('ORDER_CHANNEL_ID'),
+    )
 
-    for order in orders:
-        order_id, user_id, from_city, to_city, tariff, trip_time, phone_number, status = order
-        order_text = (
-            f"Новый заказ! (ID: {order_id})\n"
-            f"Откуда: {from_city}\n"
-            f"Куда: {to_city}\n"
-            f"Тариф: {tariff}\n"
-            f"Время: {trip_time}\n"
-            f"Телефон: {phone_number}"
-        )
-        keyboard = [[InlineKeyboardButton("Взять заказ", callback_data=f"accept_{order_id}")]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await update.message.reply_text(order_text, reply_markup=reply_markup)
+def render_orders_page(index, driver_id, after_id=0, before_id=None):
+    """Builds the text and inline keyboard of one page of the orders a driver can take."""
+    # Fetch one extra row to find out whether there is a page in that direction
+    orders = index.orders_for(driver_id, after_id=after_id, before_id=before_id, limit=ORDERS_PAGE_SIZE + 1)
+    if before_id is not None:
+        has_prev = len(orders) > ORDERS_PAGE_SIZE
+        orders = orders[-ORDERS_PAGE_SIZE:]
+        has_next = True
+    else:
+        has_next = len(orders) > ORDERS_PAGE_SIZE
+        orders = orders[:ORDERS_PAGE_SIZE]
+        has_prev = after_id > 0
+
+    if not orders:
+        keyboard = [[InlineKeyboardButton("Обновить", callback_data="orders_after_0")]]
+        return "Нет доступных заказов.", InlineKeyboardMarkup(keyboard)
+
+    text = "Вот доступные заказы:\n\n" + "\n\n".join(format_order(order) for order in orders)
+    keyboard = [
+        [InlineKeyboardButton(f"Взять заказ {order[0]}", callback_data=f"accept_{order[0]}")]
+        for order in orders
+    ]
+    navigation = []
+    if has_prev:
+        navigation.append(InlineKeyboardButton("« Назад", callback_data=f"orders_before_{orders[0][0]}"))
+    if has_next:
+        navigation.append(InlineKeyboardButton("Далее »", callback_data=f"orders_after_{orders[-1][0]}"))
+    if navigation:
+        keyboard.append(navigation)
+    return text, InlineKeyboardMarkup(keyboard)
+
+async def show_waiting_orders(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Sends the first page of waiting orders as a single message."""
+    text, reply_markup = render_orders_page(context.bot_data['matching_index'], update.effective_user.id)
+    await update.message.reply_text(text, reply_markup=reply_markup)
+
+async def orders_page(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Edits the orders message in place to show the next or previous page."""
+    query = update.callback_query
+    await query.answer()
+
+    _, direction, order_id = query.data.split("_")
+    index = context.bot_data['matching_index']
+    if direction == "after":
+        text, reply_markup = render_orders_page(index, query.from_user.id, after_id=int(order_id))
+    else:
+        text, reply_markup = render_orders_page(index, query.from_user.id, before_id=int(order_id))
+
+    try:
+        await query.edit_message_text(text, reply_markup=reply_markup)
+    except BadRequest as e:
+        # Refreshing an unchanged page is not an error worth surfacing
+        if "not modified" not in str(e):
+            raise
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Starts the bot, checks for registration, and either shows orders or starts registration."""
-    driver = get_driver_by_telegram_id(update.effective_user.id)
+    driver = await get_driver_by_telegram_id(update.effective_user.id)
     if driver:
-        await update.message.reply_text(f"Здравствуйте, {driver[2]}!")
+        greeting = f"Здравствуйте, {driver[2]}!"
+        if not context.bot_data['presence'].is_online(update.effective_user.id):
+            greeting += "\nЧтобы получать новые заказы, начните смену: /shift_start"
+        await update.message.reply_text(greeting)
         await show_waiting_orders(update, context)
         return ConversationHandler.END
     else:
@@ -78,10 +262,13 @@ async def phone_number_handler(update: Update, context: ContextTypes.DEFAULT_TYP
     phone = update.message.contact.phone_number
     context.user_data['phone_number'] = phone
     
-    driver = get_driver_by_phone(phone)
+    driver = await get_driver_by_phone(phone)
     if driver:
-        update_driver_telegram_id(phone, update.effective_user.id)
-        await update.message.reply_text(f"Рады снова вас видеть, {driver[2]}!")
+        await update_driver_telegram_id(phone, update.effective_user.id)
+        if driver[0] != update.effective_user.id:
+            context.bot_data['matching_index'].rename_driver(driver[0], update.effective_user.id)
+            context.bot_data['presence'].rename_driver(driver[0], update.effective_user.id)
+        await update.message.reply_text(f"Рады снова вас видеть, {driver[2]}!", reply_markup=ReplyKeyboardRemove())
         await show_waiting_orders(update, context)
         return ConversationHandler.END
     else:
@@ -98,12 +285,13 @@ async def car_number_handler(update: Update, context: ContextTypes.DEFAULT_TYPE)
     """Handles the car number, saves the new driver, and shows orders."""
     context.user_data['car_number'] = update.message.text
     
-    add_driver(
+    await add_driver(
         telegram_id=update.effective_user.id,
         phone_number=context.user_data['phone_number'],
         full_name=context.user_data['full_name'],
         car_number=context.user_data['car_number'],
     )
+    context.bot_data['matching_index'].add_driver(update.effective_user.id)
     
     await update.message.reply_text("Поздравляем, вы успешно зарегистрированы!")
     await show_waiting_orders(update, context)
@@ -115,209 +303,265 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
         "Этот бот предназначен для водителей такси.\n\n"
         "**Команды:**\n"
         "/start - Начать работу или показать доступные заказы\n"
+        "/shift_start - Начать смену и получать новые заказы\n"
+        "/shift_stop - Закончить смену\n"
+        "/routes - Выбрать маршруты и тарифы\n"
         "/help - Показать это сообщение"
     )
 
-async def button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Parses the CallbackQuery and updates the message text."""
+async def heartbeat(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Keeps the shift of a driver who is using the bot open."""
+    if update.effective_user:
+        context.bot_data['presence'].heartbeat(update.effective_user.id)
+
+async def shift_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Asks a registered driver for the city they start their shift in."""
+    if not await get_driver_by_telegram_id(update.effective_user.id):
+        await update.message.reply_text("Сначала зарегистрируйтесь с помощью /start.")
+        return
+
+    keyboard = [[InlineKeyboardButton(city, callback_data=f"shift_city_{i}")] for i, city in enumerate(CITIES)]
+    await update.message.reply_text("В каком городе вы начинаете смену?", reply_markup=InlineKeyboardMarkup(keyboard))
+
+async def shift_city(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Puts the driver online in the chosen city."""
     query = update.callback_query
     await query.answer()
 
-    if query.data.startswith("accept_"):
-        order_id = int(query.data.split("_")[1])
-        driver_user = query.from_user
-        
-        update_order_status(order_id, "Принят")
-        logger.info(f"Driver {driver_user.id} ({driver_user.full_name}) accepted order {order_id}")
-        
-        original_message = query.message.text
-        await query.edit_message_text(text=f"Заказ {order_id} принят вами.\n\n{original_message}")
-
-        # Notify the client
-        order = get_order_by_id(order_id)
-        driver = get_driver_by_telegram_id(driver_user.id)
-
-        if order and driver:
-            client_user_id = order[1]
-            driver_name = driver[2]
-            driver_car = driver[3]
-
-            notification_text = (
-                f"Ваш заказ принят!\n\n"
-                f"Водитель: {driver_name}\n"
-                f"Машина: {driver_car}"
-            )
-
-            client_token = context.bot_data['CLIENT_TELEGRAM_TOKEN']
-            url = f"https://api.telegram.org/bot{client_token}/sendMessage"
-            params = {"chat_id": client_user_id, "text": notification_text}
-
-            async with httpx.AsyncClient() as client:
-                try:
-                    response = await client.post(url, json=params)
-                    response.raise_for_status()
-                    logger.info(f"Successfully sent notification to client {client_user_id} for order {order_id}")
-                except httpx.HTTPStatusError as e:
-                    logger.error(f"Failed to send notification for order {order_id}: {e.response.text}")
-                except Exception as e:
-                    logger.error(f"An unexpected error occurred while sending notification for order {order_id}: {e}")
+    city = CITIES[int(query.data.split("_")[2])]
+    context.bot_data['presence'].start_shift(query.from_user.id, city)
+    logger.info(f"Driver {query.from_user.id} started a shift in {city}")
+    await query.edit_message_text(f"Смена начата, город: {city}. Новые заказы будут приходить сюда.")
 
-async def post_init(application: Application) -> None:
-    """Sets the bot commands in the Telegram menu."""
-    commands = [
-        BotCommand("start", "Начать работу / Показать заказы"),
-        BotCommand("help", "Помощь"),
-    ]
-    await application.bot.set_my_commands(commands)
+async def shift_stop(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Takes the driver offline."""
+    if context.bot_data['presence'].stop_shift(update.effective_user.id):
+        logger.info(f"Driver {update.effective_user.id} ended their shift")
+        await update.message.reply_text("Смена завершена. Новые заказы больше не будут приходить.")
+    else:
+        await update.message.reply_text("Вы не на смене. Начать смену: /shift_start")
 
-async def show_waiting_orders(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Displays waiting orders to the driver."""
-    await update.message.reply_text("Вот доступные заказы:", reply_markup=ReplyKeyboardRemove())
-    orders = get_waiting_orders()
-    if not orders:
-        await update.message.reply_text("Нет доступных заказов.")
+async def routes_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Shows the routes and tariffs the driver serves as toggle buttons."""
+    if not await get_driver_by_telegram_id(update.effective_user.id):
+        await update.message.reply_text("Сначала зарегистрируйтесь с помощью /start.")
         return
 
-    for order in orders:
-        order_id, user_id, from_city, to_city, tariff, trip_time, phone_number, status = order
-        order_text = (
-            f"Новый заказ! (ID: {order_id})\n"
-            f"Откуда: {from_city}\n"
-            f"Куда: {to_city}\n"
-            f"Тариф: {tariff}\n"
-            f"Время: {trip_time}\n"
-            f"Телефон: {phone_number}"
-        )
-        keyboard = [[InlineKeyboardButton("Взять заказ", callback_data=f"accept_{order_id}")]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await update.message.reply_text(order_text, reply_markup=reply_markup)
+    declared = context.bot_data['matching_index'].routes_of(update.effective_user.id)
+    selection = {
+        "routes": [i for i, route in enumerate(ROUTES) if any(key[:2] == route for key in declared)],
+        "tariffs": [i for i, tariff in enumerate(TARIFFS) if any(key[2] == tariff for key in declared)],
+    }
+    context.user_data['routes_selection'] = selection
+    await update.message.reply_text(
+        "Выберите маршруты и тарифы, заказы по которым вы хотите получать. "
+        "Если не выбрать ни одного маршрута или тарифа, вы получаете заказы по всем.",
+        reply_markup=routes_keyboard(selection),
+    )
 
-async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    """Starts the bot, checks for registration, and either shows orders or starts registration."""
-    driver = get_driver_by_telegram_id(update.effective_user.id)
-    if driver:
-        await update.message.reply_text(f"Здравствуйте, {driver[2]}!")
-        await show_waiting_orders(update, context)
-        return ConversationHandler.END
-    else:
-        contact_button = KeyboardButton("Поделиться номером телефона", request_contact=True)
-        reply_markup = ReplyKeyboardMarkup([[contact_button]], one_time_keyboard=True, resize_keyboard=True)
-        await update.message.reply_text(
-            "Здравствуйте! Для начала работы, пожалуйста, поделитесь своим номером телефона.",
-            reply_markup=reply_markup,
-        )
-        return PHONE_NUMBER
+async def routes_toggle(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Toggles one route or tariff of the selection."""
+    query = update.callback_query
+    await query.answer()
 
-async def phone_number_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    """Handles the phone number, checks if the driver exists, and proceeds accordingly."""
-    phone = update.message.contact.phone_number
-    context.user_data['phone_number'] = phone
-    
-    driver = get_driver_by_phone(phone)
-    if driver:
-        update_driver_telegram_id(phone, update.effective_user.id)
-        await update.message.reply_text(f"Рады снова вас видеть, {driver[2]}!")
-        await show_waiting_orders(update, context)
-        return ConversationHandler.END
+    _, kind, i = query.data.split("_")
+    selection = context.user_data.setdefault('routes_selection', {"routes": [], "tariffs": []})
+    chosen = selection[f"{kind}s"]
+    if int(i) in chosen:
+        chosen.remove(int(i))
     else:
-        await update.message.reply_text("Вы новый водитель! Пожалуйста, введите ваше ФИО:", reply_markup=ReplyKeyboardRemove())
-        return FULL_NAME
+        chosen.append(int(i))
 
-async def full_name_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    """Handles the full name and asks for the car number."""
-    context.user_data['full_name'] = update.message.text
-    await update.message.reply_text("Теперь, пожалуйста, введите номер вашей машины:")
-    return CAR_NUMBER
+    try:
+        await query.edit_message_reply_markup(reply_markup=routes_keyboard(selection))
+    except BadRequest as e:
+        if "not modified" not in str(e):
+            raise
 
-async def car_number_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    """Handles the car number, saves the new driver, and shows orders."""
-    context.user_data['car_number'] = update.message.text
-    
-    add_driver(
-        telegram_id=update.effective_user.id,
-        phone_number=context.user_data['phone_number'],
-        full_name=context.user_data['full_name'],
-        car_number=context.user_data['car_number'],
-    )
-    
-    await update.message.reply_text("Поздравляем, вы успешно зарегистрированы!")
-    await show_waiting_orders(update, context)
-    return ConversationHandler.END
+async def routes_save(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Saves the selection as every chosen route with every chosen tariff."""
+    query = update.callback_query
+    await query.answer()
 
-async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Displays help information."""
-    await update.message.reply_text(
-        "Этот бот предназначен для водителей такси.\n\n"
-        "**Команды:**\n"
-        "/start - Начать работу или показать доступные заказы\n"
-        "/help - Показать это сообщение"
-    )
+    selection = context.user_data.pop('routes_selection', None) or {"routes": [], "tariffs": []}
+    routes = []
+    if query.data == "routes_save":
+        chosen_routes = [ROUTES[i] for i in sorted(selection["routes"])] or ROUTES
+        chosen_tariffs = [TARIFFS[i] for i in sorted(selection["tariffs"])] or TARIFFS
+        routes = [(*route, tariff) for route, tariff in itertools.product(chosen_routes, chosen_tariffs)]
+        if len(routes) == len(ROUTES) * len(TARIFFS):
+            routes = []
+
+    if not await set_driver_routes(query.from_user.id, routes):
+        await query.edit_message_text("Не удалось сохранить маршруты. Попробуйте позже.")
+        return
+    context.bot_data['matching_index'].set_routes(query.from_user.id, routes)
+
+    if routes:
+        lines = sorted({f"{from_city} → {to_city}" for from_city, to_city, _ in routes})
+        tariffs = [tariff for tariff in TARIFFS if any(route[2] == tariff for route in routes)]
+        text = "Вы получаете заказы по маршрутам:\n" + "\n".join(lines) + f"\n\nТарифы: {', '.join(tariffs)}"
+    else:
+        text = "Вы получаете заказы по всем маршрутам и тарифам."
+    await query.edit_message_text(text)
 
 async def button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Parses the CallbackQuery and updates the message text."""
     query = update.callback_query
-    await query.answer()
 
     if query.data.startswith("accept_"):
         order_id = int(query.data.split("_")[1])
         driver_user = query.from_user
-        
-        update_order_status(order_id, "Принят")
+
+        order = await accept_order(order_id, driver_user.id, notification=format_acceptance)
+        if not order:
+            # Anyone can tap the button in the orders channel; only drivers can take orders
+            if not await get_driver_by_telegram_id(driver_user.id):
+                await query.answer("Сначала зарегистрируйтесь с помощью /start в личном чате с ботом.", show_alert=True)
+            else:
+                await query.answer("Этот заказ уже принят другим водителем.", show_alert=True)
+            return
+
+        await query.answer()
+        context.bot_data['matching_index'].remove_order(order_id)
         logger.info(f"Driver {driver_user.id} ({driver_user.full_name}) accepted order {order_id}")
-        
-        original_message = query.message.text
-        await query.edit_message_text(text=f"Заказ {order_id} принят вами.\n\n{original_message}")
-
-        # Notify the client
-        order = get_order_by_id(order_id)
-        driver = get_driver_by_telegram_id(driver_user.id)
-
-        if order and driver:
-            client_user_id = order[1]
-            driver_name = driver[2]
-            driver_car = driver[3]
-
-            notification_text = (
-                f"Ваш заказ принят!\n\n"
-                f"Водитель: {driver_name}\n"
-                f"Машина: {driver_car}"
-            )
-
-            client_token = context.bot_data['CLIENT_TELEGRAM_TOKEN']
-            url = f"https://api.telegram.org/bot{client_token}/sendMessage"
-            params = {"chat_id": client_user_id, "text": notification_text}
-
-            async with httpx.AsyncClient() as client:
-                try:
-                    response = await client.post(url, json=params)
-                    response.raise_for_status()
-                    logger.info(f"Successfully sent notification to client {client_user_id} for order {order_id}")
-                except httpx.HTTPStatusError as e:
-                    logger.error(f"Failed to send notification for order {order_id}: {e.response.text}")
-                except Exception as e:
-                    logger.error(f"An unexpected error occurred while sending notification for order {order_id}: {e}")
+        # The client notification was queued with the acceptance; deliver it now
+        context.bot_data['outbox_worker'].wake()
+
+        if query.message.chat.type == ChatType.CHANNEL:
+            accepted_by = f"водителем {order[-2]}"
+        else:
+            accepted_by = "вами"
+        await query.edit_message_text(text=f"Заказ {order_id} принят {accepted_by}.\n\n{format_order(order)}")
+    else:
+        await query.answer()
 
-def main() -> None:
-    """Run the driver bot."""
-    try:
-        with open('config.json', 'r', encoding='utf-8') as f:
-            config = json.load(f)
-        driver_token = config.get('DRIVER_TELEGRAM_TOKEN')
-        client_token = config.get('CLIENT_TELEGRAM_TOKEN')
+async def post_init(application: Application) -> None:
+    """Sets the bot commands in the Telegram menu."""
+    commands = [
+        BotCommand("start", "Начать работу / Показать заказы"),
+        BotCommand("shift_start", "Начать смену"),
+        BotCommand("shift_stop", "Закончить смену"),
+        BotCommand("routes", "Маршруты и тарифы"),
+        BotCommand("help", "Помощь"),
+    ]
+    await application.bot.set_my_commands(commands)
 
-    except FileNotFoundError:
-        logger.error("config.json not found.")
-        return
-    except json.JSONDecodeError:
-        logger.error("Error decoding config.json.")
-        return
+    notifier = NotificationClient(application.bot_data['CLIENT_TELEGRAM_TOKEN'], base_url=application.bot_data['BOT_API_URL'])
+    outbox_worker = OutboxWorker(notifier)
+    outbox_worker.start()
+    application.bot_data['notifier'] = notifier
+    application.bot_data['outbox_worker'] = outbox_worker
+    REGISTRY.expose("notifier", "Client notification counters", notifier.metrics)
+    REGISTRY.expose("outbox", "Outbox delivery counters", outbox_worker.metrics)
+
+    presence = application.bot_data['presence']
+    presence.on_expired = lambda driver_ids: notify_shifts_expired(
+        application.bot, application.bot_data['send_limiter'], driver_ids
+    )
+    await presence.load()
+    presence.start()
+
+    # Orders nobody took are closed a while after their trip time; the ones
+    # that went stale while the bot was down never make it into the index
+    sweeper = OrderSweeper(
+        application.bot_data['ORDER_EXPIRE_AFTER'],
+        notification=format_expiry if application.bot_data['NOTIFY_EXPIRED'] else None,
+    )
+    REGISTRY.expose("expiry", "Order expiry sweep counters", sweeper.metrics)
+    await sweeper.sweep()
+
+    # Orders placed while the bot was down are loaded here and new ones arrive
+    # through the dispatcher; bookings further ahead wait in the scheduler
+    lead = application.bot_data['RELEASE_LEAD']
+    cutoff = due_cutoff(lead)
+    index = MatchingIndex()
+    index.load(await get_waiting_orders(due_before=cutoff), await get_driver_telegram_ids(), await get_driver_routes())
+    application.bot_data['matching_index'] = index
+    REGISTRY.expose("matching", "Matching index sizes and fan-out counters", index.metrics)
+
+    scheduler = ReleaseScheduler(lambda order: release_order(application, order), lead=lead)
+    for order in await get_scheduled_orders(cutoff):
+        await scheduler.add(order)
+    scheduler.start()
+    application.bot_data['scheduler'] = scheduler
+    REGISTRY.expose("scheduler", "Booked order release counters", scheduler.metrics)
+
+    dispatcher = OrderDispatcher(lambda order: dispatch_order(application, order))
+    dispatcher.start()
+    application.bot_data['dispatcher'] = dispatcher
+
+    # From here on a sweep also drops what it expires from the index and the scheduler
+    sweeper.on_expired = lambda orders: forget_orders(application, orders)
+    if application.job_queue is None:
+        logger.warning("No job queue (install python-telegram-bot[job-queue]); waiting orders will not expire.")
+    else:
+        application.job_queue.run_repeating(
+            sweeper.run, interval=application.bot_data['EXPIRY_SWEEP_INTERVAL'], name="expire_orders"
+        )
+
+def forget_orders(application, orders):
+    """Drops expired orders from the matching index and the release scheduler."""
+    index = application.bot_data['matching_index']
+    scheduler = application.bot_data['scheduler']
+    for order in orders:
+        index.remove_order(order[0])
+        scheduler.cancel(order[0])
+
+async def post_stop(application: Application) -> None:
+    """Stops pushing new orders and delivering client notifications, and saves the open shifts."""
+    for name in ('dispatcher', 'scheduler', 'outbox_worker', 'presence'):
+        worker = application.bot_data.get(name)
+        if worker:
+            await worker.stop()
+
+async def post_shutdown(application: Application) -> None:
+    """Closes the notification client and stops the database executor."""
+    notifier = application.bot_data.pop('notifier', None)
+    if notifier:
+        await notifier.close()
+    shutdown_executor()
+
+def build_application(config: dict, request: BaseRequest | None = None) -> Application | None:
+    """Builds the driver bot application from the parsed config.json."""
+    driver_token = config.get('DRIVER_TELEGRAM_TOKEN')
+    client_token = config.get('CLIENT_TELEGRAM_TOKEN')
+    order_channel_id = config.get('ORDER_CHANNEL_ID')
 
     if not driver_token or driver_token == "YOUR_DRIVER_TOKEN_HERE":
         logger.error("DRIVER_TELEGRAM_TOKEN not found or is a placeholder in config.json.")
-        return
-
-    application = Application.builder().token(driver_token).post_init(post_init).build()
+        return None
+
+    set_timezone(config.get('TIMEZONE', TIMEZONE))
+    persistence = SQLitePersistence("driver", flush_interval=config.get('PERSISTENCE_FLUSH_INTERVAL', FLUSH_INTERVAL))
+    update_processor = KeyedUpdateProcessor(config.get('CONCURRENT_UPDATES', CONCURRENT_UPDATES))
+    builder = Application.builder().token(driver_token)
+    if config.get('BOT_API_URL'):
+        # Self-hosted or fake Bot API server instead of api.telegram.org
+        builder = builder.base_url(f"{config['BOT_API_URL']}/bot")
+    # Shared connection pool when several bots run in one process; every
+    # Bot API call is timed either way
+    builder = builder.request(InstrumentedRequest(request or HTTPXRequest(connection_pool_size=256), "driver"))
+    application = (
+        builder
+        .persistence(persistence)
+        .concurrent_updates(update_processor)
+        .post_init(post_init)
+        .post_stop(post_stop)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
     application.bot_data['CLIENT_TELEGRAM_TOKEN'] = client_token
+    application.bot_data['BOT_API_URL'] = config.get('BOT_API_URL') or TELEGRAM_API_URL
+    application.bot_data['RELEASE_LEAD'] = config.get('RELEASE_LEAD', RELEASE_LEAD)
+    # Order pushes and shift notices share the driver bot's Bot API rate limit
+    application.bot_data['send_limiter'] = RateLimiter(config.get('DRIVER_SEND_RATE', GLOBAL_RATE))
+    application.bot_data['presence'] = PresenceRegistry(config.get('SHIFT_HEARTBEAT_TTL', HEARTBEAT_TTL))
+    application.bot_data['ORDER_EXPIRE_AFTER'] = config.get('ORDER_EXPIRE_AFTER', EXPIRE_AFTER)
+    application.bot_data['EXPIRY_SWEEP_INTERVAL'] = config.get('EXPIRY_SWEEP_INTERVAL', SWEEP_INTERVAL)
+    application.bot_data['NOTIFY_EXPIRED'] = config.get('NOTIFY_EXPIRED', True)
+    if order_channel_id and order_channel_id != "YOUR_ORDER_CHANNEL_ID_HERE":
+        application.bot_data['ORDER_CHANNEL_ID'] = order_channel_id
 
     registration_conv = ConversationHandler(
         entry_points=[CommandHandler("start", start)],
@@ -327,12 +571,45 @@ def main() -> None:
             CAR_NUMBER: [MessageHandler(filters.TEXT & ~filters.COMMAND, car_number_handler)],
         },
         fallbacks=[CommandHandler("start", start)],
+        name="driver_registration",
+        persistent=True,
     )
 
     application.add_handler(registration_conv)
     application.add_handler(CommandHandler("help", help_command))
+    application.add_handler(TypeHandler(Update, heartbeat), group=-1)
+    application.add_handler(CommandHandler("shift_start", shift_start))
+    application.add_handler(CommandHandler("shift_stop", shift_stop))
+    application.add_handler(CallbackQueryHandler(shift_city, pattern=r"^shift_city_\d+$"))
+    application.add_handler(CommandHandler("routes", routes_command))
+    application.add_handler(CallbackQueryHandler(routes_toggle, pattern=r"^routes_(route|tariff)_\d+$"))
+    application.add_handler(CallbackQueryHandler(routes_save, pattern=r"^routes_(save|all)$"))
+    application.add_handler(CallbackQueryHandler(orders_page, pattern=r"^orders_(after|before)_\d+$"))
     application.add_handler(CallbackQueryHandler(button))
 
+    instrument_handlers(application, "driver")
+    REGISTRY.expose("updates", "Update processing counters", update_processor.metrics, bot="driver")
+    REGISTRY.expose("persistence", "Write-behind persistence counters", persistence.metrics, bot="driver")
+    REGISTRY.expose("presence", "Driver shift counters", application.bot_data['presence'].metrics)
+    return application
+
+def main() -> None:
+    """Run the driver bot."""
+    try:
+        with open('config.json', 'r', encoding='utf-8') as f:
+            config = json.load(f)
+    except FileNotFoundError:
+        logger.error("config.json not found.")
+        return
+    except json.JSONDecodeError:
+        logger.error("Error decoding config.json.")
+        return
+
+    application = build_application(config)
+    if application is None:
+        return
+
+    initialize_database(config.get('STORAGE', {}))
     application.run_polling()
 
 if __name__ == "__main__":
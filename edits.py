@@ -0,0 +1,92 @@
+"""Coalescing of rapid message edits.
+
+Tapping the time picker's +/- buttons quickly produces a burst of
+``editMessageText`` calls for the same message, and Telegram answers bursts
+like that with 429 flood waits. ``EditCoalescer`` lets handlers update their
+state immediately, but the first edit of a message opens a short debounce
+window and only the latest render requested within it is sent. A user who
+keeps tapping still sees the picker move, at most once per window.
+"""
+import asyncio
+import logging
+
+from telegram.error import BadRequest
+
+logger = logging.getLogger(__name__)
+
+# Seconds to wait for further edits of the same message before sending
+EDIT_DEBOUNCE = 0.4
+
+
+class EditCoalescer:
+    """Debounces edits per message; only the last edit of each window is sent."""
+
+    def __init__(self, delay=EDIT_DEBOUNCE):
+        self.delay = delay
+        self.metrics = {"requested": 0, "sent": 0, "saved": 0, "failed": 0}
+        self._pending = {}
+        self._tasks = {}
+
+    def edit(self, chat_id, message_id, send):
+        """Schedules ``send`` (an async callable doing the edit), replacing any pending edit of the message."""
+        key = (chat_id, message_id)
+        self.metrics["requested"] += 1
+        if key in self._pending:
+            self.metrics["saved"] += 1
+        self._pending[key] = send
+        if key not in self._tasks:
+            self._tasks[key] = asyncio.create_task(self._send_later(key), name=f"edit-{chat_id}-{message_id}")
+
+    async def _send(self, key, send):
+        try:
+            await send()
+            self.metrics["sent"] += 1
+        except BadRequest as e:
+            # The message already shows this render
+            if "not modified" not in str(e):
+                self.metrics["failed"] += 1
+                logger.warning(f"Failed to edit message {key}: {e}")
+        except Exception as e:
+            self.metrics["failed"] += 1
+            logger.warning(f"Failed to edit message {key}: {e}")
+
+    async def _send_later(self, key):
+        try:
+            # Edits requested while the previous one was being sent start a new window
+            while key in self._pending:
+                await asyncio.sleep(self.delay)
+                await self._send(key, self._pending.pop(key))
+        finally:
+            self._tasks.pop(key, None)
+
+    async def discard(self, chat_id, message_id=None):
+        """Drops pending edits of a message (or of every message in the chat).
+
+        Call it before replacing the message some other way, so that a late
+        edit cannot overwrite the new content. An edit already being sent is
+        waited for.
+        """
+        keys = [key for key in self._tasks if key[0] == chat_id and message_id in (None, key[1])]
+        for key in keys:
+            task = self._tasks[key]
+            if self._pending.pop(key, None) is not None:
+                self.metrics["saved"] += 1
+                task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+
+    async def flush(self):
+        """Sends every pending edit now, e.g. before shutting down."""
+        for key in list(self._tasks):
+            task = self._tasks[key]
+            send = self._pending.pop(key, None)
+            if send is not None:
+                task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+            if send is not None:
+                await self._send(key, send)
@@ -0,0 +1,73 @@
+"""Expiry of waiting orders that nobody took.
+
+An order still 'Ожидает' ``expire_after`` seconds past its trip time will
+not be taken any more, yet it would stay in every driver's feed and in
+every scan of waiting orders. ``OrderSweeper`` runs as a repeating job on
+the driver bot's job queue; each tick is one UPDATE over the partial index
+on waiting trip times that marks such orders 'Истёк', at most
+``batch_size`` of them, and queues one notice per client in the outbox
+in the same transaction. The driver bot then drops the expired orders from
+its matching index and release scheduler.
+"""
+import logging
+import time
+from datetime import timedelta
+
+from async_database import expire_orders
+from database import EXPIRE_BATCH_SIZE
+from metrics import REGISTRY
+from scheduling import TRIP_TIME_FORMAT, local_now
+
+logger = logging.getLogger(__name__)
+
+# Seconds past the trip time after which a waiting order expires
+EXPIRE_AFTER = 3600.0
+# Seconds between sweeps
+SWEEP_INTERVAL = 60.0
+# Bucket bounds of the rows-per-sweep histogram
+SWEEP_ROW_BUCKETS = (0, 1, 5, 10, 50, 100, 500, 1000)
+
+
+class OrderSweeper:
+    """Expires overdue waiting orders, one bulk update per ``run``.
+
+    ``notification(rows)`` formats the notice for one client's expired
+    orders, or is None to expire silently; ``on_expired(rows)`` is called with the
+    rows of every sweep that expired something.
+    """
+
+    def __init__(self, expire_after=EXPIRE_AFTER, batch_size=EXPIRE_BATCH_SIZE, notification=None, on_expired=None):
+        self.expire_after = expire_after
+        self.batch_size = batch_size
+        self.notification = notification
+        self.on_expired = on_expired
+        self.metrics = {"sweeps": 0, "expired": 0, "last_rows": 0, "last_seconds": 0.0}
+        self._seconds = REGISTRY.histogram("expiry_sweep_seconds", "Duration of one expiry sweep")
+        self._rows = REGISTRY.histogram("expiry_sweep_rows", "Orders expired per sweep", buckets=SWEEP_ROW_BUCKETS)
+
+    def cutoff(self, now=None):
+        """Waiting orders with a trip time before this stored value are expired."""
+        return ((now or local_now()) - timedelta(seconds=self.expire_after)).strftime(TRIP_TIME_FORMAT)
+
+    async def sweep(self):
+        """Expires what is overdue now. Returns the expired order rows."""
+        start = time.perf_counter()
+        expired = await expire_orders(self.cutoff(), self.batch_size, self.notification)
+        elapsed = time.perf_counter() - start
+
+        self._seconds.observe(elapsed)
+        self._rows.observe(len(expired))
+        self.metrics["sweeps"] += 1
+        self.metrics["expired"] += len(expired)
+        self.metrics["last_rows"] = len(expired)
+        self.metrics["last_seconds"] = elapsed
+        if expired and self.on_expired is not None:
+            self.on_expired(expired)
+        return expired
+
+    async def run(self, context):
+        """Job queue callback."""
+        try:
+            await self.sweep()
+        except Exception as e:
+            logger.error(f"Expiry sweep failed: {e}")
@@ -0,0 +1,167 @@
+"""A local stand-in for the Telegram Bot API, for benchmarks and manual runs.
+
+``FakeBotApi`` is a small HTTP/1.1 server that answers Bot API calls the
+way Telegram does, after a configurable random delay, and remembers every
+call. Point the bots at it with ``BOT_API_URL`` in config.json; since the
+server never produces updates, they are fed to the applications directly
+(``benchmark.py e2e``) or through the webhook.
+
+Usage:
+    python fake_bot_api.py [--port N] [--latency S]
+"""
+import argparse
+import asyncio
+import collections
+import json
+import logging
+import random
+import re
+import time
+from urllib.parse import parse_qsl
+
+logger = logging.getLogger(__name__)
+
+# Server defaults
+LISTEN = "127.0.0.1"
+PORT = 8081
+LATENCY = 0.02
+
+REQUEST_PATH = re.compile(r"^/bot(?P<token>[^/]+)/(?P<method>\w+)$")
+
+
+def _parameters(content_type, body):
+    """Decodes a JSON or form encoded request body; form values hold JSON themselves."""
+    if not body:
+        return {}
+    if content_type.startswith("application/json"):
+        return json.loads(body)
+    parameters = {}
+    for key, value in parse_qsl(body.decode()):
+        try:
+            parameters[key] = json.loads(value)
+        except ValueError:
+            parameters[key] = value
+    return parameters
+
+
+class FakeBotApi:
+    """Answers Bot API calls of any number of bots after about ``latency`` seconds.
+
+    The delay varies from call to call (uniformly up to twice ``latency``),
+    so concurrent calls finish out of order as they do against Telegram.
+    ``calls`` counts calls per (token, method); ``messages`` receives a
+    ``(token, method, parameters)`` tuple for every sendMessage and
+    editMessageText, so scripted users can react to what the bots send.
+    """
+
+    def __init__(self, listen=LISTEN, port=PORT, latency=LATENCY, seed=42):
+        self.listen = listen
+        self.port = port
+        self.latency = latency
+        self.calls = collections.Counter()
+        self.messages = asyncio.Queue()
+        self._random = random.Random(seed)
+        self._message_ids = collections.Counter()
+        self._server = None
+
+    @property
+    def url(self):
+        return f"http://{self.listen}:{self.port}"
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle_connection, self.listen, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        logger.info(f"Fake Bot API listening on {self.url}")
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    def answer(self, token, method, parameters):
+        """The ``result`` of a successful call."""
+        if method == "getMe":
+            bot_id = int(token.split(":")[0]) if token.split(":")[0].isdigit() else 1
+            return {"id": bot_id, "is_bot": True, "first_name": "Fake", "username": f"fake_{bot_id}_bot"}
+        if method in ("sendMessage", "editMessageText"):
+            chat_id = parameters.get("chat_id", 1)
+            if "message_id" in parameters:
+                message_id = parameters["message_id"]
+            else:
+                self._message_ids[chat_id] += 1
+                message_id = self._message_ids[chat_id]
+            self.messages.put_nowait((token, method, parameters))
+            chat = {"id": chat_id, "type": "private" if isinstance(chat_id, int) and chat_id > 0 else "channel"}
+            return {"message_id": message_id, "date": int(time.time()), "chat": chat, "text": parameters.get("text", "")}
+        return True
+
+    async def _handle_connection(self, reader, writer):
+        try:
+            # Keep-alive: serve requests on this connection until the client closes it
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                headers = {}
+                while (line := await reader.readline()) not in (b"\r\n", b"\n", b""):
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+
+                status, payload = await self._respond(request_line.decode("latin-1").split(), headers, body)
+                writer.write(
+                    f"HTTP/1.1 {status}\r\n"
+                    f"Content-Type: application/json\r\n"
+                    f"Content-Length: {len(payload)}\r\n\r\n".encode() + payload
+                )
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError) as e:
+            logger.debug(f"Dropping connection: {e}")
+        finally:
+            writer.close()
+
+    async def _respond(self, request_line, headers, body):
+        match = REQUEST_PATH.match(request_line[1]) if len(request_line) >= 2 else None
+        if match is None:
+            return "404 Not Found", json.dumps({"ok": False, "error_code": 404, "description": "Not Found"}).encode()
+
+        token, method = match.group("token"), match.group("method")
+        try:
+            parameters = _parameters(headers.get("content-type", ""), body)
+        except ValueError:
+            return "400 Bad Request", json.dumps({"ok": False, "error_code": 400, "description": "Bad Request"}).encode()
+
+        await asyncio.sleep(self._random.uniform(0, 2 * self.latency))
+        self.calls[(token, method)] += 1
+        return "200 OK", json.dumps({"ok": True, "result": self.answer(token, method, parameters)}).encode()
+
+
+async def serve(port, latency):
+    api = FakeBotApi(port=port, latency=latency)
+    await api.start()
+    print(f"Fake Bot API on {api.url}; set \"BOT_API_URL\": \"{api.url}\" in config.json. Press Ctrl+C to stop.")
+    try:
+        while True:
+            # Nobody reads the sent messages here; keep the queue from growing
+            token, method, parameters = await api.messages.get()
+            logger.info(f"{method} to {parameters.get('chat_id')}: {parameters.get('text', '')[:60]!r}")
+    finally:
+        await api.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--latency", type=float, default=LATENCY, help="mean seconds per call")
+    args = parser.parse_args()
+
+    logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO)
+    try:
+        asyncio.run(serve(args.port, args.latency))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+"""Fare quotes for every route and tariff.
+
+Prices come from a JSON file (``fares.json`` by default, ``FARES_FILE`` in
+config.json): road distances between the cities, a base fare, a price per
+kilometre and a minimum fare per tariff, and optional time-of-day surge
+multipliers. ``FareTable`` turns them into a dense CITIES x CITIES x TARIFFS
+price matrix at startup, one per distinct multiplier, plus the multiplier of
+every minute of the day, so a quote is a few list lookups and never does
+arithmetic on the hot path.
+"""
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+FARES_FILE = "fares.json"
+# Prices are rounded to this many rubles
+ROUNDING = 10
+
+MINUTES_PER_DAY = 24 * 60
+
+
+def format_price(price):
+    """A price in rubles for people: "2 200 ₽"."""
+    return f"{price:,} ₽".replace(",", " ")
+
+
+def _minute_of_day(value):
+    """Minutes since midnight of an "HH:MM" time, or of a stored "YYYY-MM-DD HH:MM" trip time."""
+    hour, minute = value[-5:].split(":")
+    return (int(hour) * 60 + int(minute)) % MINUTES_PER_DAY
+
+
+def _round(value, rounding):
+    return int((value + rounding / 2) // rounding * rounding)
+
+
+class FareTable:
+    """Precomputed prices of every (from_city, to_city, tariff), with surge by time of day.
+
+    ``settings`` is the parsed fares file. Routes without a known distance
+    and tariffs without rates have no price: ``quote`` returns None for them
+    and the client bot then shows no price.
+    """
+
+    def __init__(self, cities, tariffs, settings=None):
+        settings = settings or {}
+        self.cities = list(cities)
+        self.tariffs = list(tariffs)
+        self.metrics = {"quotes": 0, "unpriced": 0}
+        self._city_index = {city: i for i, city in enumerate(self.cities)}
+        self._tariff_index = {tariff: i for i, tariff in enumerate(self.tariffs)}
+        self._rounding = settings.get("rounding", ROUNDING)
+
+        base = self._base_prices(settings.get("distances_km", {}), settings.get("tariffs", {}))
+        self._surge = self._surge_by_minute(settings.get("surge", []))
+        # One flat matrix per multiplier in use, indexed by _offset()
+        self._matrices = {
+            multiplier: [None if price is None else _round(price * multiplier, self._rounding) for price in base]
+            for multiplier in set(self._surge) | {1.0}
+        }
+        self._base = self._matrices[1.0]
+
+    def _offset(self, from_city, to_city, tariff):
+        """Position of a route and tariff in the flat matrices, or None if any of them is unknown."""
+        try:
+            return ((self._city_index[from_city] * len(self.cities) + self._city_index[to_city]) * len(self.tariffs)
+                    + self._tariff_index[tariff])
+        except KeyError:
+            return None
+
+    def _base_prices(self, distances, rates):
+        """Unrounded prices without surge, in matrix order."""
+        # Distances are symmetric unless both directions are given
+        kilometres = {}
+        for from_city, destinations in distances.items():
+            for to_city, distance in destinations.items():
+                if from_city not in self._city_index or to_city not in self._city_index:
+                    logger.warning(f"Ignoring the distance {from_city} → {to_city}: unknown city")
+                    continue
+                kilometres[(from_city, to_city)] = distance
+                kilometres.setdefault((to_city, from_city), distance)
+        for tariff in rates:
+            if tariff not in self._tariff_index:
+                logger.warning(f"Ignoring the rates of unknown tariff {tariff}")
+
+        prices = []
+        for from_city in self.cities:
+            for to_city in self.cities:
+                distance = kilometres.get((from_city, to_city)) if from_city != to_city else None
+                for tariff in self.tariffs:
+                    rate = rates.get(tariff)
+                    if distance is None or rate is None:
+                        prices.append(None)
+                        continue
+                    price = rate.get("base", 0) + rate.get("per_km", 0) * distance
+                    prices.append(max(price, rate.get("minimum", 0)))
+        return prices
+
+    def _surge_by_minute(self, periods):
+        """The multiplier of every minute of the day; a period may wrap around midnight."""
+        surge = [1.0] * MINUTES_PER_DAY
+        for period in periods:
+            try:
+                start, end = _minute_of_day(period["from"]), _minute_of_day(period["to"])
+                multiplier = float(period["multiplier"])
+            except (KeyError, TypeError, ValueError) as e:
+                logger.warning(f"Ignoring the surge period {period}: {e}")
+                continue
+            minute = start
+            while minute != end:
+                surge[minute] = multiplier
+                minute = (minute + 1) % MINUTES_PER_DAY
+        return surge
+
+    def surge(self, trip_time):
+        """The multiplier at a trip time ("HH:MM" or stored "YYYY-MM-DD HH:MM")."""
+        try:
+            return self._surge[_minute_of_day(trip_time)]
+        except (TypeError, ValueError):
+            return 1.0
+
+    def base_price(self, from_city, to_city, tariff):
+        """The price without surge, or None if the route or tariff has no price."""
+        offset = self._offset(from_city, to_city, tariff)
+        return self._base[offset] if offset is not None else None
+
+    def quote(self, from_city, to_city, tariff, trip_time=None):
+        """The price of a trip, with the surge at ``trip_time`` if given; None if unpriced."""
+        self.metrics["quotes"] += 1
+        offset = self._offset(from_city, to_city, tariff)
+        if offset is None:
+            self.metrics["unpriced"] += 1
+            return None
+        matrix = self._matrices[self.surge(trip_time)] if trip_time is not None else self._base
+        price = matrix[offset]
+        if price is None:
+            self.metrics["unpriced"] += 1
+        return price
+
+    def prices(self, from_city, to_city):
+        """Tariff -> price without surge for one route, e.g. for the tariff keyboard."""
+        return {tariff: self.base_price(from_city, to_city, tariff) for tariff in self.tariffs}
+
+
+def load_fares(cities, tariffs, path=FARES_FILE):
+    """Reads the fares file into a FareTable; without a readable file nothing is priced."""
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            settings = json.load(f)
+    except (OSError, ValueError) as e:
+        logger.error(f"Failed to load fares from {path}, orders will have no price: {e}")
+        settings = {}
+    return FareTable(cities, tariffs, settings)
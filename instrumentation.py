@@ -0,0 +1,74 @@
+"""Metrics for the Telegram side of the bots: handler timings and Bot API calls.
+
+``instrument_handlers`` wraps every handler callback of an application,
+including those nested in conversation handlers, in a timing histogram.
+``InstrumentedRequest`` wraps the request object a ``Bot`` uses, recording
+the latency of every Bot API call and counting 429 (flood wait) answers.
+"""
+import time
+
+from telegram.ext import ConversationHandler
+from telegram.request import BaseRequest
+
+from metrics import REGISTRY, timed
+
+TELEGRAM_LATENCY = "telegram_request_seconds"
+TELEGRAM_LATENCY_HELP = "Bot API call latency by bot and method"
+TELEGRAM_RATE_LIMITED = "telegram_rate_limited_total"
+TELEGRAM_RATE_LIMITED_HELP = "Bot API calls answered with 429 Too Many Requests"
+
+
+def observe_telegram_call(bot, method, seconds, status_code):
+    """Records one Bot API call; shared with the notification client."""
+    REGISTRY.histogram(TELEGRAM_LATENCY, TELEGRAM_LATENCY_HELP, bot=bot, method=method).observe(seconds)
+    if status_code == 429:
+        REGISTRY.counter(TELEGRAM_RATE_LIMITED, TELEGRAM_RATE_LIMITED_HELP, bot=bot, method=method).inc()
+
+
+class InstrumentedRequest(BaseRequest):
+    """Delegates to another request object and records every call's latency and status."""
+
+    def __init__(self, request, bot):
+        self.request = request
+        self.bot = bot
+
+    @property
+    def read_timeout(self):
+        return self.request.read_timeout
+
+    async def initialize(self):
+        await self.request.initialize()
+
+    async def shutdown(self):
+        await self.request.shutdown()
+
+    async def do_request(self, url, method, request_data=None, **kwargs):
+        start = time.perf_counter()
+        status_code = None
+        try:
+            status_code, payload = await self.request.do_request(url, method, request_data, **kwargs)
+            return status_code, payload
+        finally:
+            observe_telegram_call(self.bot, url.rsplit("/", 1)[-1], time.perf_counter() - start, status_code)
+
+
+def _handlers(handler):
+    if isinstance(handler, ConversationHandler):
+        nested = handler.entry_points + [h for hs in handler.states.values() for h in hs] + handler.fallbacks
+        for child in nested:
+            yield from _handlers(child)
+    else:
+        yield handler
+
+
+def instrument_handlers(application, bot):
+    """Records the run time of every handler callback of ``application``."""
+    wrapped = {}
+    for group in application.handlers.values():
+        for top_level in group:
+            for handler in _handlers(top_level):
+                callback = handler.callback
+                # The same callback may serve several handlers; wrap it only once
+                if callback not in wrapped:
+                    wrapped[callback] = timed("handler_seconds", "Handler run time by bot and callback", bot=bot)(callback)
+                handler.callback = wrapped[callback]
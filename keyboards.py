@@ -0,0 +1,92 @@
+"""Inline keyboards of the client bot, built once instead of on every callback.
+
+Telegram objects are immutable once created, so a single markup instance
+can be sent to any number of users. ``Keyboards`` builds every static menu
+of the order flow at startup, including one time picker per (hour, minute)
+the +/- buttons can reach and one tariff choice per route with its prices.
+"""
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup, KeyboardButton, ReplyKeyboardMarkup
+
+from fares import format_price
+
+# The time picker moves minutes in steps of this size
+MINUTE_STEP = 15
+
+
+def main_menu_keyboard():
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("Заказать такси", callback_data="new_order")],
+        [InlineKeyboardButton("Мои заказы", callback_data="my_orders")],
+        [InlineKeyboardButton("Поддержка", callback_data="support")],
+        [InlineKeyboardButton("Правила", callback_data="rules")],
+    ])
+
+
+def choice_keyboard(options):
+    """One button per option, each sending the option itself as callback data."""
+    return InlineKeyboardMarkup([[InlineKeyboardButton(option, callback_data=option)] for option in options])
+
+
+def tariff_keyboard(tariffs, prices=None):
+    """One button per tariff, labelled with its price from ``prices`` (tariff -> rubles) when known."""
+    prices = prices or {}
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton(
+            f"{tariff} · {format_price(prices[tariff])}" if prices.get(tariff) is not None else tariff,
+            callback_data=tariff,
+        )]
+        for tariff in tariffs
+    ])
+
+
+def contact_keyboard():
+    contact_button = KeyboardButton("Поделиться номером телефона", request_contact=True)
+    return ReplyKeyboardMarkup([[contact_button]], one_time_keyboard=True, resize_keyboard=True)
+
+
+def time_picker_keyboard(hour, minute):
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("+", callback_data="hour_up"), InlineKeyboardButton("+", callback_data="minute_up")],
+        [InlineKeyboardButton(f"{hour:02d}:{minute:02d}", callback_data="time_display")],
+        [InlineKeyboardButton("-", callback_data="hour_down"), InlineKeyboardButton("-", callback_data="minute_down")],
+        [InlineKeyboardButton("Подтвердить", callback_data="confirm_time")],
+    ])
+
+
+class Keyboards:
+    """Registry of the prebuilt keyboards for the given cities and tariffs."""
+
+    def __init__(self, cities, tariffs, fares=None):
+        self.cities = cities
+        self.tariffs = tariffs
+        self.main_menu = main_menu_keyboard()
+        self.city_from = choice_keyboard(cities)
+        # Destination choices exclude the departure city
+        self.city_to = {city: choice_keyboard([other for other in cities if other != city]) for city in cities}
+        self.set_fares(fares)
+        self.contact = contact_keyboard()
+        self.time_picker = {
+            (hour, minute): time_picker_keyboard(hour, minute)
+            for hour in range(24)
+            for minute in range(0, 60, MINUTE_STEP)
+        }
+
+    def set_fares(self, fares):
+        """Rebuilds the tariff choice of every route with its prices from a FareTable (or none)."""
+        self.tariff = {
+            (from_city, to_city): tariff_keyboard(self.tariffs, fares.prices(from_city, to_city) if fares else None)
+            for from_city in self.cities
+            for to_city in self.cities
+            if from_city != to_city
+        }
+
+    def tariffs_for(self, from_city, to_city):
+        """The tariff choice for a route."""
+        markup = self.tariff.get((from_city, to_city))
+        return markup if markup is not None else tariff_keyboard(self.tariffs)
+
+    def time(self, hour, minute):
+        """The time picker showing ``hour:minute``."""
+        markup = self.time_picker.get((hour, minute))
+        # Off-grid times, e.g. restored from older persisted data, are rare
+        return markup if markup is not None else time_picker_keyboard(hour, minute)
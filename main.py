@@ -1,28 +1,89 @@
+import asyncio
+import json
+import logging
+import signal
 
-import subprocess
-import sys
+from telegram.request import HTTPXRequest
 
-def main():
-    """Runs both the client and driver bots in parallel."""
+from metrics import MetricsServer
+from runner import run_applications, supervise
+
+# Scripts started by the supervised multi-process mode
+BOT_SCRIPTS = ["bot.py", "driver_bot.py"]
+
+def read_config():
+    """Reads config.json; the bots report a missing or broken file themselves."""
     try:
-        print("Starting client bot...")
-        client_bot_process = subprocess.Popen([sys.executable, "bot.py"])
-        
-        print("Starting driver bot...")
-        driver_bot_process = subprocess.Popen([sys.executable, "driver_bot.py"])
-        
-        print("Both bots are running. Press Ctrl+C to stop.")
-        
-        # Wait for the processes to complete
-        client_bot_process.wait()
-        driver_bot_process.wait()
-        
-    except KeyboardInterrupt:
-        print("\nStopping both bots...")
-        client_bot_process.terminate()
-        driver_bot_process.terminate()
+        with open('config.json', 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+def build_applications(config):
+    """Builds both bots sharing one Bot API connection pool, or None on bad config."""
+    import bot
+    import driver_bot
+    from database import initialize_database
+
+    request = HTTPXRequest(connection_pool_size=config.get('HTTP_POOL_SIZE', 256))
+    bots = {
+        "client": bot.build_application(config, request=request),
+        "driver": driver_bot.build_application(config, request=request),
+    }
+    if None in bots.values():
+        return None
+
+    initialize_database(config.get('STORAGE', {}))
+    return bots
+
+async def serve(bots, config):
+    """Runs the bots in this loop until SIGINT/SIGTERM."""
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+
+    # Prometheus text endpoint on localhost, only when METRICS_PORT is set
+    metrics_server = None
+    if config.get('METRICS_PORT'):
+        metrics_server = MetricsServer(config.get('METRICS_LISTEN', '127.0.0.1'), config['METRICS_PORT'])
+        await metrics_server.start()
+
+    try:
+        if config.get('MODE') == 'webhook':
+            from webhook import run_webhook
+            await run_webhook(bots, config['WEBHOOK'], stop_event)
+        else:
+            await run_applications(list(bots.values()), stop_event)
+    finally:
+        if metrics_server is not None:
+            await metrics_server.stop()
+
+def main():
+    """Runs both the client and driver bots.
+
+    MODE in config.json selects how: "single" (default) polls both bots in
+    one process, "webhook" serves both from one webhook server, and
+    "supervised" runs each bot in its own process and restarts it on a crash.
+    """
+    logging.basicConfig(
+        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
+    )
+    config = read_config()
+
+    if config.get('MODE') == 'supervised':
+        print("Starting both bots as supervised processes. Press Ctrl+C to stop.")
+        supervise(BOT_SCRIPTS)
         print("Bots stopped.")
+        return
+
+    bots = build_applications(config)
+    if bots is None:
+        return
+
+    print(f"Both bots are running in {config.get('MODE', 'single')} mode. Press Ctrl+C to stop.")
+    asyncio.run(serve(bots, config))
+    print("Bots stopped.")
 
 if __name__ == "__main__":
     main()
-
@@ -0,0 +1,158 @@
+"""Matching of waiting orders to drivers by route and tariff.
+
+Drivers declare the routes (from_city, to_city) and tariffs they serve in
+the ``driver_routes`` table; a driver who declared nothing serves every
+route. ``MatchingIndex`` keeps the waiting orders of the driver bot's
+process in memory, bucketed by (from_city, to_city, tariff), together with
+the drivers serving each bucket. A driver's feed and the fan-out of a new
+order then only touch matching orders and drivers instead of scanning every
+waiting order or every driver.
+
+The index is loaded from the database at startup and kept in sync by the
+driver bot: new orders arrive through the dispatcher and accepted orders
+are removed as they are accepted. Orders that became waiting by other means
+(e.g. a bulk import) show up after the next restart.
+"""
+import bisect
+import heapq
+import itertools
+
+# The service area; the client bot offers exactly these choices
+CITIES = ["Октябрьский", "Туймазы", "Уфа"]
+TARIFFS = ["Стандарт", "Комфорт", "Бизнес"]
+
+# Every route a driver can declare, in menu order
+ROUTES = [(from_city, to_city) for from_city in CITIES for to_city in CITIES if from_city != to_city]
+
+
+def order_route(order):
+    """The matching key of an order row: (from_city, to_city, tariff)."""
+    return order[2], order[3], order[4]
+
+
+class MatchingIndex:
+    """Waiting orders and the drivers serving them, bucketed by (from_city, to_city, tariff).
+
+    Each bucket is a sorted list of order ids, so a page of a driver's feed
+    bisects to its start in every bucket the driver serves and merges at
+    most ``limit`` ids from each, whatever the page's offset. Drivers
+    without declared routes page through the sorted ids of all orders.
+    """
+
+    def __init__(self):
+        self.metrics = {"orders": 0, "drivers": 0, "restricted_drivers": 0, "fan_outs": 0, "recipients": 0}
+        self._waiting = {}
+        self._ids = []
+        self._buckets = {}
+        self._routes = {}
+        self._subscribers = {}
+        self._unrestricted = set()
+
+    def load(self, orders, driver_ids, routes):
+        """Replaces the contents with waiting order rows, all driver IDs and
+        (telegram_id, from_city, to_city, tariff) rows of declared routes."""
+        self._waiting.clear()
+        self._ids.clear()
+        self._buckets.clear()
+        self._routes.clear()
+        self._subscribers.clear()
+        self._unrestricted = set(driver_ids)
+        for order in sorted(orders):
+            self.add_order(order)
+        declared = sorted(routes)
+        for driver_id, driver_routes in itertools.groupby(declared, key=lambda row: row[0]):
+            self.set_routes(driver_id, [row[1:] for row in driver_routes])
+        self._update_metrics()
+
+    def _update_metrics(self):
+        self.metrics["orders"] = len(self._waiting)
+        self.metrics["restricted_drivers"] = len(self._routes)
+        self.metrics["drivers"] = len(self._routes) + len(self._unrestricted)
+
+    def add_order(self, order):
+        """Adds a waiting order row; adding it again is a no-op."""
+        order_id = order[0]
+        if order_id in self._waiting:
+            return
+        self._waiting[order_id] = order
+        # New orders have the highest id, so this is usually an append
+        bisect.insort(self._ids, order_id)
+        bisect.insort(self._buckets.setdefault(order_route(order), []), order_id)
+        self.metrics["orders"] = len(self._waiting)
+
+    def remove_order(self, order_id):
+        """Forgets an order that is no longer waiting."""
+        order = self._waiting.pop(order_id, None)
+        if order is None:
+            return
+        del self._ids[bisect.bisect_left(self._ids, order_id)]
+        route = order_route(order)
+        bucket = self._buckets[route]
+        del bucket[bisect.bisect_left(bucket, order_id)]
+        if not bucket:
+            del self._buckets[route]
+        self.metrics["orders"] = len(self._waiting)
+
+    def add_driver(self, driver_id):
+        """Registers a driver, who serves every route until declaring some."""
+        if driver_id not in self._routes:
+            self._unrestricted.add(driver_id)
+            self._update_metrics()
+
+    def rename_driver(self, old_id, new_id):
+        """Moves a driver's routes to a new Telegram ID."""
+        routes = self.routes_of(old_id)
+        self.set_routes(old_id, [])
+        self._unrestricted.discard(old_id)
+        self.add_driver(new_id)
+        self.set_routes(new_id, routes)
+
+    def routes_of(self, driver_id):
+        """The (from_city, to_city, tariff) keys a driver declared; empty means all."""
+        return set(self._routes.get(driver_id, ()))
+
+    def set_routes(self, driver_id, routes):
+        """Replaces a driver's declared routes; an empty list means every route."""
+        for route in self._routes.pop(driver_id, ()):
+            subscribers = self._subscribers[route]
+            subscribers.discard(driver_id)
+            if not subscribers:
+                del self._subscribers[route]
+        routes = {tuple(route) for route in routes}
+        if routes:
+            self._unrestricted.discard(driver_id)
+            self._routes[driver_id] = routes
+            for route in routes:
+                self._subscribers.setdefault(route, set()).add(driver_id)
+        else:
+            self._unrestricted.add(driver_id)
+        self._update_metrics()
+
+    def drivers_for(self, order):
+        """The drivers an order should be offered to."""
+        drivers = self._unrestricted | self._subscribers.get(order_route(order), set())
+        self.metrics["fan_outs"] += 1
+        self.metrics["recipients"] += len(drivers)
+        return drivers
+
+    def orders_for(self, driver_id, after_id=0, before_id=None, limit=10):
+        """One page of the orders a driver can take, ascending by id.
+
+        Keyset paging: ``after_id`` for the next page, ``before_id`` for the
+        previous one.
+        """
+        if driver_id in self._routes:
+            buckets = [self._buckets[route] for route in self._routes[driver_id] if route in self._buckets]
+        else:
+            buckets = [self._ids]
+
+        if before_id is not None:
+            ends = [(bucket, bisect.bisect_left(bucket, before_id)) for bucket in buckets]
+            ids = heapq.merge(*(reversed(bucket[max(0, end - limit):end]) for bucket, end in ends), reverse=True)
+            page = [self._waiting[order_id] for order_id in itertools.islice(ids, limit)]
+            page.reverse()
+            return page
+
+        starts = [(bucket, bisect.bisect_right(bucket, after_id)) for bucket in buckets]
+        ids = heapq.merge(*(bucket[start:start + limit] for bucket, start in starts))
+        return [self._waiting[order_id] for order_id in itertools.islice(ids, limit)]
@@ -0,0 +1,263 @@
+"""In-process metrics: counters, gauges and histograms with a Prometheus text view.
+
+Instruments are cheap enough to stay on in production: an observation is a
+``perf_counter`` call, a bisect over the bucket bounds and a short locked
+update. Everything lives in the process-wide ``REGISTRY``; ``MetricsServer``
+optionally serves it as Prometheus text on a local port.
+"""
+import asyncio
+import bisect
+import functools
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Histogram bucket bounds in seconds, from a warm SQLite lookup to a slow Bot API call
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Metrics server defaults
+LISTEN = "127.0.0.1"
+PORT = 9100
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in labels.items()) + "}"
+
+
+class Counter:
+    """A value that only goes up."""
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def samples(self, name, labels):
+        yield name, labels, self.value
+
+
+class Gauge:
+    """A value that goes up and down."""
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+    def samples(self, name, labels):
+        yield name, labels, self.value
+
+
+class Histogram:
+    """Counts observations per bucket, Prometheus style."""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def percentile(self, percent):
+        """Upper bound of the bucket holding the given percentile (None without data)."""
+        if not self.count:
+            return None
+        rank = self.count * percent / 100
+        seen = 0
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+    def samples(self, name, labels):
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            yield f"{name}_bucket", {**labels, "le": repr(bound)}, cumulative
+        yield f"{name}_bucket", {**labels, "le": "+Inf"}, self.count
+        yield f"{name}_sum", labels, self.sum
+        yield f"{name}_count", labels, self.count
+
+
+class Registry:
+    """All metrics of the process, grouped in families by name."""
+
+    def __init__(self):
+        self._families = {}
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def _get(self, kind, name, description, labels, factory):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            family = self._families.setdefault(name, (kind, description, {}))
+            if family[0] != kind:
+                raise ValueError(f"Metric {name} is already registered as a {family[0]}")
+            metrics = family[2]
+            if key not in metrics:
+                metrics[key] = factory()
+            return metrics[key]
+
+    def counter(self, name, description, **labels):
+        return self._get("counter", name, description, labels, Counter)
+
+    def gauge(self, name, description, **labels):
+        return self._get("gauge", name, description, labels, Gauge)
+
+    def histogram(self, name, description, buckets=DEFAULT_BUCKETS, **labels):
+        return self._get("histogram", name, description, labels, lambda: Histogram(buckets))
+
+    def histograms(self):
+        """Yields (name, labels, histogram) for every histogram, e.g. to print percentiles."""
+        with self._lock:
+            families = [(name, dict(metrics)) for name, (kind, _, metrics) in self._families.items()
+                        if kind == "histogram"]
+        for name, metrics in families:
+            for key, histogram in sorted(metrics.items()):
+                yield name, dict(key), histogram
+
+    def add_collector(self, collect):
+        """Registers ``collect()``, called on every render and yielding (name, description, labels, value) gauges."""
+        self._collectors.append(collect)
+
+    def expose(self, prefix, description, values, **labels):
+        """Publishes a component's plain ``metrics`` dict as ``<prefix>_<key>`` gauges."""
+        def collect():
+            for key, value in list(values.items()):
+                yield f"{prefix}_{key}", description, labels, value
+        self.add_collector(collect)
+
+    def collect(self):
+        """Yields (name, kind, description, [(sample name, labels, value), ...]) per family."""
+        with self._lock:
+            families = [(name, kind, description, dict(metrics))
+                        for name, (kind, description, metrics) in self._families.items()]
+        for name, kind, description, metrics in families:
+            samples = []
+            for key, metric in metrics.items():
+                samples.extend(metric.samples(name, dict(key)))
+            yield name, kind, description, samples
+
+        collected = {}
+        for collect in self._collectors:
+            try:
+                for name, description, labels, value in collect():
+                    collected.setdefault(name, (description, []))[1].append((name, labels, value))
+            except Exception as e:
+                logger.warning(f"Metrics collector failed: {e}")
+        for name, (description, samples) in collected.items():
+            yield name, "gauge", description, samples
+
+    def render(self):
+        """Returns all metrics in the Prometheus text exposition format."""
+        lines = []
+        for name, kind, description, samples in self.collect():
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} {kind}")
+            for sample_name, labels, value in samples:
+                lines.append(f"{sample_name}{_format_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+def timed(name, description, **labels):
+    """Decorator recording the run time of a function, sync or async, in a histogram.
+
+    The histogram gets a ``function`` label with the decorated function's name.
+    """
+    def decorator(func):
+        histogram = REGISTRY.histogram(name, description, function=func.__name__, **labels)
+
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    histogram.observe(time.perf_counter() - start)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - start)
+        return wrapper
+
+    return decorator
+
+
+class MetricsServer:
+    """Serves ``GET /metrics`` in Prometheus text format; meant for localhost only."""
+
+    def __init__(self, listen=LISTEN, port=PORT, registry=REGISTRY):
+        self.listen = listen
+        self.port = port
+        self.registry = registry
+        self._server = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle_connection, self.listen, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        logger.info(f"Metrics available at http://{self.listen}:{self.port}/metrics")
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _handle_connection(self, reader, writer):
+        try:
+            request_line = await reader.readline()
+            while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                pass
+            parts = request_line.decode("latin-1").split()
+            if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+                status, body = "200 OK", self.registry.render().encode()
+            else:
+                status, body = "404 Not Found", b""
+            writer.write(
+                f"HTTP/1.1 {status}\r\n"
+                f"Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                f"Connection: close\r\n\r\n".encode() + body
+            )
+            await writer.drain()
+        except ConnectionError as e:
+            logger.debug(f"Dropping metrics connection: {e}")
+        finally:
+            writer.close()
@@ -0,0 +1,270 @@
+"""Sending messages to clients through the client bot's token.
+
+The driver bot notifies clients from a different bot, so it cannot use its
+own ``Bot`` instance. ``NotificationClient`` is created once per application
+and reuses a pooled keep-alive (HTTP/2 when ``h2`` is installed) connection
+to the Bot API instead of opening a new one per notification. Handlers do not
+call it directly: they queue messages in the ``outbox`` table and an
+``OutboxWorker`` delivers them in the background.
+"""
+import asyncio
+import importlib.util
+import logging
+import time
+
+import httpx
+
+from async_database import get_due_notifications, mark_notifications_sent, reschedule_notification
+from instrumentation import observe_telegram_call
+
+logger = logging.getLogger(__name__)
+
+TELEGRAM_API_URL = "https://api.telegram.org"
+
+# Client defaults
+TIMEOUT = 10.0
+MAX_RETRIES = 3
+BACKOFF = 0.5
+MAX_CONNECTIONS = 20
+
+# Outbox worker defaults; Telegram allows roughly 30 messages per second
+# overall and about one per second to the same chat
+GLOBAL_RATE = 30.0
+PER_CHAT_INTERVAL = 1.0
+OUTBOX_BATCH_SIZE = 50
+OUTBOX_POLL_INTERVAL = 1.0
+OUTBOX_MAX_ATTEMPTS = 10
+OUTBOX_RETRY_BACKOFF = 5
+OUTBOX_MAX_BACKOFF = 300
+
+
+class NotificationError(Exception):
+    """Raised when a message could not be delivered after all retries.
+
+    ``retryable`` is False for errors that will not go away by themselves,
+    such as a client who blocked the bot.
+    """
+
+    def __init__(self, message, retryable=True):
+        super().__init__(message)
+        self.retryable = retryable
+
+
+class NotificationClient:
+    """Long-lived Bot API client with retries and simple counters.
+
+    Requests answered with 429 are retried after the ``retry_after`` the Bot
+    API asks for; 5xx responses and network errors are retried with
+    exponential backoff. Other errors are not retried.
+    """
+
+    def __init__(self, token, base_url=TELEGRAM_API_URL, timeout=TIMEOUT, max_retries=MAX_RETRIES,
+                 backoff=BACKOFF, max_connections=MAX_CONNECTIONS, transport=None):
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.metrics = {
+            "sent": 0,
+            "failed": 0,
+            "retries": 0,
+            "rate_limited": 0,
+            "request_count": 0,
+            "request_seconds": 0.0,
+        }
+        self._client = httpx.AsyncClient(
+            base_url=f"{base_url}/bot{token}",
+            timeout=httpx.Timeout(timeout),
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_connections,
+                keepalive_expiry=60.0,
+            ),
+            http2=transport is None and importlib.util.find_spec("h2") is not None,
+            transport=transport,
+        )
+
+    async def _post(self, method, payload):
+        start = time.perf_counter()
+        status_code = None
+        try:
+            response = await self._client.post(f"/{method}", json=payload)
+            status_code = response.status_code
+            return response
+        finally:
+            elapsed = time.perf_counter() - start
+            self.metrics["request_count"] += 1
+            self.metrics["request_seconds"] += elapsed
+            observe_telegram_call("notifier", method, elapsed, status_code)
+
+    async def call(self, method, payload):
+        """Calls a Bot API method and returns its ``result``."""
+        for attempt in range(self.max_retries + 1):
+            try:
+                response = await self._post(method, payload)
+            except httpx.TransportError as e:
+                error = f"{type(e).__name__}: {e}"
+                delay = self.backoff * 2 ** attempt
+            else:
+                if response.status_code == 200:
+                    return response.json().get("result")
+
+                try:
+                    body = response.json()
+                except ValueError:
+                    body = {}
+                error = body.get("description") or response.text
+
+                if response.status_code == 429:
+                    self.metrics["rate_limited"] += 1
+                    retry_after = body.get("parameters", {}).get("retry_after")
+                    if retry_after is None:
+                        retry_after = response.headers.get("Retry-After", self.backoff)
+                    delay = float(retry_after)
+                elif response.status_code >= 500:
+                    delay = self.backoff * 2 ** attempt
+                else:
+                    raise NotificationError(f"{method} failed with {response.status_code}: {error}", retryable=False)
+
+            if attempt == self.max_retries:
+                break
+            self.metrics["retries"] += 1
+            logger.warning(f"{method} failed ({error}), retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
+
+        raise NotificationError(f"{method} failed after {self.max_retries + 1} attempts: {error}")
+
+    async def send_message(self, chat_id, text, **kwargs):
+        """Sends a text message and returns the sent Message as a dict."""
+        try:
+            message = await self.call("sendMessage", {"chat_id": chat_id, "text": text, **kwargs})
+        except NotificationError:
+            self.metrics["failed"] += 1
+            raise
+        self.metrics["sent"] += 1
+        return message
+
+    async def close(self):
+        """Closes the underlying connection pool."""
+        await self._client.aclose()
+
+
+class RateLimiter:
+    """Token bucket allowing ``rate`` acquisitions per second on average."""
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst if burst is not None else rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        """Waits until a token is available and takes it."""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class OutboxWorker:
+    """Background task that delivers queued client messages from the outbox.
+
+    Messages are written to the ``outbox`` table in the same transaction as
+    the change they describe and are only marked as sent after the Bot API
+    accepted them, so delivery is at-least-once. Sends are paced by a global
+    token bucket and at most one message per chat per ``per_chat_interval``;
+    failed messages are retried with exponential backoff.
+    """
+
+    def __init__(self, notifier, global_rate=GLOBAL_RATE, per_chat_interval=PER_CHAT_INTERVAL,
+                 batch_size=OUTBOX_BATCH_SIZE, poll_interval=OUTBOX_POLL_INTERVAL,
+                 max_attempts=OUTBOX_MAX_ATTEMPTS):
+        self.notifier = notifier
+        self.per_chat_interval = per_chat_interval
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.metrics = {"delivered": 0, "failed_attempts": 0, "given_up": 0, "last_batch_size": 0}
+        self._limiter = RateLimiter(global_rate)
+        self._last_sent = {}
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    def start(self):
+        """Starts draining the outbox on the running event loop."""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run(), name="outbox-worker")
+
+    async def stop(self):
+        """Stops the background task."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def wake(self):
+        """Asks the worker to check the outbox now instead of at the next poll."""
+        self._wakeup.set()
+
+    async def _deliver(self, notification_id, chat_id, text, attempts):
+        await self._limiter.acquire()
+        self._last_sent[chat_id] = time.monotonic()
+        try:
+            await self.notifier.send_message(chat_id, text)
+            return notification_id
+        except Exception as e:
+            self.metrics["failed_attempts"] += 1
+            give_up = attempts + 1 >= self.max_attempts or not getattr(e, "retryable", True)
+            if give_up:
+                self.metrics["given_up"] += 1
+                logger.error(f"Giving up on notification {notification_id} to {chat_id}: {e}")
+            else:
+                logger.warning(f"Notification {notification_id} to {chat_id} failed: {e}")
+            delay = min(OUTBOX_MAX_BACKOFF, OUTBOX_RETRY_BACKOFF * 2 ** attempts)
+            await reschedule_notification(notification_id, delay, str(e), give_up=give_up)
+            return None
+
+    async def deliver_due(self):
+        """Delivers one batch of due messages. Returns how many were fetched."""
+        batch = await get_due_notifications(self.batch_size)
+        self.metrics["last_batch_size"] = len(batch)
+        now = time.monotonic()
+        self._last_sent = {
+            chat_id: sent for chat_id, sent in self._last_sent.items()
+            if now - sent < self.per_chat_interval
+        }
+
+        # The batch has one message per chat; chats sent to a moment ago wait for a later round
+        ready = [notification for notification in batch if notification[1] not in self._last_sent]
+
+        delivered = await asyncio.gather(*(self._deliver(*notification) for notification in ready))
+        delivered = [notification_id for notification_id in delivered if notification_id is not None]
+        if delivered:
+            await mark_notifications_sent(delivered)
+            self.metrics["delivered"] += len(delivered)
+        return len(batch)
+
+    async def _run(self):
+        while True:
+            try:
+                fetched = await self.deliver_due()
+            except Exception as e:
+                logger.error(f"Outbox worker error: {e}")
+                fetched = 0
+            if not fetched:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                self._wakeup.clear()
+            else:
+                # A batch holds one message per chat, so more may be queued behind it;
+                # pace the next round by the per-chat limit
+                await asyncio.sleep(min(self.poll_interval, self.per_chat_interval))
@@ -0,0 +1,116 @@
+"""Bulk import and export of orders for the ops team.
+
+Usage:
+    python orders_cli.py import FILE [--format csv|jsonl] [--chunk-size N]
+    python orders_cli.py export [FILE] [--format csv|jsonl] [--after-id N] [--batch-size N]
+
+CSV files have a header row with the field names, JSONL files one JSON
+object per line. Import accepts the fields user_id, from_city, to_city,
+tariff, trip_time, phone_number and optionally status, driver_id,
+created_at and price. Export writes the same fields plus id, to stdout unless FILE is
+given. The storage settings of config.json are applied; throughput is
+reported on stderr.
+"""
+import argparse
+import csv
+import json
+import sys
+import time
+
+import database
+import scheduling
+
+
+def read_config():
+    try:
+        with open('config.json', 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def detect_format(path, fmt):
+    if fmt:
+        return fmt
+    return "jsonl" if path and path.endswith((".jsonl", ".ndjson")) else "csv"
+
+
+def read_orders(f, fmt):
+    """Yields one dict per order from an open CSV or JSONL file."""
+    if fmt == "csv":
+        yield from csv.DictReader(f)
+    else:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def write_orders(f, fmt, rows):
+    """Writes order rows to an open file. Returns how many were written."""
+    count = 0
+    if fmt == "csv":
+        writer = csv.writer(f)
+        writer.writerow(database.EXPORT_COLUMNS)
+        for row in rows:
+            writer.writerow(row)
+            count += 1
+    else:
+        for row in rows:
+            f.write(json.dumps(dict(zip(database.EXPORT_COLUMNS, row)), ensure_ascii=False) + "\n")
+            count += 1
+    return count
+
+
+def report(action, count, elapsed):
+    print(f"{action} {count} orders in {elapsed:.2f}s ({count / max(elapsed, 1e-9):.0f} rows/s)", file=sys.stderr)
+
+
+def import_command(args):
+    fmt = detect_format(args.file, args.format)
+    start = time.perf_counter()
+    with open(args.file, newline="", encoding="utf-8") as f:
+        count = database.import_orders(read_orders(f, fmt), chunk_size=args.chunk_size)
+    if count is None:
+        print("Import stopped on an error; only the chunks before it were imported, see the log.", file=sys.stderr)
+        sys.exit(1)
+    report("Imported", count, time.perf_counter() - start)
+
+
+def export_command(args):
+    fmt = detect_format(args.file, args.format)
+    rows = database.export_orders(after_id=args.after_id, batch_size=args.batch_size)
+    start = time.perf_counter()
+    if args.file:
+        with open(args.file, "w", newline="", encoding="utf-8") as f:
+            count = write_orders(f, fmt, rows)
+    else:
+        count = write_orders(sys.stdout, fmt, rows)
+    report("Exported", count, time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    import_parser = subparsers.add_parser("import", help="insert orders from a CSV or JSONL file")
+    import_parser.add_argument("file")
+    import_parser.add_argument("--format", choices=("csv", "jsonl"))
+    import_parser.add_argument("--chunk-size", type=int, default=database.IMPORT_CHUNK_SIZE)
+    import_parser.set_defaults(func=import_command)
+
+    export_parser = subparsers.add_parser("export", help="stream orders to a CSV or JSONL file")
+    export_parser.add_argument("file", nargs="?")
+    export_parser.add_argument("--format", choices=("csv", "jsonl"))
+    export_parser.add_argument("--after-id", type=int, default=0, help="only orders with a larger ID")
+    export_parser.add_argument("--batch-size", type=int, default=database.EXPORT_BATCH_SIZE)
+    export_parser.set_defaults(func=export_command)
+
+    args = parser.parse_args()
+    config = read_config()
+    scheduling.set_timezone(config.get('TIMEZONE', scheduling.TIMEZONE))
+    database.initialize_database(config.get('STORAGE', {}))
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
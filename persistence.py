@@ -0,0 +1,135 @@
+"""SQLite-backed persistence for the bots' conversations and user data.
+
+Without persistence every restart of a bot process forgets half-finished
+orders and registrations. ``SQLitePersistence`` keeps conversation states
+and ``user_data`` in the shared database, but writes them behind: changes
+are collected in memory and written as one transaction per flush interval,
+so a button press never waits on a disk write.
+"""
+import asyncio
+import collections
+import json
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+from async_database import load_persisted, save_persisted
+from metrics import REGISTRY
+
+# Seconds between flushes to the database
+FLUSH_INTERVAL = 5.0
+
+
+def _dumps(value):
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":"))
+
+
+class SQLitePersistence(BasePersistence):
+    """Write-behind persistence for user data and conversation states.
+
+    ``namespace`` keeps the client and driver bots apart in the shared table,
+    since the same Telegram user may talk to both. Only user data and
+    conversations are stored; bot data holds tokens and live objects, and
+    chat data is not used by the bots.
+    """
+
+    def __init__(self, namespace, flush_interval=FLUSH_INTERVAL):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=flush_interval,
+        )
+        self.namespace = namespace
+        self.metrics = {"flushes": 0, "rows_written": 0, "last_flush_rows": 0}
+        self._pending = {}
+        self._flush_task = None
+        self._flush_lock = asyncio.Lock()
+        # Current state of every active conversation, for the state gauges
+        self._conversation_states = {}
+        REGISTRY.add_collector(self._collect_conversations)
+
+    def _kind(self, kind):
+        return f"{self.namespace}:{kind}"
+
+    def _stage(self, kind, key, value):
+        """Records a change to be written by the next flush."""
+        self._pending[(self._kind(kind), key)] = None if value is None else _dumps(value)
+        # Application.update_persistence() reports every change of one interval
+        # back to back; writing after it yields turns them into one transaction
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self.flush())
+
+    async def get_user_data(self):
+        return {int(key): json.loads(value) for key, value in await load_persisted(self._kind("user_data"))}
+
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name):
+        rows = await load_persisted(self._kind(f"conversation:{name}"))
+        conversations = {tuple(json.loads(key)): json.loads(value) for key, value in rows}
+        for key, state in conversations.items():
+            self._conversation_states[(name, key)] = state
+        return conversations
+
+    async def update_conversation(self, name, key, new_state):
+        if new_state is None:
+            self._conversation_states.pop((name, key), None)
+        else:
+            self._conversation_states[(name, key)] = new_state
+        self._stage(f"conversation:{name}", _dumps(list(key)), new_state)
+
+    def _collect_conversations(self):
+        counts = collections.Counter((name, state) for (name, _), state in self._conversation_states.items())
+        for (name, state), count in counts.items():
+            labels = {"bot": self.namespace, "conversation": name, "state": state}
+            yield "conversations", "Active conversations by state", labels, count
+
+    async def update_user_data(self, user_id, data):
+        self._stage("user_data", str(user_id), data if data else None)
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_user_data(self, user_id):
+        self._stage("user_data", str(user_id), None)
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def refresh_user_data(self, user_id, user_data):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    async def flush(self):
+        """Writes all pending changes in a single transaction."""
+        await asyncio.sleep(0)
+        # Serialize writers so an older batch can never overwrite a newer one
+        async with self._flush_lock:
+            if not self._pending:
+                return
+            pending, self._pending = self._pending, {}
+            changes = [(kind, key, value) for (kind, key), value in pending.items()]
+            if not await save_persisted(changes):
+                # Keep the changes for the next flush unless newer ones replaced them
+                for change_key, value in pending.items():
+                    self._pending.setdefault(change_key, value)
+                return
+            self.metrics["flushes"] += 1
+            self.metrics["rows_written"] += len(changes)
+            self.metrics["last_flush_rows"] = len(changes)
@@ -0,0 +1,158 @@
+"""Which drivers are working right now.
+
+Drivers start and end their shift in the driver bot. ``PresenceRegistry``
+keeps the open shifts in memory, so the dispatcher can offer new orders to
+online drivers only without asking the database. Every update from a driver
+on shift counts as a heartbeat; a shift without one for ``ttl`` seconds is
+closed, so a driver who forgot /shift_stop does not get orders all night.
+``on_expired`` lets the bot tell those drivers that their shift ended.
+
+Shifts are written behind to the ``driver_sessions`` table, one batched
+upsert per flush interval, and restored from it when the bot restarts.
+"""
+import asyncio
+import collections
+import logging
+import time
+
+from async_database import load_driver_sessions, save_driver_sessions
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+# Seconds without any update from a driver after which their shift ends
+HEARTBEAT_TTL = 2 * 3600.0
+# Seconds between expiry checks and writes to the database
+FLUSH_INTERVAL = 5.0
+
+
+class PresenceRegistry:
+    """Open shifts by driver: driver_id -> (city, started_at, last_seen), in wall-clock seconds."""
+
+    def __init__(self, ttl=HEARTBEAT_TTL, flush_interval=FLUSH_INTERVAL, on_expired=None):
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        # ``async def on_expired(driver_ids)``, awaited after shifts expired
+        self.on_expired = on_expired
+        self.metrics = {"started": 0, "stopped": 0, "expired": 0, "flushes": 0, "rows_written": 0}
+        self._sessions = {}
+        self._pending = {}
+        self._flush_lock = asyncio.Lock()
+        self._task = None
+        REGISTRY.add_collector(self._collect)
+
+    async def load(self):
+        """Restores the shifts that were open, and have not expired, when the bot stopped."""
+        now = time.time()
+        expired = []
+        for driver_id, city, started_at, last_seen in await load_driver_sessions():
+            if now - last_seen < self.ttl:
+                self._sessions[driver_id] = (city, started_at, last_seen)
+            else:
+                self._stage(driver_id, None)
+                expired.append(driver_id)
+        logger.info(f"Restored {len(self._sessions)} open shifts")
+        if expired and self.on_expired is not None:
+            await self.on_expired(expired)
+
+    def start(self):
+        """Starts the background expiry and flush task on the running event loop."""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run(), name="presence")
+
+    async def stop(self):
+        """Stops the background task and writes what is still pending."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    def _stage(self, driver_id, session):
+        self._pending[driver_id] = session
+
+    def start_shift(self, driver_id, city):
+        """Puts a driver online in ``city``; starting again only moves them."""
+        now = time.time()
+        started_at = self._sessions[driver_id][1] if driver_id in self._sessions else now
+        self._sessions[driver_id] = (city, started_at, now)
+        self._stage(driver_id, self._sessions[driver_id])
+        self.metrics["started"] += 1
+
+    def stop_shift(self, driver_id):
+        """Takes a driver offline. Returns False if they were not on shift."""
+        if self._sessions.pop(driver_id, None) is None:
+            return False
+        self._stage(driver_id, None)
+        self.metrics["stopped"] += 1
+        return True
+
+    def heartbeat(self, driver_id):
+        """Records that a driver is still around; a no-op for drivers off shift."""
+        session = self._sessions.get(driver_id)
+        if session is not None:
+            self._sessions[driver_id] = (session[0], session[1], time.time())
+            self._stage(driver_id, self._sessions[driver_id])
+
+    def rename_driver(self, old_id, new_id):
+        """Moves an open shift to a driver's new Telegram ID."""
+        session = self._sessions.pop(old_id, None)
+        if session is not None:
+            self._sessions[new_id] = session
+            self._stage(old_id, None)
+            self._stage(new_id, session)
+
+    def is_online(self, driver_id):
+        return driver_id in self._sessions
+
+    def online(self, driver_ids):
+        """The subset of ``driver_ids`` that is on shift."""
+        return {driver_id for driver_id in driver_ids if driver_id in self._sessions}
+
+    def counts_by_city(self):
+        return collections.Counter(city for city, _, _ in self._sessions.values())
+
+    def expire(self):
+        """Ends the shifts without a heartbeat for ``ttl`` seconds. Returns their driver IDs."""
+        deadline = time.time() - self.ttl
+        expired = [driver_id for driver_id, (_, _, last_seen) in self._sessions.items() if last_seen < deadline]
+        for driver_id in expired:
+            del self._sessions[driver_id]
+            self._stage(driver_id, None)
+        if expired:
+            self.metrics["expired"] += len(expired)
+            logger.info(f"Shifts of {len(expired)} drivers expired")
+        return expired
+
+    async def flush(self):
+        """Writes all changed shifts in one transaction."""
+        async with self._flush_lock:
+            if not self._pending:
+                return
+            pending, self._pending = self._pending, {}
+            rows = [(driver_id, *(session or (None, None, None))) for driver_id, session in pending.items()]
+            if not await save_driver_sessions(rows):
+                # Keep the changes for the next flush unless newer ones replaced them
+                for driver_id, session in pending.items():
+                    self._pending.setdefault(driver_id, session)
+                return
+            self.metrics["flushes"] += 1
+            self.metrics["rows_written"] += len(rows)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                expired = self.expire()
+                await self.flush()
+                if expired and self.on_expired is not None:
+                    await self.on_expired(expired)
+            except Exception as e:
+                logger.error(f"Presence flush failed: {e}")
+
+    def _collect(self):
+        for city, count in self.counts_by_city().items():
+            yield "drivers_online", "Drivers on shift by city", {"city": city}, count
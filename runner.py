@@ -0,0 +1,138 @@
+"""Hosting both bots: in one asyncio loop, or as supervised subprocesses.
+
+``run_applications`` drives several ``Application``s through the same
+lifecycle as ``run_polling`` (initialize, post_init, start, ..., post_shutdown)
+inside one event loop, so the bots share one interpreter, one database pool
+and one HTTP connection pool. ``supervise`` keeps the old one-process-per-bot
+layout but restarts a bot that crashes, with exponential backoff.
+"""
+import logging
+import resource
+import signal
+import subprocess
+import sys
+import time
+
+logger = logging.getLogger(__name__)
+
+# Supervisor defaults
+RESTART_BACKOFF = 1.0
+MAX_RESTART_BACKOFF = 60.0
+# A child that ran at least this long before crashing restarts with the initial backoff
+STABLE_RUNTIME = 60.0
+
+
+def rss_mb(pid=None):
+    """Returns the resident set size of a process (default: this one) in MB."""
+    try:
+        with open(f"/proc/{pid or 'self'}/status", encoding="ascii") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    if pid is None:
+        # Peak rather than current RSS, but available everywhere; Linux reports KB
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / 1024 / 1024 if sys.platform == "darwin" else peak / 1024
+    return 0.0
+
+
+async def start_application(application, polling=True):
+    """Initializes and starts one application, running its post_init hook."""
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    if polling:
+        await application.updater.start_polling()
+    await application.start()
+
+
+async def stop_application(application):
+    """Stops update processing of one application, running its post_stop hook."""
+    if application.updater and application.updater.running:
+        await application.updater.stop()
+    if application.running:
+        await application.stop()
+    if application.post_stop:
+        await application.post_stop(application)
+
+
+async def shutdown_application(application):
+    """Shuts one application down, running its post_shutdown hook."""
+    await application.shutdown()
+    if application.post_shutdown:
+        await application.post_shutdown(application)
+
+
+async def run_applications(applications, stop_event, polling=True):
+    """Runs ``applications`` in the current loop until ``stop_event`` is set.
+
+    All applications are stopped before any is shut down, because they may
+    share an HTTP connection pool.
+    """
+    started_at = time.perf_counter()
+    started = []
+    try:
+        for application in applications:
+            await start_application(application, polling=polling)
+            started.append(application)
+        logger.info(
+            f"{len(started)} bots started in {time.perf_counter() - started_at:.2f}s, "
+            f"RSS {rss_mb():.1f} MB"
+        )
+        await stop_event.wait()
+    finally:
+        for application in reversed(started):
+            await stop_application(application)
+        for application in reversed(started):
+            await shutdown_application(application)
+
+
+def supervise(scripts, restart_backoff=RESTART_BACKOFF, max_backoff=MAX_RESTART_BACKOFF):
+    """Runs each script in its own interpreter and restarts it when it exits.
+
+    Blocks until interrupted with Ctrl+C or SIGTERM, then terminates all children.
+    """
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    processes = {}
+    backoff = {script: restart_backoff for script in scripts}
+    restart_at = {script: 0.0 for script in scripts}
+    started_at = {}
+
+    try:
+        while True:
+            now = time.monotonic()
+            for script in scripts:
+                process = processes.get(script)
+                if process is not None:
+                    code = process.poll()
+                    if code is None:
+                        continue
+                    runtime = now - started_at[script]
+                    if runtime >= STABLE_RUNTIME:
+                        backoff[script] = restart_backoff
+                    logger.error(
+                        f"{script} exited with code {code} after {runtime:.0f}s, "
+                        f"restarting in {backoff[script]:.0f}s"
+                    )
+                    restart_at[script] = now + backoff[script]
+                    backoff[script] = min(max_backoff, backoff[script] * 2)
+                    processes[script] = None
+                elif now >= restart_at[script]:
+                    processes[script] = subprocess.Popen([sys.executable, script])
+                    started_at[script] = now
+                    logger.info(f"Started {script} (pid {processes[script].pid})")
+            time.sleep(0.5)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        running = [process for process in processes.values() if process is not None]
+        for process in running:
+            process.terminate()
+        for process in running:
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        logger.info(f"Stopped {len(running)} bot processes")
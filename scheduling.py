@@ -0,0 +1,189 @@
+"""Trip times and the release of pre-booked orders to drivers.
+
+Clients pick a time of day; ``resolve_trip_time`` turns it into the next
+such moment, so 06:00 chosen at 23:00 means tomorrow morning. Trip times
+are stored as "YYYY-MM-DD HH:MM" in the service's time zone, which sorts
+and compares correctly as text.
+
+An order is due once its trip is at most the release lead time away.
+The driver bot offers due orders right away. ``ReleaseScheduler`` holds
+the rest in a heap keyed by release time and releases each one when its
+time comes, with a single timer for the earliest one.
+"""
+import asyncio
+import heapq
+import logging
+import time
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo
+
+logger = logging.getLogger(__name__)
+
+TRIP_TIME_FORMAT = "%Y-%m-%d %H:%M"
+
+# Time zone of the service area (Bashkortostan)
+TIMEZONE = "Asia/Yekaterinburg"
+# Seconds before pickup at which a booked order is offered to drivers
+RELEASE_LEAD = 3600.0
+# A picked time up to this far in the past means "now" rather than tomorrow
+PAST_GRACE = timedelta(minutes=15)
+
+_zone = ZoneInfo(TIMEZONE)
+
+
+def set_timezone(name):
+    """Sets the service time zone, e.g. from TIMEZONE in config.json."""
+    global _zone
+    _zone = ZoneInfo(name)
+
+
+def local_now():
+    """The current time in the service time zone, as a naive datetime."""
+    return datetime.now(_zone).replace(tzinfo=None)
+
+
+def from_utc(value):
+    """The service-zone time of a UTC "YYYY-MM-DD HH:MM:SS" value such as orders.created_at."""
+    placed = datetime.fromisoformat(value).replace(tzinfo=timezone.utc)
+    return placed.astimezone(_zone).replace(tzinfo=None)
+
+
+def parse_trip_time(value):
+    """The datetime of a stored trip time, or None for legacy "HH:MM" values."""
+    try:
+        return datetime.strptime(value, TRIP_TIME_FORMAT)
+    except (TypeError, ValueError):
+        return None
+
+
+def resolve_trip_time(hour, minute, now=None):
+    """The next moment at ``hour:minute``, formatted for storage."""
+    now = now or local_now()
+    trip = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+    if trip < now - PAST_GRACE:
+        trip += timedelta(days=1)
+    return trip.strftime(TRIP_TIME_FORMAT)
+
+
+def normalize_trip_time(value, placed=None):
+    """A trip time for storage from an imported value: "YYYY-MM-DD HH:MM", or a
+    bare "HH:MM" dated as if picked at ``placed``. Raises ValueError otherwise."""
+    # Fast path for values already in the stored format, e.g. from an export
+    if isinstance(value, str) and len(value) == 16:
+        try:
+            return datetime.fromisoformat(value).strftime(TRIP_TIME_FORMAT)
+        except ValueError:
+            pass
+    trip = parse_trip_time(value)
+    if trip is not None:
+        return trip.strftime(TRIP_TIME_FORMAT)
+    try:
+        hour, minute = value.split(":")
+        if len(minute) != 2:
+            raise ValueError(value)
+        return resolve_trip_time(int(hour), int(minute), placed)
+    except (AttributeError, TypeError, ValueError):
+        raise ValueError(f"Not a trip time: {value!r}") from None
+
+
+def format_trip_time(value, with_date=False, now=None):
+    """A stored trip time for people: "18:30" today, "18.10 06:00" on other days or with ``with_date``."""
+    trip = parse_trip_time(value)
+    if trip is None:
+        return value
+    if not with_date and trip.date() == (now or local_now()).date():
+        return f"{trip:%H:%M}"
+    return f"{trip:%d.%m %H:%M}"
+
+
+def due_cutoff(lead=RELEASE_LEAD, now=None):
+    """Orders with a trip time up to this stored value are due now."""
+    return ((now or local_now()) + timedelta(seconds=lead)).strftime(TRIP_TIME_FORMAT)
+
+
+class ReleaseScheduler:
+    """Offers orders to drivers ``lead`` seconds before their trip time.
+
+    ``release`` is an ``async def release(order)`` callback. ``add`` calls it
+    right away for due orders and otherwise pushes the order on a heap of
+    (release time, order id); one background task sleeps until the top of
+    the heap is due or an earlier order arrives.
+    """
+
+    def __init__(self, release, lead=RELEASE_LEAD):
+        self.release = release
+        self.lead = lead
+        self.metrics = {"scheduled": 0, "released": 0, "pending": 0}
+        self._heap = []
+        self._orders = {}
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    def start(self):
+        """Starts the release timer on the running event loop."""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run(), name="release-scheduler")
+
+    async def stop(self):
+        """Stops the release timer; scheduled orders are reloaded from the database on restart."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def release_time(self, order):
+        """Wall-clock time at which an order becomes due; 0 for legacy trip times."""
+        trip = parse_trip_time(order[5])
+        if trip is None:
+            return 0.0
+        return trip.replace(tzinfo=_zone).timestamp() - self.lead
+
+    async def add(self, order):
+        """Releases a due order now, or schedules it. Adding a scheduled order again is a no-op."""
+        order_id = order[0]
+        if order_id in self._orders:
+            return
+        release_at = self.release_time(order)
+        if release_at <= time.time():
+            await self._release(order)
+            return
+
+        self._orders[order_id] = order
+        heapq.heappush(self._heap, (release_at, order_id))
+        self.metrics["scheduled"] += 1
+        self.metrics["pending"] = len(self._orders)
+        # Only an order due before the current timer needs to move it
+        if self._heap[0][1] == order_id:
+            self._wakeup.set()
+
+    def cancel(self, order_id):
+        """Drops a scheduled order, e.g. one that expired; its heap entry is skipped later."""
+        if self._orders.pop(order_id, None) is not None:
+            self.metrics["pending"] = len(self._orders)
+
+    async def _release(self, order):
+        try:
+            await self.release(order)
+            self.metrics["released"] += 1
+        except Exception as e:
+            logger.error(f"Failed to release order {order[0]}: {e}")
+
+    async def _run(self):
+        while True:
+            now = time.time()
+            while self._heap and self._heap[0][0] <= now:
+                _, order_id = heapq.heappop(self._heap)
+                order = self._orders.pop(order_id, None)
+                if order is not None:
+                    self.metrics["pending"] = len(self._orders)
+                    await self._release(order)
+
+            timeout = self._heap[0][0] - time.time() if self._heap else None
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
@@ -0,0 +1,94 @@
+"""Concurrent update processing that keeps each user's updates in order.
+
+By default an ``Application`` handles one update at a time, so one slow
+database write or Bot API call holds up every other user. With
+``KeyedUpdateProcessor`` updates run concurrently, up to a configurable
+cap, except that updates sharing a key wait for each other: a user's second
+button press is never handled before the first one, and two drivers pressing
+"Взять заказ" on the same order are handled one after the other.
+"""
+import asyncio
+import re
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+# Updates handled at the same time
+CONCURRENT_UPDATES = 32
+# Updates admitted at the same time, including those waiting for their key
+MAX_PENDING_UPDATES = 1024
+
+ORDER_CALLBACK = re.compile(r"^accept_(\d+)$")
+
+
+def update_keys(update):
+    """Returns the ordering keys of an update: its user and the order it is about."""
+    if not isinstance(update, Update):
+        return ()
+    keys = []
+    if update.effective_user is not None:
+        keys.append(("user", update.effective_user.id))
+    elif update.effective_chat is not None:
+        keys.append(("chat", update.effective_chat.id))
+    if update.callback_query is not None and update.callback_query.data:
+        match = ORDER_CALLBACK.match(update.callback_query.data)
+        if match:
+            keys.append(("order", int(match.group(1))))
+    return tuple(keys)
+
+
+class KeyedUpdateProcessor(BaseUpdateProcessor):
+    """Runs unrelated updates in parallel and updates with a common key in arrival order.
+
+    Each update is chained behind the previous update holding any of its keys
+    and only takes one of the ``concurrency`` running slots once those have
+    finished, so a user sending many updates at once does not block the
+    slots of everyone else. ``max_pending_updates`` bounds how many updates
+    are admitted, running or waiting, at the same time.
+    """
+
+    def __init__(self, concurrency=CONCURRENT_UPDATES, max_pending_updates=MAX_PENDING_UPDATES, key_func=update_keys):
+        super().__init__(max(concurrency, max_pending_updates))
+        self.concurrency = concurrency
+        self.key_func = key_func
+        self.metrics = {"processed": 0, "waited_for_key": 0, "max_running": 0}
+        self._running = asyncio.Semaphore(concurrency)
+        self._running_count = 0
+        self._tails = {}
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_process_update(self, update, coroutine):
+        keys = self.key_func(update)
+        done = asyncio.get_running_loop().create_future()
+        # Registration happens before the first await, so the chains follow arrival order
+        previous = {self._tails[key] for key in keys if key in self._tails}
+        for key in keys:
+            self._tails[key] = done
+
+        started = False
+        try:
+            if previous:
+                self.metrics["waited_for_key"] += 1
+                await asyncio.wait(previous)
+            async with self._running:
+                started = True
+                self._running_count += 1
+                self.metrics["max_running"] = max(self.metrics["max_running"], self._running_count)
+                try:
+                    await coroutine
+                finally:
+                    self._running_count -= 1
+                    self.metrics["processed"] += 1
+        finally:
+            if not started:
+                # Cancelled while waiting for its turn
+                coroutine.close()
+            done.set_result(None)
+            for key in keys:
+                if self._tails.get(key) is done:
+                    del self._tails[key]
@@ -0,0 +1,175 @@
+"""Webhook mode: one local HTTP server receiving updates for both bots.
+
+Instead of each bot long-polling ``getUpdates``, Telegram POSTs updates to
+``<WEBHOOK.url>/<path>``. ``WebhookServer`` serves every registered bot on its
+own path from a single asyncio server, checks Telegram's secret token header,
+and hands updates to the applications through a bounded queue. When the queue
+is full it answers 503 and Telegram redelivers the update later.
+
+It is a deliberately small HTTP/1.1 implementation on ``asyncio.start_server``
+so that webhook mode needs no extra dependencies; put it behind a TLS
+terminating reverse proxy.
+"""
+import asyncio
+import hmac
+import json
+import logging
+from http import HTTPStatus
+
+from telegram import Update
+
+from runner import shutdown_application, start_application, stop_application
+
+logger = logging.getLogger(__name__)
+
+# Server defaults
+LISTEN = "127.0.0.1"
+PORT = 8080
+MAX_QUEUE = 1000
+MAX_BODY = 1024 * 1024
+SECRET_HEADER = "x-telegram-bot-api-secret-token"
+
+
+class WebhookServer:
+    """Serves the webhook endpoints of several applications on one port."""
+
+    def __init__(self, listen=LISTEN, port=PORT, max_queue=MAX_QUEUE):
+        self.listen = listen
+        self.port = port
+        self.metrics = {"received": 0, "rejected": 0, "queue_full": 0}
+        self._routes = {}
+        self._queue = asyncio.Queue(maxsize=max_queue)
+        self._server = None
+        self._forwarder = None
+
+    def add_bot(self, path, application, secret_token):
+        """Routes POST requests for ``path`` to ``application``."""
+        self._routes["/" + path.strip("/")] = (application, secret_token)
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle_connection, self.listen, self.port)
+        # Port 0 means "any free port"; report the one actually bound
+        self.port = self._server.sockets[0].getsockname()[1]
+        self._forwarder = asyncio.create_task(self._forward_updates(), name="webhook-forwarder")
+        logger.info(f"Webhook server listening on {self.listen}:{self.port} for {', '.join(self._routes)}")
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+        if self._forwarder is not None:
+            # Hand over what was already accepted before stopping
+            await self._queue.join()
+            self._forwarder.cancel()
+            try:
+                await self._forwarder
+            except asyncio.CancelledError:
+                pass
+            self._forwarder = None
+
+    async def _forward_updates(self):
+        while True:
+            application, data = await self._queue.get()
+            try:
+                await application.update_queue.put(Update.de_json(data, application.bot))
+            except Exception as e:
+                logger.error(f"Failed to enqueue webhook update: {e}")
+            finally:
+                self._queue.task_done()
+
+    def _route(self, method, path, headers, body):
+        """Returns the HTTP status for one request."""
+        if method != "POST":
+            return HTTPStatus.METHOD_NOT_ALLOWED
+        route = self._routes.get(path.split("?", 1)[0])
+        if route is None:
+            return HTTPStatus.NOT_FOUND
+        application, secret_token = route
+        if not hmac.compare_digest(headers.get(SECRET_HEADER, "").encode(), secret_token.encode()):
+            self.metrics["rejected"] += 1
+            return HTTPStatus.FORBIDDEN
+        try:
+            data = json.loads(body)
+        except ValueError:
+            return HTTPStatus.BAD_REQUEST
+        try:
+            self._queue.put_nowait((application, data))
+        except asyncio.QueueFull:
+            self.metrics["queue_full"] += 1
+            return HTTPStatus.SERVICE_UNAVAILABLE
+        self.metrics["received"] += 1
+        return HTTPStatus.OK
+
+    async def _handle_connection(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, _ = request_line.decode("latin-1").split(" ", 2)
+
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+
+                length = int(headers.get("content-length", 0))
+                if length > MAX_BODY:
+                    status = HTTPStatus.REQUEST_ENTITY_TOO_LARGE
+                    keep_alive = False
+                else:
+                    body = await reader.readexactly(length) if length else b""
+                    status = self._route(method, path, headers, body)
+                    keep_alive = headers.get("connection", "").lower() != "close"
+
+                writer.write(
+                    f"HTTP/1.1 {status.value} {status.phrase}\r\n"
+                    f"Content-Length: 0\r\n"
+                    f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode()
+                )
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ValueError, asyncio.IncompleteReadError, ConnectionError) as e:
+            logger.debug(f"Dropping webhook connection: {e}")
+        finally:
+            writer.close()
+
+
+async def run_webhook(bots, webhook_config, stop_event):
+    """Runs ``bots`` ({path: application}) in webhook mode until ``stop_event`` is set.
+
+    ``webhook_config`` is the WEBHOOK section of config.json: ``url`` (public
+    base URL), ``secret_token`` and optionally ``listen``, ``port`` and
+    ``max_queue``.
+    """
+    server = WebhookServer(
+        listen=webhook_config.get("listen", LISTEN),
+        port=webhook_config.get("port", PORT),
+        max_queue=webhook_config.get("max_queue", MAX_QUEUE),
+    )
+    base_url = webhook_config["url"].rstrip("/")
+    secret_token = webhook_config["secret_token"]
+
+    for path, application in bots.items():
+        await start_application(application, polling=False)
+        await application.bot.set_webhook(
+            url=f"{base_url}/{path}",
+            secret_token=secret_token,
+            allowed_updates=Update.ALL_TYPES,
+        )
+        server.add_bot(path, application, secret_token)
+
+    await server.start()
+    try:
+        await stop_event.wait()
+    finally:
+        await server.stop()
+        for application in bots.values():
+            await stop_application(application)
+        for application in bots.values():
+            await shutdown_application(application)